@@ -6,20 +6,46 @@
 import streamlit as st
 from google import genai
 from google.genai import types
-from typing import Optional, Generator
+from google.genai import errors
+from typing import Optional, Generator, AsyncGenerator
 import io
 import re
 import time
 import tempfile
+import uuid
 import base64
 import json
+import logging
 import os
+import queue
+import random
+import asyncio
+import atexit
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
+import difflib
+import threading
+import importlib.util
+import sqlite3
+import email.utils
+from collections import OrderedDict, deque
 from datetime import datetime
+import httpx
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
 import PyPDF2
 import docx
 
+# 日志：默认只输出警告及以上；排查流式解析等问题时设置环境变量 YOGORT_LOG_LEVEL=DEBUG
+logger = logging.getLogger("yogort")
+logger.setLevel(os.environ.get("YOGORT_LOG_LEVEL", "WARNING").upper())
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("[%(levelname)s %(name)s] %(message)s"))
+    logger.addHandler(_log_handler)
+
 # ============================================
 # 可用的Gemini模型列表
 # ============================================
@@ -93,6 +119,79 @@ GENERATE_PRD_SYSTEM_PROMPT = """你是资深游戏策划"酸奶"。
 
 请根据用户提供的功能描述，生成完整、专业的策划案。创建日期请使用上述当前日期。"""
 
+# 策划案的10个标准章节：(标题, 说明)，与 GENERATE_PRD_SYSTEM_PROMPT 中的内容结构一致
+PRD_STANDARD_CHAPTERS = [
+    ("功能概述", "一句话说清做什么"),
+    ("战略定位", "解决什么问题，为谁解决"),
+    ("用户场景", "具体使用流程和触发点"),
+    ("功能规格", "详细的功能点和交互"),
+    ("AI处理逻辑", "模型调用、数据处理流程"),
+    ("容错设计", "出错时的体验保障"),
+    ("验收标准", "如何判断功能成功"),
+    ("能力边界", "明确什么不能做"),
+    ("技术依赖", "需要的技术资源和接口"),
+    ("版本规划", "分阶段实施计划"),
+]
+
+# 快速生成：大纲的System Prompt（结构化输出，各章节据此并行展开）
+PRD_OUTLINE_SYSTEM_PROMPT = """你是资深游戏策划"酸奶"，正在为策划案拟定大纲。
+
+【回复语言】
+- 请始终使用中文进行回答和输出
+
+【任务】
+根据用户提供的功能描述，为以下10个章节分别列出要点，供10位同事各自独立撰写对应章节：
+""" + "\n".join(f"{i}、{title}（{desc}）" for i, (title, desc) in enumerate(PRD_STANDARD_CHAPTERS, 1)) + """
+
+【要求】
+- title：策划案标题
+- facts：全文共用的关键事实和决策（核心概念的命名、关键数值、角色、状态、接口等），各章节必须保持一致的内容都写在这里
+- chapters：严格按上述顺序输出10项，每项的 points 列出本章需要写到的关键要点和决策（3-6条，每条一句话）
+- 只写要点，不要展开成正文"""
+
+# 快速生成：大纲的结构化输出格式
+PRD_OUTLINE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "title": {"type": "STRING"},
+        "facts": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "chapters": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "title": {"type": "STRING"},
+                    "points": {"type": "ARRAY", "items": {"type": "STRING"}},
+                },
+                "required": ["title", "points"],
+            },
+        },
+    },
+    "required": ["title", "facts", "chapters"],
+}
+
+# 快速生成：按大纲撰写单个章节的System Prompt
+PRD_CHAPTER_SYSTEM_PROMPT = """你是资深游戏策划"酸奶"，正在按照已确定的大纲撰写策划案中的一个章节，其他章节由同事同时撰写。
+
+【回复语言】
+- 请始终使用中文进行回答和输出
+
+【语言约束】
+- 严禁在正文中使用英文（代码变量除外）
+- 所有标题、内容必须使用中文
+
+【格式约束】
+- 只输出指定的一个章节，从该章的一级标题开始（如“4、功能规格”）
+- 小节标题严格使用简单的数字格式（如 4.1、4.2...），不要使用 Markdown 的 # 符号或英文字母作为标题索引
+- 不要输出策划案标题、其他章节或任何说明文字
+
+【内容约束】
+- 大纲中的全局关键信息（命名、数值、流程）必须原样沿用，不得自行更改
+- 本章要点必须全部覆盖，可以补充细节，但不要展开其他章节的内容
+
+【时间信息】
+当前日期：{current_date}"""
+
 # 思维脑图解析的System Prompt
 MINDMAP_PARSE_SYSTEM_PROMPT = """你是一个专业的思维脑图解析专家。
 
@@ -213,6 +312,44 @@ DEVELOPER_REVIEW_PROMPT = """你是一个挑剔的高级开发人员。
 - 每个问题要具体、明确
 - 聚焦于技术可行性、逻辑完整性、边界情况处理"""
 
+# 审查团角色：同一轮中并发审查，各自只关注本职责范围内的问题
+REVIEW_PERSONAS = {
+    "client": {
+        "name": "客户端开发",
+        "focus": "界面与交互状态、客户端性能和包体、弱网和断线重连、多机型适配、前后端接口字段",
+    },
+    "server": {
+        "name": "服务端开发",
+        "focus": "数据结构与存储、接口设计、并发与一致性、防作弊与校验、容量和扩展性",
+    },
+    "qa": {
+        "name": "测试工程师",
+        "focus": "验收标准是否可测、边界值和异常流程、状态组合、回归范围、可复现性",
+    },
+    "liveops": {
+        "name": "运营",
+        "focus": "上线节奏与开关配置、数据埋点和指标、活动与奖励投放、玩家反馈和客服场景、灰度与回滚",
+    },
+}
+
+
+def build_persona_review_prompt(persona: str) -> str:
+    """审查团中某个角色的System Prompt（格式要求与 DEVELOPER_REVIEW_PROMPT 一致）"""
+    info = REVIEW_PERSONAS[persona]
+    return f"""你是一个挑剔的资深{info['name']}。
+
+【回复语言】
+- 请始终使用中文进行回答和输出
+
+请从{info['name']}的角度阅读当前的策划案，提出尖锐的问题，指出逻辑漏洞、缺少的细节或不明确的边缘情况。
+重点关注：{info['focus']}
+
+请只列出问题，不要修改文档，不要提出与你的职责无关的问题。
+
+问题格式要求：
+- 使用数字编号列出问题
+- 每个问题要具体、明确"""
+
 # 策划修改的System Prompt
 PLANNER_FIX_PROMPT = """你是策划酸奶。
 
@@ -232,6 +369,49 @@ PLANNER_FIX_PROMPT = """你是策划酸奶。
 
 请针对开发人员的问题，逐一回应并修改策划案。"""
 
+# 策划修改（补丁模式）的System Prompt：只输出修改或新增的章节
+PLANNER_PATCH_PROMPT = """你是策划酸奶。
+
+【回复语言】
+- 请始终使用中文进行回答和输出
+
+根据开发人员提出的问题，对策划案进行修改、补充和完善。只输出需要修改或新增的一级章节，未修改的章节不要输出。
+
+【输出格式】（必须严格遵守，补丁块之外不要输出任何内容）
+<<<REPLACE 章节编号>>>
+修改后的完整章节（从该章的一级标题开始，如“3、功能流程”，包含其下所有子标题和正文）
+<<<END>>>
+<<<ADD 章节编号>>>
+新增的完整章节（编号紧接在现有最后一章之后）
+<<<END>>>
+
+【格式约束】
+- 被修改的章节必须完整输出，不能只输出改动的句子
+- 不修改已有章节的编号和顺序
+- 严禁在正文中使用英文（代码变量除外）
+- 标题层级严格使用简单的数字格式（如 1.1、1.2...），不要使用 Markdown 的 # 符号"""
+
+# 章节并行优化后的一致性检查System Prompt（输出格式与补丁模式一致）
+PRD_CONSISTENCY_PROMPT = """你是策划酸奶。
+
+【回复语言】
+- 请始终使用中文进行回答和输出
+
+以下策划案的各章节刚刚分别独立修改过，请检查章节之间是否存在不一致：名词和概念、数值和配置、流程和状态、接口和数据字段、验收标准与功能描述等前后矛盾或遗漏引用的地方。
+只修正不一致之处，不要借机改写其他内容。
+
+【输出格式】（必须严格遵守）
+- 没有不一致时只输出：无需修改
+- 有不一致时只输出需要修正的章节，每个章节完整输出：
+<<<REPLACE 章节编号>>>
+修正后的完整章节（从该章的一级标题开始）
+<<<END>>>
+
+【格式约束】
+- 不修改章节编号和顺序
+- 严禁在正文中使用英文（代码变量除外）
+- 标题层级严格使用简单的数字格式（如 1.1、1.2...），不要使用 Markdown 的 # 符号"""
+
 # 复检清单
 CHECKLIST = """
 ---
@@ -517,6 +697,8 @@ def clear_module_session(module_name: str):
     Args:
         module_name: 模块名称
     """
+    # 中止该模块正在进行的后台任务
+    cancel_active_job(module_name)
     if module_name == "生成策划案":
         st.session_state.generated_prd = ""
         st.session_state.uploaded_file_content = ""
@@ -537,6 +719,10 @@ def clear_module_session(module_name: str):
     elif module_name == "优化策划案":
         st.session_state.optimized_prd = ""
         st.session_state.optimize_saved_to_history = False
+        # 不再提示继续之前的优化（检查点记录仍保留到过期）
+        st.session_state.optimize_checkpoint_id = ""
+        if CHECKPOINT_QUERY_PARAM in st.query_params:
+            del st.query_params[CHECKPOINT_QUERY_PARAM]
         clear_chat_history("optimize_prd_chat")
     elif module_name == "汇报助手":
         if "generated_report" in st.session_state:
@@ -571,7 +757,6 @@ def clear_module_session(module_name: str):
         st.session_state.linmo_input_key_counter = st.session_state.get("linmo_input_key_counter", 0) + 1
     elif module_name == "PUBGM WoW 玩法评审":
         st.session_state.wow_review_result = ""
-        st.session_state.wow_is_processing = False
         st.session_state.wow_uploaded_video = None
 
 def build_chat_context(chat_key: str, system_prompt: str, max_history: int = 10) -> str:
@@ -691,6 +876,7 @@ def process_chat_message(chat_key: str, user_message: str, system_prompt: str,
     has_error = False
     error_message = ""
     
+    output_renderer = StreamRenderer(output_container, cursor="▌")
     for chunk in call_gemini_stream(full_prompt, system_prompt):
         if st.session_state.should_stop:
             was_stopped = True
@@ -698,7 +884,7 @@ def process_chat_message(chat_key: str, user_message: str, system_prompt: str,
         
         if chunk["type"] == "text":
             full_response += chunk["content"]
-            output_container.markdown(full_response + "▌")
+            output_renderer.update(full_response)
         elif chunk["type"] == "error":
             has_error = True
             error_message = chunk["content"]
@@ -708,7 +894,7 @@ def process_chat_message(chat_key: str, user_message: str, system_prompt: str,
     
     # 移除光标
     if full_response:
-        output_container.markdown(full_response)
+        output_renderer.flush()
     
     # 处理结果
     if has_error:
@@ -746,7 +932,9 @@ def add_to_history(function_type: str, input_data: dict, output_data: str,
         # 将二进制数据转为base64字符串以便存储到JSON
         "download_data": base64.b64encode(download_data).decode('utf-8') if download_data else None,
         "download_filename": download_filename,
-        "download_mime": download_mime
+        "download_mime": download_mime,
+        # 实际产出结果的模型（发生模型降级时与所选模型不同）
+        "model": st.session_state.get("last_model_used") or st.session_state.get("selected_model", "")
     }
     
     st.session_state.session_history.append(history_item)
@@ -856,6 +1044,8 @@ def render_history_sidebar():
         with st.sidebar.expander(f"#{item_id} {summary}", expanded=False):
             st.caption(f"🕐 {timestamp}")
             st.caption(f"📌 {func_type}")
+            if item.get("model"):
+                st.caption(f"🤖 {item['model']}")
             
             # 查看详情按钮
             if st.button("📄 查看详情", key=f"view_{item_id}", use_container_width=True):
@@ -904,6 +1094,96 @@ SELF_CHECK_SYSTEM_PROMPT = """你是资深游戏策划"酸奶"，正在对策划
 
 请用中文输出，格式清晰易读。"""
 
+# 复检清单条目（并行复检时逐项独立检查）
+# chapters: 该项依赖的策划案章节编号（对应生成策划案的 1、功能概述 … 10、版本规划），
+# 边生成边复检时，依赖章节全部生成完毕即可开始检查
+SELF_CHECK_ITEMS = [
+    {"id": 1, "name": "是否用一句话说清功能核心？", "chapters": [1]},
+    {"id": 2, "name": "是否明确定义目标用户和使用场景？", "chapters": [2, 3]},
+    {"id": 3, "name": "是否描述清楚用户触发路径？", "chapters": [3]},
+    {"id": 4, "name": "是否定义输入要求（格式、限制）？", "chapters": [4]},
+    {"id": 5, "name": "是否说明AI处理逻辑（模型、流程）？", "chapters": [5]},
+    {"id": 6, "name": "是否定义输出格式（是否可编辑）？", "chapters": [4]},
+    {"id": 7, "name": "是否设计用户体验流转（修改、重试）？", "chapters": [4, 6]},
+    {"id": 8, "name": "是否设定量化验收标准？", "chapters": [7]},
+    {"id": 9, "name": "是否声明能力边界？", "chapters": [8]},
+    {"id": 10, "name": "是否列出技术依赖？", "chapters": [9]},
+]
+
+# 单项复检的System Prompt（结构化输出）
+SELF_CHECK_ITEM_SYSTEM_PROMPT = """你是资深游戏策划"酸奶"，正在对策划案进行复检清单中某一项的检查。
+
+【回复语言】
+- 请始终使用中文进行回答和输出
+
+【检查要求】
+- 只针对给定的这一项检查，不要评价其他方面
+- verdict 取值：pass（通过）/ partial（部分满足）/ missing（缺失）
+- suggestion：通过时简要说明依据；部分满足或缺失时具体说明缺少什么内容以及改进建议
+- 严格按照JSON格式输出"""
+
+# 单项复检结果的JSON Schema
+SELF_CHECK_ITEM_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "verdict": {"type": "STRING", "enum": ["pass", "partial", "missing"]},
+        "suggestion": {"type": "STRING"},
+    },
+    "required": ["verdict", "suggestion"],
+}
+
+# 复检判断对应的展示文本
+SELF_CHECK_VERDICT_LABELS = {
+    "pass": "✅ 通过",
+    "partial": "⚠️ 部分满足",
+    "missing": "❌ 缺失",
+}
+
+# 本地规则预检：复检条目 -> 对应的标准章节标题（章节按标题查找，不依赖章节编号）
+LOCAL_SELF_CHECK_SECTIONS = {
+    1: "功能概述",
+    8: "验收标准",
+    9: "能力边界",
+    10: "技术依赖",
+}
+
+# 功能概述视为“一句话”的最大长度（字符）
+LOCAL_SELF_CHECK_SUMMARY_CHARS = 120
+
+# 量化指标：数值 + 单位/比较，或比较符号 + 数值
+LOCAL_SELF_CHECK_METRIC_PATTERN = re.compile(
+    r'\d+(?:\.\d+)?\s*(?:%|％|‰|毫秒|ms|秒|分钟|小时|天|周|次|个|条|项|人|帧|元|倍|MB|KB|GB|以内|以上|以下)'
+    r'|[<>≤≥＜＞]\s*=?\s*\d|(?:不低于|不超过|不少于|不高于|小于|大于|低于|高于|达到)\s*\d'
+)
+
+# 列表项或小节标题（用于判断章节是否逐条列出了内容）
+LOCAL_SELF_CHECK_LIST_PATTERN = re.compile(r'^(?:[-*•·]\s*\S|\d+(?:\.\d+)*[、\.．)）]\s*\S)')
+
+
+# 策划案标题的正则表达式
+# 一级标题: 1、 或 1. 或 1  开头（纯数字）
+PRD_LEVEL1_PATTERN = re.compile(r'^(\d+)[、\.．]\s*(.+)$')
+# 二级标题: 1.1、 或 1.1. 或 1.1 开头
+PRD_LEVEL2_PATTERN = re.compile(r'^(\d+\.\d+)[、\.．]?\s*(.+)$')
+# 三级标题: 1.1.1、 或 1.1.1. 或 1.1.1 开头
+PRD_LEVEL3_PATTERN = re.compile(r'^(\d+\.\d+\.\d+)[、\.．]?\s*(.+)$')
+# 四级标题: 1.1.1.1 开头
+PRD_LEVEL4_PATTERN = re.compile(r'^(\d+\.\d+\.\d+\.\d+)[、\.．]?\s*(.+)$')
+
+
+def get_prd_chapter_number(line: str) -> Optional[int]:
+    """
+    判断一行是否为策划案一级标题（章节），与 parse_prd_to_excel_data 的标题规则一致
+    
+    Returns:
+        int: 章节编号；不是一级标题时返回None
+    """
+    line = line.strip()
+    if PRD_LEVEL2_PATTERN.match(line) or PRD_LEVEL3_PATTERN.match(line) or PRD_LEVEL4_PATTERN.match(line):
+        return None
+    match = PRD_LEVEL1_PATTERN.match(line)
+    return int(match.group(1)) if match else None
+
 
 def parse_prd_to_excel_data(prd_content: str) -> list:
     """
@@ -917,51 +1197,21 @@ def parse_prd_to_excel_data(prd_content: str) -> list:
     Returns:
         list: [(row_data, level), ...] 每行数据和其层级
     """
-    lines = prd_content.strip().split('\n')
     excel_data = []
     current_level = 0
     
-    # 匹配各级标题的正则表达式
-    # 一级标题: 1、 或 1. 或 1  开头（纯数字）
-    level1_pattern = re.compile(r'^(\d+)[、\.．]\s*(.+)$')
-    # 二级标题: 1.1、 或 1.1. 或 1.1 开头
-    level2_pattern = re.compile(r'^(\d+\.\d+)[、\.．]?\s*(.+)$')
-    # 三级标题: 1.1.1、 或 1.1.1. 或 1.1.1 开头
-    level3_pattern = re.compile(r'^(\d+\.\d+\.\d+)[、\.．]?\s*(.+)$')
-    # 四级标题: 1.1.1.1 开头
-    level4_pattern = re.compile(r'^(\d+\.\d+\.\d+\.\d+)[、\.．]?\s*(.+)$')
-    
-    for line in lines:
-        line = line.strip()
-        if not line:
+    for line in parse_prd(prd_content).lines:
+        if not line.stripped:
             continue
         
-        # 检查是否是标题行，从高级别往低级别检查
-        level4_match = level4_pattern.match(line)
-        level3_match = level3_pattern.match(line)
-        level2_match = level2_pattern.match(line)
-        level1_match = level1_pattern.match(line)
-        
-        if level4_match:
-            # 四级标题 -> 第4列
-            current_level = 4
-            excel_data.append((line, 4))
-        elif level3_match:
-            # 三级标题 -> 第3列
-            current_level = 3
-            excel_data.append((line, 3))
-        elif level2_match:
-            # 二级标题 -> 第2列
-            current_level = 2
-            excel_data.append((line, 2))
-        elif level1_match:
-            # 一级标题 -> 第1列
-            current_level = 1
-            excel_data.append((line, 1))
+        if line.outline_level:
+            # 标题行（按编号识别，四级优先）-> 对应层级的列
+            current_level = line.outline_level
+            excel_data.append((line.stripped, current_level))
         else:
             # 普通内容 -> 当前标题的下一列，至少在第2列
             content_level = max(current_level + 1, 2) if current_level > 0 else 1
-            excel_data.append((line, content_level))
+            excel_data.append((line.stripped, content_level))
     
     return excel_data
 
@@ -1134,6 +1384,318 @@ def extract_text_from_file(uploaded_file) -> str:
         return "[不支持的文件类型]"
 
 
+# 文档展示用的一级标题：标题文字中不含冒号（避免匹配"1. 说明：xxx"形式的列表）
+PRD_DISPLAY_LEVEL1_PATTERN = re.compile(r'^(\d+)[、\.．]\s*([^：:]+)$')
+
+
+def get_display_chapter_number(line: str) -> Optional[int]:
+    """
+    按 format_prd_content 的规则判断一行是否为一级标题（忽略 ** 和 # 标记）
+    
+    Returns:
+        int: 章节编号；不是一级标题时返回None
+    """
+    clean_line = re.sub(r'\*\*', '', line.strip()).lstrip('#').strip()
+    if PRD_LEVEL2_PATTERN.match(clean_line):
+        return None
+    match = PRD_DISPLAY_LEVEL1_PATTERN.match(clean_line)
+    return int(match.group(1)) if match else None
+
+
+# ============================================
+# 策划案语法树
+# ============================================
+
+# 语法树缓存的条目数（按内容哈希复用，页面重跑时同一份策划案只解析一次）
+PRD_PARSE_CACHE_ENTRIES = 64
+
+# 展示层级对应的 Markdown 标题前缀和编号后的分隔符
+PRD_DISPLAY_HEADINGS = {1: ("##", "、"), 2: ("###", " "), 3: ("####", " ")}
+
+# HTML 渲染：加粗片段和有序列表项（format_prd_content 输出的 "1. xxx"）
+PRD_BOLD_PATTERN = re.compile(r'\*\*(.+?)\*\*')
+PRD_ORDERED_ITEM_PATTERN = re.compile(r'^(\d+)\. (.+)$')
+
+
+class PrdLine:
+    """
+    策划案语法树的节点（一行）
+    
+    kind 取值：
+    - blank：空行
+    - bullet：以 - 或 * 开头的列表项
+    - ordered：流程、步骤等上下文中的编号列表项（number、title 为编号和内容）
+    - heading：标题（level 为展示层级 1-3，对应 ##/###/####；number、title 为编号和标题文字）
+    - text：普通内容
+    
+    outline_level 为只按编号识别的标题级别 1-4（Excel 导出使用，不考虑上下文），非标题为0；
+    chapter 为 get_display_chapter_number 的结果（章节切分使用）。
+    """
+    
+    __slots__ = ("raw", "stripped", "kind", "level", "number", "title", "outline_level", "chapter")
+    
+    def __init__(self, raw: str, stripped: str, kind: str, level: int = 0, number: str = "", title: str = "",
+                 outline_level: int = 0, chapter: Optional[int] = None):
+        self.raw = raw
+        self.stripped = stripped
+        self.kind = kind
+        self.level = level
+        self.number = number
+        self.title = title
+        self.outline_level = outline_level
+        self.chapter = chapter
+    
+    def markdown(self) -> str:
+        """format_prd_content 中这一行的输出"""
+        if self.kind == "heading":
+            mark, separator = PRD_DISPLAY_HEADINGS[self.level]
+            return f"\n{mark} {self.number}{separator}{self.title}\n"
+        if self.kind == "ordered":
+            return f"{self.number}. {self.title}"
+        return self.raw
+    
+    def bold_spans(self) -> list:
+        """
+        行内加粗片段
+        
+        Returns:
+            list: [(文字, 是否加粗)]，按原文顺序
+        """
+        spans = []
+        pos = 0
+        for match in PRD_BOLD_PATTERN.finditer(self.raw):
+            if match.start() > pos:
+                spans.append((self.raw[pos:match.start()], False))
+            spans.append((match.group(1), True))
+            pos = match.end()
+        if pos < len(self.raw):
+            spans.append((self.raw[pos:], False))
+        return spans
+
+
+def _prd_line_html(text: str, spans: Optional[list] = None) -> tuple:
+    """
+    将 format_prd_content 输出的一行转换为 HTML（标题、加粗、列表项）
+    
+    Args:
+        text: Markdown 行
+        spans: 该行的加粗片段（PrdLine.bold_spans，为None时按需识别）
+    
+    Returns:
+        tuple: (HTML, 是否为列表项)
+    """
+    if spans is not None:
+        text = "".join(f"<strong>{part}</strong>" if bold else part for part, bold in spans)
+    elif "**" in text:
+        text = PRD_BOLD_PATTERN.sub(r'<strong>\1</strong>', text)
+    if text.startswith("## ") and len(text) > 3:
+        text = f"<h2>{text[3:]}</h2>"
+    elif text.startswith("### ") and len(text) > 4:
+        text = f"<h3>{text[4:]}</h3>"
+    elif text.startswith("#### ") and len(text) > 5:
+        text = f"<h4>{text[5:]}</h4>"
+    elif text.startswith("- ") and len(text) > 2:
+        return (f"<li>{text[2:]}</li>", True)
+    elif text[:1].isdigit():
+        match = PRD_ORDERED_ITEM_PATTERN.match(text)
+        if match:
+            return (f"<li>{match.group(2)}</li>", True)
+    # 原文中已经是 <li> 的行同样归入列表
+    return (text, text.startswith("<li>") and text.endswith("</li>"))
+
+
+class PrdDocument:
+    """
+    策划案语法树：一次遍历得到每行的类型、标题层级、编号和所属章节
+    
+    展示格式化（format_prd_content）、文档渲染（render_prd_document）、Excel 导出（parse_prd_to_excel_data）
+    和章节切分（split_prd_sections）共用同一棵树。只有以数字开头的行才会做正则匹配；
+    markdown / html 在首次使用时生成并保存在实例上，由 parse_prd() 按内容哈希缓存。
+    """
+    
+    def __init__(self, content: str):
+        self.content = content
+        self.lines = []
+        self._markdown = None
+        self._html = None
+        self._chapters = None
+        self._parse()
+    
+    def _parse(self):
+        in_list_context = False  # 是否位于列表上下文中（与 format_prd_content 的原有规则一致）
+        prev_stripped = ""
+        for index, raw in enumerate(self.content.split("\n")):
+            stripped = raw.strip()
+            clean = stripped.replace("**", "") if "**" in stripped else stripped
+            kind, level, number, title = "text", 0, "", ""
+            level2_match = level1_match = None
+            
+            # 按编号识别的标题级别（四级优先，不看上下文）
+            outline_level = 0
+            if stripped[:1].isdigit():
+                if PRD_LEVEL4_PATTERN.match(stripped):
+                    outline_level = 4
+                elif PRD_LEVEL3_PATTERN.match(stripped):
+                    outline_level = 3
+                elif PRD_LEVEL2_PATTERN.match(stripped):
+                    outline_level = 2
+                elif PRD_LEVEL1_PATTERN.match(stripped):
+                    outline_level = 1
+            
+            if not stripped:
+                kind = "blank"
+                in_list_context = False
+            elif stripped[0] in "-*":
+                kind = "bullet"
+                in_list_context = True
+            elif stripped[0].isdigit():
+                level3_match = PRD_LEVEL3_PATTERN.match(clean)
+                level2_match = PRD_LEVEL2_PATTERN.match(clean)
+                level1_match = PRD_DISPLAY_LEVEL1_PATTERN.match(clean)
+                # 前一行以冒号结尾或描述流程、步骤时，较长的编号行视为列表项
+                is_list_item = False
+                if index > 0 and (prev_stripped.endswith('：') or prev_stripped.endswith(':') or
+                                  '流程' in prev_stripped or '步骤' in prev_stripped or in_list_context):
+                    if level1_match and len(clean) > 20:
+                        is_list_item = True
+                        in_list_context = True
+                heading_match = level3_match or level2_match or (level1_match if not is_list_item else None)
+                if heading_match:
+                    kind = "heading"
+                    level = 3 if level3_match else 2 if level2_match else 1
+                    number, title = heading_match.group(1), heading_match.group(2).strip()
+                    in_list_context = False
+                elif is_list_item:
+                    kind = "ordered"
+                    number, title = PRD_LEVEL1_PATTERN.match(clean).groups()
+            
+            # 章节编号（忽略 ** 和 # 标记，规则同 get_display_chapter_number）
+            chapter = None
+            chapter_line = clean.lstrip('#').strip()
+            if chapter_line[:1].isdigit():
+                if not stripped[0].isdigit():
+                    # 以数字开头的行在上面已经匹配过（此时 chapter_line 与 clean 相同）
+                    level2_match = PRD_LEVEL2_PATTERN.match(chapter_line)
+                    level1_match = PRD_DISPLAY_LEVEL1_PATTERN.match(chapter_line)
+                if not level2_match and level1_match:
+                    chapter = int(level1_match.group(1))
+            
+            self.lines.append(PrdLine(raw, stripped, kind, level, number, title, outline_level, chapter))
+            prev_stripped = stripped
+    
+    @property
+    def markdown(self) -> str:
+        """展示用 Markdown（format_prd_content 的结果）"""
+        if self._markdown is None:
+            self._markdown = "\n".join(line.markdown() for line in self.lines)
+        return self._markdown
+    
+    @property
+    def html(self) -> str:
+        """文档正文 HTML（render_prd_document 的内容部分）"""
+        if self._html is None:
+            parts = []
+            in_ul = False
+            for line in self.lines:
+                if line.kind == "heading":
+                    rows = [("", None)] + [(line.markdown().strip(), None)] + [("", None)]
+                else:
+                    rows = [(line.markdown(), line.bold_spans() if line.kind in ("text", "bullet") and "**" in line.raw else None)]
+                for text, spans in rows:
+                    text, is_item = _prd_line_html(text, spans)
+                    if is_item:
+                        # 连续的列表项（中间只隔空白行）合并为一个 <ul>
+                        parts.append(text if in_ul else "<ul>" + text)
+                        in_ul = True
+                        continue
+                    stripped = text.strip()
+                    if in_ul:
+                        if not stripped:
+                            parts.append(text)
+                            continue
+                        # </ul> 紧贴在列表之后第一个非空白字符之前
+                        indent = len(text) - len(text.lstrip())
+                        parts.append(text[:indent] + "</ul>" + text[indent:])
+                        in_ul = False
+                        continue
+                    if stripped and not stripped.startswith('<') and not stripped.startswith('#'):
+                        text = f"<p>{stripped}</p>"
+                    parts.append(text)
+            if in_ul:
+                parts[-1] += "</ul>"
+            # 清理多余的空行
+            self._html = re.sub(r'\n{3,}', '\n\n', "\n".join(parts))
+        return self._html
+    
+    def chapters(self) -> list:
+        """
+        按一级标题（章节）划分的行范围
+        
+        只认连续递增且分隔符一致的章节号，避免正文中的编号列表被误判为章节；代码块内的行不参与判断。
+        
+        Returns:
+            list: [(章节编号, 起始行, 结束行)]，第一个章节标题之前的部分编号为0
+        """
+        if self._chapters is None:
+            chapters = [[0, 0, 0]]
+            separator = None
+            in_code = False
+            for index, line in enumerate(self.lines):
+                if line.stripped.startswith("```"):
+                    in_code = not in_code
+                elif not in_code and line.chapter == chapters[-1][0] + 1:
+                    clean_line = line.stripped.replace("**", "").lstrip('#').strip()
+                    line_separator = clean_line[len(str(line.chapter))]
+                    if separator is None or line_separator == separator:
+                        separator = line_separator
+                        chapters.append([line.chapter, index, index])
+                chapters[-1][2] = index + 1
+            self._chapters = [tuple(chapter) for chapter in chapters]
+        return self._chapters
+
+
+class PrdParseCache:
+    """按内容哈希缓存的策划案语法树（有界LRU，进程内所有会话共享）"""
+    
+    def __init__(self, max_entries: int = PRD_PARSE_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # {内容哈希: PrdDocument}
+        self._lock = threading.Lock()
+    
+    def get(self, content: str) -> PrdDocument:
+        key = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        with self._lock:
+            document = self._entries.get(key)
+            if document is not None:
+                self._entries.move_to_end(key)
+                return document
+        document = PrdDocument(content)
+        with self._lock:
+            self._entries[key] = document
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return document
+
+
+@st.cache_resource(show_spinner=False)
+def get_prd_parse_cache() -> PrdParseCache:
+    """获取进程级策划案语法树缓存（所有会话共享）"""
+    return PrdParseCache()
+
+
+def parse_prd(content: str) -> PrdDocument:
+    """
+    解析策划案（按内容哈希缓存，页面重跑或多处使用同一份策划案时只解析一次）
+    
+    Args:
+        content: 策划案内容
+    
+    Returns:
+        PrdDocument: 策划案语法树
+    """
+    return get_prd_parse_cache().get(content)
+
+
 def format_prd_content(content: str) -> str:
     """
     格式化策划案内容，增强Markdown显示效果
@@ -1145,138 +1707,23 @@ def format_prd_content(content: str) -> str:
     Returns:
         str: 格式化后的Markdown内容
     """
-    import re
-    
-    # 处理内容，增强格式
-    lines = content.split('\n')
-    formatted_lines = []
-    
-    # 用于判断是否在列表上下文中
-    in_list_context = False
-    
-    for i, line in enumerate(lines):
-        stripped = line.strip()
-        
-        # 跳过空行
-        if not stripped:
-            formatted_lines.append(line)
-            in_list_context = False
-            continue
-        
-        # 清理标题中的 ** 符号
-        clean_line = re.sub(r'\*\*', '', stripped)
-        
-        # 匹配三级标题：1.1.1、xxx 或 1.1.1 xxx（优先匹配更长的模式）
-        level3_match = re.match(r'^(\d+\.\d+\.\d+)[、\.．]?\s*(.+)$', clean_line)
-        # 匹配二级标题：1.1、xxx 或 1.1 xxx
-        level2_match = re.match(r'^(\d+\.\d+)[、\.．]?\s*(.+)$', clean_line)
-        # 匹配一级标题：仅行首为单个数字 + 顿号/点号 + 标题文字（不含冒号结尾，避免匹配列表）
-        level1_match = re.match(r'^(\d+)[、\.．]\s*([^：:]+)$', clean_line)
-        
-        # 检查是否是列表项（在特定上下文中的数字开头行）
-        # 列表项特征：前面有 - 或 * 开头，或者在流程/步骤描述中
-        is_list_item = False
-        
-        # 检查前一行是否暗示这是列表
-        if i > 0:
-            prev_line = lines[i-1].strip() if i > 0 else ""
-            # 如果前一行以冒号结尾，或包含"流程"、"步骤"等词，后续的数字行可能是列表
-            if prev_line.endswith('：') or prev_line.endswith(':') or \
-               '流程' in prev_line or '步骤' in prev_line or in_list_context:
-                # 检查当前行是否看起来像列表项（较长的描述性文字）
-                if level1_match and len(clean_line) > 20:
-                    is_list_item = True
-                    in_list_context = True
-        
-        # 检查是否是以 - 或 * 开头的列表项
-        if stripped.startswith('-') or stripped.startswith('*'):
-            # 保持原样，只清理多余的 **
-            formatted_lines.append(re.sub(r'\*\*([^*]+)\*\*', r'**\1**', line))
-            in_list_context = True
-            continue
-        
-        if level3_match:
-            num, title = level3_match.groups()
-            title = title.strip()
-            formatted_lines.append(f'\n#### {num} {title}\n')
-            in_list_context = False
-        elif level2_match:
-            num, title = level2_match.groups()
-            title = title.strip()
-            formatted_lines.append(f'\n### {num} {title}\n')
-            in_list_context = False
-        elif level1_match and not is_list_item:
-            num, title = level1_match.groups()
-            title = title.strip()
-            # 一级标题使用特殊样式
-            formatted_lines.append(f'\n## {num}、{title}\n')
-            in_list_context = False
-        else:
-            # 对于普通行，保持原样但清理格式
-            # 处理列表项格式，确保 **xxx** 格式正确
-            processed_line = line
-            # 如果是数字开头的列表项，转换为有序列表格式
-            list_item_match = re.match(r'^(\d+)[、\.．]\s*(.+)$', clean_line)
-            if list_item_match and is_list_item:
-                num, text = list_item_match.groups()
-                processed_line = f'{num}. {text}'
-            formatted_lines.append(processed_line)
-    
-    return '\n'.join(formatted_lines)
+    return parse_prd(content).markdown
 
 
-def render_prd_document(content: str, title: str = "策划案"):
+def render_prd_document(content: str, title: str = "策划案", container=None):
     """
     以美观的文档格式渲染策划案内容
     
     Args:
         content: 策划案内容
         title: 文档标题
+        container: 渲染目标容器（如 st.empty() 或后台任务画布的占位，默认直接输出到页面）
     """
-    import re
-    
-    # 格式化内容
-    formatted_content = format_prd_content(content)
-    
-    # 将Markdown转换为HTML以便在自定义容器中正确显示
-    # 处理标题
-    html_content = formatted_content
-    
-    # 转换 ## 标题为 h2
-    html_content = re.sub(r'^## (.+)$', r'<h2>\1</h2>', html_content, flags=re.MULTILINE)
-    # 转换 ### 标题为 h3
-    html_content = re.sub(r'^### (.+)$', r'<h3>\1</h3>', html_content, flags=re.MULTILINE)
-    # 转换 #### 标题为 h4
-    html_content = re.sub(r'^#### (.+)$', r'<h4>\1</h4>', html_content, flags=re.MULTILINE)
-    
-    # 转换加粗文本
-    html_content = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', html_content)
-    
-    # 转换列表项 (- 开头)
-    html_content = re.sub(r'^- (.+)$', r'<li>\1</li>', html_content, flags=re.MULTILINE)
-    
-    # 转换有序列表项 (1. 开头)
-    html_content = re.sub(r'^(\d+)\. (.+)$', r'<li>\2</li>', html_content, flags=re.MULTILINE)
-    
-    # 将连续的 <li> 包裹在 <ul> 中
-    html_content = re.sub(r'((?:<li>.*?</li>\s*)+)', r'<ul>\1</ul>', html_content, flags=re.DOTALL)
-    
-    # 转换段落（非空行且不是HTML标签开头的行）
-    lines = html_content.split('\n')
-    processed_lines = []
-    for line in lines:
-        stripped = line.strip()
-        if stripped and not stripped.startswith('<') and not stripped.startswith('#'):
-            processed_lines.append(f'<p>{stripped}</p>')
-        else:
-            processed_lines.append(line)
-    html_content = '\n'.join(processed_lines)
-    
-    # 清理多余的空行
-    html_content = re.sub(r'\n{3,}', '\n\n', html_content)
+    # 标题、加粗、列表、段落的转换由语法树一次完成（按内容哈希缓存）
+    html_content = parse_prd(content).html
     
     # 使用Streamlit渲染整个文档（包括标题和内容）在同一个容器中
-    st.markdown(f"""
+    (container or st).markdown(f"""
     <div class="prd-document">
         <div style="text-align: center; margin-bottom: 25px;">
             <h1 style="color: #1a73e8; border-bottom: 2px solid #1a73e8; padding-bottom: 10px; display: inline-block; margin: 0;">
@@ -1301,20 +1748,382 @@ def is_file_upload_supported() -> bool:
     return False
 
 
+# ============================================
+# Gemini 客户端连接池
+# ============================================
+
+# 客户端空闲超过该时长（秒）后被回收
+CLIENT_IDLE_TTL_SECONDS = 600
+
+# HTTP 连接池配置：延长 keep-alive，使后续调用复用已建立的 TLS 连接
+CLIENT_HTTP_LIMITS = {
+    "max_connections": 20,
+    "max_keepalive_connections": 10,
+    "keepalive_expiry": 120,
+}
+
+
+class GeminiClientRegistry:
+    """
+    进程级 Gemini 客户端注册表
+    
+    按 (API Key, HTTP选项) 复用 genai.Client，所有会话共享同一个 HTTP 连接池，
+    避免每次调用都重新建立连接和 TLS 握手；长时间未使用的客户端会被回收。
+    流式请求、后台任务等长时间持有客户端的调用方通过 acquire/release（或 lease）登记使用，
+    仍被持有的客户端不会被回收。
+    """
+    
+    def __init__(self, idle_ttl: float = CLIENT_IDLE_TTL_SECONDS):
+        self.idle_ttl = idle_ttl
+        self._clients = {}  # {registry_key: {"client": genai.Client, "last_used": float, "leases": int}}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _make_key(api_key: str, http_options: Optional[dict]) -> tuple:
+        """生成注册表键（不直接保存明文 API Key）"""
+        key_fingerprint = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+        options_key = json.dumps(http_options or {}, sort_keys=True, default=str)
+        return (key_fingerprint, options_key)
+    
+    @staticmethod
+    def _create_client(api_key: str, http_options: Optional[dict]) -> genai.Client:
+        """创建启用长连接池的客户端"""
+        limits = httpx.Limits(**CLIENT_HTTP_LIMITS)
+        options = dict(http_options or {})
+        options.setdefault("client_args", {"limits": limits})
+        # 安装了 aiohttp 时 SDK 的异步客户端不走 httpx，不能传入 httpx 参数
+        if importlib.util.find_spec("aiohttp") is None:
+            options.setdefault("async_client_args", {"limits": limits})
+        return genai.Client(api_key=api_key, http_options=types.HttpOptions(**options))
+    
+    @staticmethod
+    def _close_client(client: genai.Client):
+        """关闭客户端持有的连接"""
+        try:
+            client.close()
+        except Exception as e:
+            print(f"关闭Gemini客户端失败: {e}")
+    
+    def get(self, api_key: str, http_options: Optional[dict] = None) -> genai.Client:
+        """
+        获取（或创建）指定 API Key 对应的共享客户端
+        
+        Args:
+            api_key: Gemini API Key
+            http_options: 传给 types.HttpOptions 的额外参数（可选）
+        
+        Returns:
+            genai.Client: 共享的客户端实例
+        """
+        with self._lock:
+            return self._get_entry_locked(api_key, http_options)["client"]
+    
+    def acquire(self, api_key: str, http_options: Optional[dict] = None) -> genai.Client:
+        """
+        获取共享客户端并登记占用，使用完毕后必须调用 release（占用期间不会被回收）
+        
+        Args:
+            api_key: Gemini API Key
+            http_options: 传给 types.HttpOptions 的额外参数（可选）
+        
+        Returns:
+            genai.Client: 共享的客户端实例
+        """
+        with self._lock:
+            entry = self._get_entry_locked(api_key, http_options)
+            entry["leases"] += 1
+            return entry["client"]
+    
+    def release(self, api_key: str, http_options: Optional[dict] = None):
+        """释放 acquire 登记的占用，并从释放时刻重新计算空闲时长"""
+        registry_key = self._make_key(api_key, http_options)
+        with self._lock:
+            entry = self._clients.get(registry_key)
+            if entry is not None and entry["leases"] > 0:
+                entry["leases"] -= 1
+                entry["last_used"] = time.monotonic()
+    
+    @contextlib.contextmanager
+    def lease(self, api_key: str, http_options: Optional[dict] = None) -> Generator[genai.Client, None, None]:
+        """在 with 代码块内占用共享客户端（退出时自动释放）"""
+        client = self.acquire(api_key, http_options)
+        try:
+            yield client
+        finally:
+            self.release(api_key, http_options)
+    
+    def _get_entry_locked(self, api_key: str, http_options: Optional[dict]) -> dict:
+        """查找（或创建）客户端条目并刷新使用时间（调用方需持有锁）"""
+        registry_key = self._make_key(api_key, http_options)
+        now = time.monotonic()
+        self._evict_idle_locked(now)
+        entry = self._clients.get(registry_key)
+        if entry is None:
+            entry = {"client": self._create_client(api_key, http_options), "last_used": now, "leases": 0}
+            self._clients[registry_key] = entry
+        entry["last_used"] = now
+        return entry
+    
+    def _evict_idle_locked(self, now: float):
+        """回收空闲超时且没有被占用的客户端（调用方需持有锁）"""
+        expired = [
+            k for k, v in self._clients.items()
+            if v["leases"] == 0 and now - v["last_used"] > self.idle_ttl
+        ]
+        for registry_key in expired:
+            self._close_client(self._clients.pop(registry_key)["client"])
+    
+    def evict_idle(self):
+        """回收空闲超时的客户端"""
+        with self._lock:
+            self._evict_idle_locked(time.monotonic())
+    
+    def close_all(self):
+        """关闭并清空所有客户端（进程退出时调用）"""
+        with self._lock:
+            entries = list(self._clients.values())
+            self._clients.clear()
+        for entry in entries:
+            self._close_client(entry["client"])
+    
+    def size(self) -> int:
+        """当前缓存的客户端数量"""
+        with self._lock:
+            return len(self._clients)
+
+
+@st.cache_resource(show_spinner=False)
+def get_client_registry() -> GeminiClientRegistry:
+    """获取进程级客户端注册表（所有会话共享，进程退出时关闭连接）"""
+    registry = GeminiClientRegistry()
+    atexit.register(registry.close_all)
+    return registry
+
+
 def get_gemini_client():
-    """获取Gemini客户端实例"""
-    api_key = st.session_state.get("api_key", "")
+    """获取Gemini客户端实例（从进程级连接池中复用）"""
+    job = get_current_job()
+    api_key = job.ctx["api_key"] if job is not None else st.session_state.get("api_key", "")
     if not api_key:
         st.error("⚠️ 请先在侧边栏配置 API Key")
         return None
     try:
-        client = genai.Client(api_key=api_key)
-        return client
+        return get_client_registry().get(api_key)
     except Exception as e:
         st.error(f"API初始化失败: {str(e)}")
         return None
 
 
+# ============================================
+# 响应缓存
+# ============================================
+
+# 磁盘缓存目录（SQLite）
+RESPONSE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "response_cache")
+RESPONSE_CACHE_DB_PATH = os.path.join(RESPONSE_CACHE_DIR, "responses.sqlite3")
+
+# 内存LRU最多保留的条目数
+RESPONSE_CACHE_MEMORY_ENTRIES = 256
+
+# 磁盘缓存有效期（秒）
+RESPONSE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+# 回放缓存结果时每个文本片段的长度
+RESPONSE_CACHE_REPLAY_CHUNK_SIZE = 80
+
+# 各功能是否允许使用响应缓存（多轮讨论类功能依赖对话上下文，默认不缓存）
+RESPONSE_CACHE_MODES = {
+    "生成策划案": True,
+    "脑图生成策划案": True,
+    "优化策划案": True,
+    "汇报助手": True,
+    "周报助手": True,
+    "白皮书助手": True,
+    "游戏策划(lina)": False,
+    "表格处理助手": False,
+    "思路引导助手 (linmo)": False,
+    "PUBGM WoW 玩法评审": False,
+}
+
+
+class ResponseCache:
+    """
+    内容寻址的模型响应缓存
+    
+    两级存储：进程内有界LRU（内存）+ SQLite持久化（磁盘，带TTL）。
+    键由 (模型, 系统提示词, 输入内容哈希, 生成配置) 计算得出。
+    """
+    
+    def __init__(self, db_path: str = RESPONSE_CACHE_DB_PATH,
+                 max_memory_entries: int = RESPONSE_CACHE_MEMORY_ENTRIES,
+                 ttl: float = RESPONSE_CACHE_TTL_SECONDS):
+        self.db_path = db_path
+        self.max_memory_entries = max_memory_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()  # {key: (response_text, created_at)}
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0}
+        self._init_db()
+    
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=5)
+    
+    def _init_db(self):
+        """创建缓存表并清理过期条目"""
+        try:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, model TEXT, response TEXT, created_at REAL)"
+                )
+                conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+        except sqlite3.Error as e:
+            print(f"初始化响应缓存失败: {e}")
+    
+    def _remember_locked(self, key: str, response: str, created_at: float):
+        """写入内存LRU（调用方需持有锁）"""
+        self._memory[key] = (response, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+    
+    def get(self, key: str) -> Optional[str]:
+        """
+        读取缓存
+        
+        Args:
+            key: 缓存键
+        
+        Returns:
+            缓存的响应文本，未命中或已过期返回None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[1] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return entry[0]
+        
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"读取响应缓存失败: {e}")
+            row = None
+        
+        with self._lock:
+            if row and now - row[1] <= self.ttl:
+                self._remember_locked(key, row[0], row[1])
+                self.stats["disk_hits"] += 1
+                return row[0]
+            self.stats["misses"] += 1
+        return None
+    
+    def put(self, key: str, response: str, model: str = ""):
+        """写入缓存（内存和磁盘）"""
+        if not response:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember_locked(key, response, now)
+            self.stats["writes"] += 1
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, model, response, created_at) VALUES (?, ?, ?, ?)",
+                    (key, model, response, now)
+                )
+        except sqlite3.Error as e:
+            print(f"写入响应缓存失败: {e}")
+    
+    def clear(self):
+        """清空内存和磁盘缓存"""
+        with self._lock:
+            self._memory.clear()
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM responses")
+        except sqlite3.Error as e:
+            print(f"清空响应缓存失败: {e}")
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> ResponseCache:
+    """获取进程级响应缓存（所有会话共享）"""
+    return ResponseCache()
+
+
+def _hash_contents(contents) -> str:
+    """计算请求内容（文本，或包含图片Part、File句柄的列表）的哈希"""
+    digest = hashlib.sha256()
+    items = contents if isinstance(contents, list) else [contents]
+    for item in items:
+        if isinstance(item, str):
+            digest.update(b"text:" + item.encode("utf-8"))
+        elif getattr(item, "inline_data", None) is not None:
+            digest.update(f"bytes:{item.inline_data.mime_type}:".encode("utf-8"))
+            digest.update(item.inline_data.data or b"")
+        elif isinstance(item, types.File):
+            digest.update(f"file:{item.uri}".encode("utf-8"))
+        else:
+            digest.update(b"other:" + repr(item).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def make_response_cache_key(model: str, system_prompt: str, contents, config) -> str:
+    """
+    生成响应缓存键
+    
+    Args:
+        model: 模型名称
+        system_prompt: 系统提示词
+        contents: 请求内容（字符串或Part列表）
+        config: types.GenerateContentConfig
+    
+    Returns:
+        str: 缓存键（SHA-256）
+    """
+    config_data = config.model_dump(mode="json", exclude_none=True) if config is not None else {}
+    payload = json.dumps({
+        "model": model,
+        "system_prompt": system_prompt or "",
+        "contents": _hash_contents(contents),
+        "config": config_data,
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_response_cache_enabled() -> bool:
+    """当前会话和功能是否启用响应缓存"""
+    if not st.session_state.get("response_cache_enabled", False):
+        return False
+    mode = st.session_state.get("selected_function", "")
+    return RESPONSE_CACHE_MODES.get(mode, False)
+
+
+def lookup_response_cache(cache_key: str, bypass: bool = False) -> Optional[str]:
+    """读取响应缓存（启用“绕过缓存”时不读取，但仍会写入新结果）"""
+    if bypass:
+        return None
+    return get_response_cache().get(cache_key)
+
+
+def replay_cached_response(response: str) -> Generator[dict, None, None]:
+    """
+    将缓存的完整响应按流式协议回放
+    
+    Yields:
+        dict: {"type": "text", "content": str}
+    """
+    for start in range(0, len(response), RESPONSE_CACHE_REPLAY_CHUNK_SIZE):
+        yield {"type": "text", "content": response[start:start + RESPONSE_CACHE_REPLAY_CHUNK_SIZE]}
+
+
 def get_selected_model():
     """获取当前选择的模型"""
     return st.session_state.get("selected_model", AVAILABLE_MODELS[0])
@@ -1326,7 +2135,7 @@ def fetch_available_models():
     if not api_key:
         return []
     try:
-        client = genai.Client(api_key=api_key)
+        client = get_client_registry().get(api_key)
         models = []
         for model in client.models.list():
             # 只获取支持generateContent的模型
@@ -1343,627 +2152,4607 @@ def fetch_available_models():
         return AVAILABLE_MODELS
 
 
-def call_gemini(prompt: str, system_prompt: str = "") -> Optional[str]:
+# ============================================
+# Reflection 检查点
+# ============================================
+
+# 检查点存储（SQLite），刷新页面或重启服务后仍可继续未完成的优化
+REFLECTION_CHECKPOINT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reflection_checkpoints")
+REFLECTION_CHECKPOINT_DB_PATH = os.path.join(REFLECTION_CHECKPOINT_DIR, "checkpoints.sqlite3")
+
+# 检查点保留时长（秒）
+REFLECTION_CHECKPOINT_TTL_SECONDS = 7 * 24 * 3600
+
+# URL 参数名：记录当前会话最近一次优化的检查点ID（会话ID在刷新后会变化，检查点ID随地址栏保留）
+CHECKPOINT_QUERY_PARAM = "ckpt"
+
+
+class ReflectionCheckpointStore:
     """
-    调用Gemini API（非流式，用于内部处理）
-    
-    Args:
-        prompt: 用户输入的提示词
-        system_prompt: 系统提示词
+    优化策划案的检查点存储
     
-    Returns:
-        API返回的文本内容，失败返回None
+    每次优化对应一条运行记录（原策划案、修改意见、迭代轮次等设置，以及初始修正结果）；
+    Reflection 每完成一轮立即写入该轮的开发人员问题和策划案版本，中断后从下一轮继续。
     """
-    try:
-        client = get_gemini_client()
-        if client is None:
-            return None
-        
-        # 构建配置
-        config = types.GenerateContentConfig(
-            system_instruction=system_prompt if system_prompt else None
+    
+    def __init__(self, db_path: str = REFLECTION_CHECKPOINT_DB_PATH, ttl: float = REFLECTION_CHECKPOINT_TTL_SECONDS):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._init_db()
+    
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=5)
+    
+    def _init_db(self):
+        """创建检查点表并清理过期记录"""
+        try:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS runs ("
+                    "run_id TEXT PRIMARY KEY, settings TEXT, initial_prd TEXT, status TEXT, error TEXT, "
+                    "created_at REAL, updated_at REAL)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS rounds ("
+                    "run_id TEXT, round_index INTEGER, questions TEXT, prd TEXT, created_at REAL, "
+                    "PRIMARY KEY (run_id, round_index))"
+                )
+                expired_before = time.time() - self.ttl
+                conn.execute(
+                    "DELETE FROM rounds WHERE run_id IN (SELECT run_id FROM runs WHERE updated_at < ?)",
+                    (expired_before,)
+                )
+                conn.execute("DELETE FROM runs WHERE updated_at < ?", (expired_before,))
+        except sqlite3.Error as e:
+            logger.warning("checkpoint store init failed: %s", e)
+    
+    def _execute(self, sql: str, params: tuple):
+        """执行写操作（失败只记录日志，不中断优化流程）"""
+        try:
+            with self._connect() as conn:
+                conn.execute(sql, params)
+        except sqlite3.Error as e:
+            logger.warning("checkpoint write failed: %s", e)
+    
+    def create_run(self, settings: dict) -> str:
+        """
+        创建运行记录
+        
+        Args:
+            settings: 优化设置（原策划案、修改意见、迭代轮次、模型等），继续优化时原样使用
+        
+        Returns:
+            str: 检查点ID
+        """
+        run_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute(
+            "INSERT INTO runs (run_id, settings, initial_prd, status, error, created_at, updated_at) "
+            "VALUES (?, ?, '', 'running', '', ?, ?)",
+            (run_id, json.dumps(settings, ensure_ascii=False), now, now)
         )
-        
-        response = client.models.generate_content(
-            model=get_selected_model(),
-            contents=prompt,
-            config=config
+        return run_id
+    
+    def save_initial(self, run_id: str, initial_prd: str):
+        """记录初始修正结果"""
+        self._execute("UPDATE runs SET initial_prd = ?, updated_at = ? WHERE run_id = ?",
+                      (initial_prd, time.time(), run_id))
+    
+    def save_round(self, run_id: str, round_index: int, questions: str, prd: str):
+        """记录一轮 Reflection 的开发人员问题和该轮结束后的策划案"""
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO rounds (run_id, round_index, questions, prd, created_at) VALUES (?, ?, ?, ?, ?)",
+            (run_id, round_index, questions, prd, now)
         )
-        return response.text
-    except Exception as e:
-        st.error(f"API调用失败: {str(e)}")
+        self._execute("UPDATE runs SET updated_at = ? WHERE run_id = ?", (now, run_id))
+    
+    def set_status(self, run_id: str, status: str, error: str = ""):
+        """
+        更新运行状态
+        
+        Args:
+            status: running, stopped, failed, done（done 之外的状态都可以继续优化）
+            error: 失败原因
+        """
+        self._execute("UPDATE runs SET status = ?, error = ?, updated_at = ? WHERE run_id = ?",
+                      (status, error, time.time(), run_id))
+    
+    def load(self, run_id: str) -> Optional[dict]:
+        """
+        读取运行记录及已完成的轮次
+        
+        Returns:
+            dict: {"run_id", "settings", "initial_prd", "status", "error", "updated_at",
+                   "rounds": [{"index", "questions", "prd"}]}，不存在或已过期时返回None
+        """
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT settings, initial_prd, status, error, updated_at FROM runs WHERE run_id = ?", (run_id,)
+                ).fetchone()
+                if row is None or time.time() - row[4] > self.ttl:
+                    return None
+                rounds = conn.execute(
+                    "SELECT round_index, questions, prd FROM rounds WHERE run_id = ? ORDER BY round_index", (run_id,)
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning("checkpoint read failed: %s", e)
+            return None
+        # 只取从第 1 轮开始连续完成的轮次
+        completed = []
+        for index, questions, prd in rounds:
+            if index != len(completed):
+                break
+            completed.append({"index": index, "questions": questions, "prd": prd})
+        return {
+            "run_id": run_id,
+            "settings": json.loads(row[0]),
+            "initial_prd": row[1],
+            "status": row[2],
+            "error": row[3],
+            "updated_at": row[4],
+            "rounds": completed,
+        }
+
+
+@st.cache_resource(show_spinner=False)
+def get_checkpoint_store() -> ReflectionCheckpointStore:
+    """获取进程级检查点存储（所有会话共享）"""
+    return ReflectionCheckpointStore()
+
+
+# ============================================
+# 重试调度与熔断
+# ============================================
+
+# 单次调用的最大尝试次数
+RETRY_MAX_ATTEMPTS = 3
+# 退避基准时长与上限（秒），实际等待时间在 [0, min(上限, 基准 * 2^n)] 内随机（full jitter）
+RETRY_BASE_DELAY = 4
+RETRY_MAX_DELAY = 30
+# 服务端要求等待超过该时长（秒）时不再重试，直接返回错误
+RETRY_MAX_SERVER_DELAY = 60
+
+# 可重试的 HTTP 状态码
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# 熔断：同一 API Key 的同一模型连续失败达到阈值后熔断，冷却期内的请求直接失败
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN_SECONDS = 60
+# 半开状态下探测请求的最长占用时间（秒）：超时未结束（如流未被关闭）视为失效，允许新的探测
+CIRCUIT_PROBE_TIMEOUT_SECONDS = 300
+
+
+class CircuitOpenError(Exception):
+    """熔断期间拒绝请求"""
+    
+    def __init__(self, retry_in: float):
+        self.retry_in = retry_in
+        super().__init__(f"服务连续失败，已暂停请求，约{int(retry_in) + 1}秒后恢复")
+
+
+def _api_key_fingerprint(api_key: str) -> str:
+    """API Key 指纹（用于统计和熔断，不保存明文）"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+def _parse_retry_delay(value) -> Optional[float]:
+    """解析 RetryInfo 的 retryDelay（如 "31s"）或 Retry-After 头（秒数或HTTP日期）"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(float(value.rstrip("s")), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(retry_at.timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
         return None
 
 
-def call_gemini_with_image(image_data: bytes, prompt: str, system_prompt: str = "", mime_type: str = "image/png") -> Optional[str]:
+class RetryScheduler:
+    """
+    进程级重试调度器
+    
+    - 按HTTP状态码判断错误是否可重试（网络超时、连接中断同样可重试）
+    - 优先使用服务端返回的重试提示（RetryInfo / Retry-After），否则指数退避 + full jitter，
+      避免多个会话同时重试
+    - 按 (API Key, 模型) 熔断：连续失败达到阈值后冷却期内直接失败，冷却结束后放行一个探测请求；
+      探测请求无论成功、失败还是被取消都需通过 release_probe 结束
+    - 等待在异步引擎中进行，不阻塞页面脚本线程
     """
-    调用Gemini API处理图片（非流式）
     
-    Args:
-        image_data: 图片的字节数据
-        prompt: 用户输入的提示词
-        system_prompt: 系统提示词
-        mime_type: 图片的MIME类型（image/png, image/jpeg, application/pdf）
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}  # {(key_fingerprint, model): {"failures": int, "opened_at": float, "probe_started": float|None}}
+        self.metrics = {
+            "attempts": 0,
+            "retries": 0,
+            "successes": 0,
+            "failures": 0,
+            "server_hints": 0,  # 使用了服务端重试提示的次数
+            "circuit_rejections": 0,
+            "backoff_seconds": 0.0,
+        }
     
-    Returns:
-        API返回的文本内容，失败返回None
-    """
-    try:
-        client = get_gemini_client()
-        if client is None:
+    @staticmethod
+    def classify_error(error: Exception) -> tuple:
+        """
+        判断错误类型
+        
+        Returns:
+            tuple: (是否可重试, HTTP状态码或None, 服务端建议的等待秒数或None)
+        """
+        if isinstance(error, errors.APIError):
+            retry_after = None
+            # 1. google.rpc.RetryInfo
+            error_body = error.details.get("error", error.details) if isinstance(error.details, dict) else {}
+            for detail in error_body.get("details", []) or []:
+                if isinstance(detail, dict) and str(detail.get("@type", "")).endswith("RetryInfo"):
+                    retry_after = _parse_retry_delay(detail.get("retryDelay"))
+            # 2. Retry-After 响应头
+            headers = getattr(error.response, "headers", None)
+            if retry_after is None and headers is not None:
+                retry_after = _parse_retry_delay(headers.get("retry-after"))
+            return (error.code in RETRYABLE_STATUS_CODES, error.code, retry_after)
+        # 网络层错误（超时、连接被重置等）
+        if isinstance(error, (httpx.TransportError, asyncio.TimeoutError, ConnectionError)):
+            return (True, None, None)
+        return (False, None, None)
+    
+    def compute_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """计算第 attempt 次失败后的等待时长（秒）"""
+        if retry_after is not None:
+            # 服务端提示的时长上叠加少量随机，避免同一时刻集中重试
+            return retry_after + random.uniform(0, 1)
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+    
+    @staticmethod
+    def _probe_active(breaker: dict, now: float) -> bool:
+        """是否有未失效的探测请求进行中"""
+        started = breaker["probe_started"]
+        return started is not None and now - started < CIRCUIT_PROBE_TIMEOUT_SECONDS
+    
+    def _rejection_locked(self, breaker: Optional[dict], now: float) -> Optional[float]:
+        """熔断拒绝请求时返回建议的等待秒数，否则返回None（调用方需持有锁）"""
+        if breaker is None or breaker["failures"] < CIRCUIT_FAILURE_THRESHOLD:
             return None
-        
-        # 构建配置
-        config = types.GenerateContentConfig(
-            system_instruction=system_prompt if system_prompt else None
+        retry_in = breaker["opened_at"] + CIRCUIT_COOLDOWN_SECONDS - now
+        if retry_in <= 0 and not self._probe_active(breaker, now):
+            return None
+        return max(retry_in, 1.0)
+    
+    def check(self, api_key: str, model: str) -> bool:
+        """
+        发起请求前检查熔断状态
+        
+        Returns:
+            bool: 本次请求是否为半开状态下的探测请求（是则请求结束后必须调用 release_probe）
+        
+        Raises:
+            CircuitOpenError: 熔断冷却期内，或冷却结束后已有探测请求进行中
+        """
+        key = (_api_key_fingerprint(api_key), model)
+        now = time.monotonic()
+        with self._lock:
+            self.metrics["attempts"] += 1
+            breaker = self._breakers.get(key)
+            retry_in = self._rejection_locked(breaker, now)
+            if retry_in is not None:
+                self.metrics["circuit_rejections"] += 1
+                raise CircuitOpenError(retry_in)
+            if breaker is None or breaker["failures"] < CIRCUIT_FAILURE_THRESHOLD:
+                return False
+            # 半开状态：放行一个探测请求
+            breaker["probe_started"] = now
+            return True
+    
+    def release_probe(self, api_key: str, model: str):
+        """探测请求结束（成功、失败或被取消）：允许下一次探测，熔断状态由 record_success/record_failure 决定"""
+        with self._lock:
+            breaker = self._breakers.get((_api_key_fingerprint(api_key), model))
+            if breaker is not None:
+                breaker["probe_started"] = None
+    
+    def is_open(self, api_key: str, model: str) -> bool:
+        """API Key 的指定模型当前是否会被熔断拒绝（冷却期内，或冷却结束后已有探测请求进行中）"""
+        with self._lock:
+            breaker = self._breakers.get((_api_key_fingerprint(api_key), model))
+            return self._rejection_locked(breaker, time.monotonic()) is not None
+    
+    def record_success(self, api_key: str, model: str):
+        """请求成功：关闭熔断"""
+        with self._lock:
+            self.metrics["successes"] += 1
+            self._breakers.pop((_api_key_fingerprint(api_key), model), None)
+    
+    def record_failure(self, api_key: str, model: str, error: Exception, attempt: int) -> Optional[float]:
+        """
+        请求失败：更新熔断状态，并决定是否重试
+        
+        Args:
+            api_key: 本次请求使用的 API Key
+            model: 本次请求使用的模型
+            error: 捕获的异常
+            attempt: 已完成的尝试序号（从0开始）
+        
+        Returns:
+            float: 需要等待的秒数；不应重试时返回None
+        """
+        retryable, status_code, retry_after = self.classify_error(error)
+        key = (_api_key_fingerprint(api_key), model)
+        
+        # 429：该 Key 移出 Key 池轮换；还有其他可用 Key 时无需等待，换 Key 立即重试
+        switch_key = False
+        if status_code == 429:
+            key_pool = get_api_key_pool()
+            key_pool.report_throttle(api_key, retry_after)
+            switch_key = api_key in key_pool and key_pool.has_available_key(exclude=api_key, model=model)
+        
+        with self._lock:
+            self.metrics["failures"] += 1
+            if retryable:
+                # 只有服务端/网络类错误计入熔断，参数错误等客户端错误不影响其他请求
+                breaker = self._breakers.setdefault(key, {"failures": 0, "opened_at": 0.0, "probe_started": None})
+                breaker["failures"] += 1
+                if breaker["failures"] >= CIRCUIT_FAILURE_THRESHOLD:
+                    breaker["opened_at"] = time.monotonic()
+            
+            if not retryable or attempt >= RETRY_MAX_ATTEMPTS - 1:
+                return None
+            if switch_key:
+                retry_after = None
+                delay = random.uniform(0, 1)
+            elif retry_after is not None and retry_after > RETRY_MAX_SERVER_DELAY:
+                return None
+            else:
+                delay = self.compute_delay(attempt, retry_after)
+            self.metrics["retries"] += 1
+            self.metrics["backoff_seconds"] += delay
+            if retry_after is not None:
+                self.metrics["server_hints"] += 1
+            return delay
+    
+    async def run(self, request_factory, api_key_provider, model: str):
+        """
+        执行非流式请求，失败时按调度策略重试
+        
+        Args:
+            request_factory: 接收 API Key 的函数，每次调用返回一个新的协程
+            api_key_provider: 每次尝试前调用，返回本次使用的 API Key（Key 池可借此换 Key 重试）
+            model: 本次请求使用的模型（熔断按 Key + 模型统计）
+        
+        Returns:
+            协程的返回值（重试用尽或不可重试时抛出最后一次的异常）
+        """
+        attempt = 0
+        while True:
+            api_key = api_key_provider()
+            probe = self.check(api_key, model)
+            try:
+                result = await request_factory(api_key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                delay = self.record_failure(api_key, model, e, attempt)
+                if delay is None:
+                    raise
+            else:
+                self.record_success(api_key, model)
+                return result
+            finally:
+                if probe:
+                    self.release_probe(api_key, model)
+            await asyncio.sleep(delay)
+            attempt += 1
+    
+    def snapshot(self) -> dict:
+        """获取统计数据快照（含当前处于熔断的 Key 数量）"""
+        with self._lock:
+            data = dict(self.metrics)
+            data["open_circuits"] = sum(
+                1 for b in self._breakers.values() if b["failures"] >= CIRCUIT_FAILURE_THRESHOLD
+            )
+        return data
+
+
+@st.cache_resource(show_spinner=False)
+def get_retry_scheduler() -> RetryScheduler:
+    """获取进程级重试调度器（所有会话共享）"""
+    return RetryScheduler()
+
+
+def describe_error(error: Exception) -> str:
+    """生成简短的错误描述（用于重试提示）"""
+    if isinstance(error, errors.APIError):
+        return f"{error.code} {error.status or ''}".strip()
+    return str(error)[:50]
+
+
+# ============================================
+# 请求限流与排队
+# ============================================
+
+# 默认限额（每个 API Key + 模型）：每分钟请求数、每分钟token数
+# 可在 secrets 中配置 RATE_LIMITS 覆盖，键为模型名（或 "default"）
+DEFAULT_RATE_LIMIT = {"rpm": 60, "tpm": 1000000}
+
+# 预估token时为模型输出预留的额度，请求完成后按实际用量结算
+RATE_LIMIT_OUTPUT_RESERVE = 4000
+
+# 排队时刷新位置的间隔（秒）
+RATE_LIMIT_POLL_SECONDS = 0.5
+
+
+def estimate_request_tokens(contents) -> int:
+    """
+    粗略估算请求的token数（用于限流预占额度）
+    
+    中文约1字1token，英文约4字符1token，这里统一按字符数估算以偏保守；图片按固定额度计算
+    """
+    if isinstance(contents, str):
+        return len(contents)
+    total = 0
+    for item in contents:
+        if isinstance(item, str):
+            total += len(item)
+        elif isinstance(item, types.Content):
+            total += estimate_request_tokens(list(item.parts or []))
+        elif getattr(item, "text", None):
+            total += len(item.text)
+        else:
+            total += 258  # 图片等二进制内容
+    return total
+
+
+class TokenBucket:
+    """令牌桶：容量为一分钟的限额，按秒匀速补充"""
+    
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.refill_rate = per_minute / 60.0
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+        self.updated = now
+    
+    def wait_time(self, amount: float) -> float:
+        """距离可以取出 amount 个令牌还需等待的秒数"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_rate
+    
+    def take(self, amount: float):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+    
+    def give_back(self, amount: float):
+        """归还（或在实际用量超出预估时补扣）令牌"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """
+    进程级限流器
+    
+    每个 (API Key, 模型) 一条通道，包含 RPM、TPM 两个令牌桶和一个 FIFO 排队队列；
+    所有会话的请求按到达顺序放行，额度不足时排队等待而不是直接触发 429。
+    admit / settle 在异步引擎的事件循环中调用，headroom / snapshot 还会在脚本线程和后台任务线程中
+    （ApiKeyPool 选择 Key、侧边栏统计）调用，令牌桶和排队状态统一由锁保护（持锁期间不 await）。
+    """
+    
+    def __init__(self, limits: Optional[dict] = None):
+        self.limits = limits or {}
+        self._lanes = {}  # {(key_fingerprint, model): {"rpm", "tpm", "queue"}}
+        self.metrics = {"admitted": 0, "queued": 0, "wait_seconds": 0.0}
+        self._lock = threading.Lock()
+    
+    def _limit_for(self, model: str) -> dict:
+        limit = dict(DEFAULT_RATE_LIMIT)
+        limit.update(self.limits.get("default", {}))
+        limit.update(self.limits.get(model, {}))
+        return limit
+    
+    def _lane(self, api_key: str, model: str) -> dict:
+        """获取通道（调用方需持有锁）"""
+        lane_key = (_api_key_fingerprint(api_key), model)
+        lane = self._lanes.get(lane_key)
+        if lane is None:
+            limit = self._limit_for(model)
+            lane = {
+                "rpm": TokenBucket(limit["rpm"]),
+                "tpm": TokenBucket(limit["tpm"]),
+                "queue": deque(),
+            }
+            self._lanes[lane_key] = lane
+        return lane
+    
+    async def admit(self, api_key: str, model: str, tokens: int) -> AsyncGenerator[int, None]:
+        """
+        申请一次请求的额度，按FIFO顺序放行
+        
+        Args:
+            api_key: 本次请求使用的 API Key
+            model: 模型名称
+            tokens: 预估token数（输入 + 输出预留）
+        
+        Yields:
+            int: 排队时前方等待的请求数（位置变化时产出）；获得额度后生成器结束
+        """
+        ticket = object()
+        with self._lock:
+            lane = self._lane(api_key, model)
+            lane["queue"].append(ticket)
+        started = time.monotonic()
+        last_position = None
+        try:
+            while True:
+                with self._lock:
+                    position = lane["queue"].index(ticket)
+                    admitted = False
+                    if position == 0:
+                        wait = max(lane["rpm"].wait_time(1), lane["tpm"].wait_time(tokens))
+                        if wait <= 0:
+                            lane["rpm"].take(1)
+                            lane["tpm"].take(tokens)
+                            admitted = True
+                    else:
+                        wait = RATE_LIMIT_POLL_SECONDS
+                    if not admitted and last_position is None:
+                        self.metrics["queued"] += 1
+                if admitted:
+                    break
+                if position != last_position:
+                    last_position = position
+                    yield position
+                await asyncio.sleep(min(wait, RATE_LIMIT_POLL_SECONDS))
+        finally:
+            with self._lock:
+                lane["queue"].remove(ticket)
+        with self._lock:
+            self.metrics["admitted"] += 1
+            self.metrics["wait_seconds"] += time.monotonic() - started
+    
+    def headroom(self, api_key: str, model: str) -> float:
+        """通道的剩余额度比例（0~1，排队中的请求越多越低），用于在多个 Key 之间选择"""
+        with self._lock:
+            lane = self._lane(api_key, model)
+            rpm, tpm = lane["rpm"], lane["tpm"]
+            rpm.wait_time(0)  # 触发补充
+            tpm.wait_time(0)
+            return min(rpm.tokens / rpm.capacity, tpm.tokens / tpm.capacity) - len(lane["queue"])
+    
+    def settle(self, api_key: str, model: str, reserved: int, actual: int):
+        """请求完成后按实际token用量结算预占的额度"""
+        if actual:
+            with self._lock:
+                self._lane(api_key, model)["tpm"].give_back(reserved - actual)
+    
+    def snapshot(self) -> dict:
+        """统计数据快照（含当前排队中的请求数）"""
+        with self._lock:
+            data = dict(self.metrics)
+            data["waiting"] = sum(max(len(lane["queue"]) - 1, 0) for lane in self._lanes.values())
+        return data
+
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter() -> RateLimiter:
+    """获取进程级限流器（所有会话共享），限额可通过 secrets 中的 RATE_LIMITS 配置"""
+    limits = {}
+    try:
+        if "RATE_LIMITS" in st.secrets:
+            limits = {name: dict(value) for name, value in st.secrets["RATE_LIMITS"].items()}
+    except Exception:
+        # 本地运行时可能没有 secrets 文件
+        pass
+    return RateLimiter(limits)
+
+
+def estimate_reserved_tokens(contents) -> int:
+    """限流预占的token数：输入估算 + 输出预留"""
+    return estimate_request_tokens(contents) + RATE_LIMIT_OUTPUT_RESERVE
+
+
+async def wait_for_admission(api_key: str, model: str, reserved: int) -> AsyncGenerator[dict, None]:
+    """
+    等待限流放行，排队期间产出 queue 类型的 chunk
+    
+    Args:
+        api_key: 本次请求使用的 API Key
+        model: 模型名称
+        reserved: 预占的token数（estimate_reserved_tokens 的结果）
+    
+    Yields:
+        dict: {"type": "queue", "content": str}
+    """
+    async for position in get_rate_limiter().admit(api_key, model, reserved):
+        if position > 0:
+            message = f"⏳ 请求排队中，前方还有 {position} 个请求..."
+        else:
+            message = "⏳ 已到达队首，等待限额恢复..."
+        yield {"type": "queue", "content": message}
+
+
+def get_usage_tokens(usage_metadata) -> int:
+    """从 usage_metadata 读取总token数（无数据时返回0）"""
+    if usage_metadata is None:
+        return 0
+    return usage_metadata.total_token_count or 0
+
+
+def estimate_consumed_tokens(contents, output_chars: int) -> int:
+    """请求中途被取消且未收到用量统计时，按输入估算 + 已收到的输出字符数估算消耗"""
+    return estimate_request_tokens(contents) + output_chars
+
+
+def record_call_usage(ctx: dict, used_tokens: int):
+    """将一次调用的token用量计入调用方的取消令牌（中止时据此报告已消耗的用量）"""
+    token = ctx.get("cancel_token")
+    if token is not None:
+        token.add_usage(used_tokens)
+
+
+def apply_model_used(ctx: dict):
+    """
+    将非流式调用实际产出结果的模型（可能是降级链上的备用模型）记录到运行状态
+    
+    后台事件循环无法访问会话状态，_generate_async 只把模型写入 ctx；
+    调用方在脚本线程或任务线程中、调用结束后调用本函数。
+    """
+    model = ctx.pop("model_used", None)
+    if model:
+        get_run_state().last_model_used = model
+
+
+def format_consumed_tokens(token) -> str:
+    """中止提示中的用量说明（无取消令牌或无用量时为空）"""
+    if token is None or not token.consumed_tokens:
+        return ""
+    return f"（已消耗约 {token.consumed_tokens:,} tokens）"
+
+
+# ============================================
+# API Key 池
+# ============================================
+
+# Key 被限流（429）后移出轮换的最短冷却时长（秒）
+API_KEY_COOLDOWN_SECONDS = 60
+
+
+class ApiKeyPool:
+    """
+    多 API Key 负载均衡
+    
+    从 secrets 的 GOOGLE_API_KEYS 读取多个 Key，每次请求选择：
+    不在冷却期且未熔断 → 限流额度剩余最多 → 最久未被限流 的 Key；
+    某个 Key 返回 429 后在冷却期内不再分配请求。
+    """
+    
+    def __init__(self, api_keys: list):
+        self.api_keys = list(dict.fromkeys(k for k in api_keys if k))  # 去重并保持顺序
+        self._lock = threading.Lock()
+        self._stats = {
+            api_key: {"requests": 0, "tokens": 0, "throttles": 0, "cooldown_until": 0.0, "last_throttled": 0.0}
+            for api_key in self.api_keys
+        }
+    
+    def __contains__(self, api_key: str) -> bool:
+        return api_key in self._stats
+    
+    def _is_available_locked(self, api_key: str, now: float, model: str) -> bool:
+        return self._stats[api_key]["cooldown_until"] <= now and not get_retry_scheduler().is_open(api_key, model)
+    
+    def acquire(self, model: str) -> str:
+        """
+        为一次请求选择 API Key
+        
+        Args:
+            model: 模型名称（用于比较各 Key 的限流余量）
+        
+        Returns:
+            str: 选中的 API Key（全部不可用时返回最早结束冷却的 Key）
+        """
+        limiter = get_rate_limiter()
+        now = time.monotonic()
+        with self._lock:
+            candidates = [k for k in self.api_keys if self._is_available_locked(k, now, model)]
+            if candidates:
+                api_key = max(
+                    candidates,
+                    key=lambda k: (limiter.headroom(k, model), -self._stats[k]["last_throttled"])
+                )
+            else:
+                api_key = min(self.api_keys, key=lambda k: self._stats[k]["cooldown_until"])
+            self._stats[api_key]["requests"] += 1
+            return api_key
+    
+    def has_available_key(self, exclude: str, model: str) -> bool:
+        """除 exclude 外是否还有可用于该模型的 Key"""
+        now = time.monotonic()
+        with self._lock:
+            return any(k != exclude and self._is_available_locked(k, now, model) for k in self.api_keys)
+    
+    def report_throttle(self, api_key: str, retry_after: Optional[float] = None):
+        """记录 Key 被限流，移出轮换一段时间"""
+        if api_key not in self:
+            return
+        now = time.monotonic()
+        with self._lock:
+            stats = self._stats[api_key]
+            stats["throttles"] += 1
+            stats["last_throttled"] = now
+            stats["cooldown_until"] = now + max(retry_after or 0, API_KEY_COOLDOWN_SECONDS)
+    
+    def record_usage(self, api_key: str, tokens: int):
+        """累计 Key 的token用量"""
+        if api_key not in self:
+            return
+        with self._lock:
+            self._stats[api_key]["tokens"] += tokens
+    
+    def usage_report(self) -> list:
+        """
+        各 Key 的使用情况（Key 只显示末4位）
+        
+        Returns:
+            list: [{"key", "requests", "tokens", "throttles", "status"}, ...]
+        """
+        now = time.monotonic()
+        report = []
+        with self._lock:
+            for api_key in self.api_keys:
+                stats = self._stats[api_key]
+                if stats["cooldown_until"] > now:
+                    status = f"冷却中（{int(stats['cooldown_until'] - now) + 1}秒）"
+                elif get_retry_scheduler().is_open(api_key, get_selected_model()):
+                    status = "熔断中"
+                else:
+                    status = "可用"
+                report.append({
+                    "key": f"…{api_key[-4:]}",
+                    "requests": stats["requests"],
+                    "tokens": stats["tokens"],
+                    "throttles": stats["throttles"],
+                    "status": status,
+                })
+        return report
+
+
+def load_secrets_api_keys() -> list:
+    """从 secrets 读取 API Key 列表（GOOGLE_API_KEYS 优先，其次单个 GOOGLE_API_KEY / GEMINI_API_KEY）"""
+    try:
+        if "GOOGLE_API_KEYS" in st.secrets:
+            return [k for k in st.secrets["GOOGLE_API_KEYS"] if k]
+        if "GOOGLE_API_KEY" in st.secrets:
+            return [st.secrets["GOOGLE_API_KEY"]]
+        if "GEMINI_API_KEY" in st.secrets:
+            return [st.secrets["GEMINI_API_KEY"]]
+    except Exception:
+        # 本地运行时可能没有 secrets 文件
+        pass
+    return []
+
+
+@st.cache_resource(show_spinner=False)
+def get_api_key_pool() -> ApiKeyPool:
+    """获取进程级 API Key 池（所有会话共享）"""
+    return ApiKeyPool(load_secrets_api_keys())
+
+
+def select_api_key(ctx: dict, model: Optional[str] = None) -> str:
+    """
+    为一次请求选择 API Key：会话使用 secrets 中配置的 Key 时由 Key 池分配，
+    用户在侧边栏填写了自己的 Key 时直接使用该 Key
+    
+    Args:
+        ctx: get_call_context() 返回的调用参数
+        model: 本次请求实际使用的模型（默认为 ctx 中选择的模型）
+    """
+    if ctx.get("use_key_pool"):
+        return get_api_key_pool().acquire(model or ctx["model"])
+    return ctx["api_key"]
+
+
+# ============================================
+# 模型降级
+# ============================================
+
+# 各功能的模型降级链：当前模型重试用尽或熔断时，依次改用链上排在它之后的模型
+# 当前模型不在链上时使用整条链；可在 secrets 中通过 MODEL_FALLBACK_CHAINS 按功能覆盖
+DEFAULT_MODEL_FALLBACK_CHAIN = [
+    "gemini-2.5-pro-preview-06-05",
+    "gemini-2.5-flash-preview-05-20",
+    "gemini-2.0-flash",
+    "gemini-2.0-flash-lite",
+]
+MODEL_FALLBACK_CHAINS = {
+    "default": DEFAULT_MODEL_FALLBACK_CHAIN,
+}
+
+
+@st.cache_resource(show_spinner=False)
+def load_model_fallback_chains() -> dict:
+    """读取模型降级链配置（secrets 中的 MODEL_FALLBACK_CHAINS 覆盖默认配置）"""
+    chains = dict(MODEL_FALLBACK_CHAINS)
+    try:
+        if "MODEL_FALLBACK_CHAINS" in st.secrets:
+            chains.update({mode: list(chain) for mode, chain in st.secrets["MODEL_FALLBACK_CHAINS"].items()})
+    except Exception:
+        # 本地运行时可能没有 secrets 文件
+        pass
+    return chains
+
+
+def get_fallback_models(mode: str, model: str) -> list:
+    """
+    获取当前功能、当前模型的降级候选模型
+    
+    Args:
+        mode: 功能名称（与功能选择下拉框一致）
+        model: 当前选择的模型
+    
+    Returns:
+        list: 按顺序尝试的备用模型（不含当前模型）
+    """
+    chains = load_model_fallback_chains()
+    chain = chains.get(mode, chains["default"])
+    if model in chain:
+        return chain[chain.index(model) + 1:]
+    return [m for m in chain if m != model]
+
+
+def should_fallback(error: Exception) -> bool:
+    """错误是否属于服务端过载/不可用（可以改用其他模型），参数错误等不降级"""
+    if isinstance(error, CircuitOpenError):
+        return True
+    return RetryScheduler.classify_error(error)[0]
+
+
+# ============================================
+# 对冲请求
+# ============================================
+
+# 启用对冲请求的功能（输出较短、对首字延迟敏感）
+HEDGE_MODES = {"汇报助手", "白皮书助手"}
+
+# 首字延迟（TTFT）样本数不足时使用的默认对冲阈值（秒）
+HEDGE_DEFAULT_DELAY_SECONDS = 4.0
+# 计算分位数阈值所需的最少样本数，以及保留的最近样本数
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MAX_SAMPLES = 200
+
+
+class HedgeStats:
+    """
+    对冲请求统计
+    
+    按模型记录主请求最近的首字延迟样本，用于计算对冲阈值；对冲请求胜出时主请求的首字延迟未知，
+    以当时的耗时作为下限计入样本（不计入会只剩较快的请求，阈值逐渐偏低、对冲越来越频繁）。
+    胜出的对冲请求自身的首字延迟单独保存，不计入阈值样本。
+    同时记录对冲率和主/备请求胜出次数，便于调整分位数。
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ttft_samples = {}  # {model: deque[float]}，主请求的首字延迟
+        self._hedge_ttft_samples = {}  # {model: deque[float]}，胜出的对冲请求从发出到首字的延迟
+        self.metrics = {"requests": 0, "hedged": 0, "primary_wins": 0, "hedge_wins": 0}
+    
+    def threshold(self, model: str, percentile: int) -> float:
+        """
+        对冲阈值：主请求超过该时长仍未产出首字时发出对冲请求
+        
+        Args:
+            model: 主请求的模型
+            percentile: 分位数（如 90 表示 P90）
+        """
+        with self._lock:
+            samples = sorted(self._ttft_samples.get(model, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY_SECONDS
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+        return samples[index]
+    
+    def record(self, model: str, ttft: Optional[float], hedged: bool, hedge_won: bool,
+               hedge_model: str = "", hedge_ttft: Optional[float] = None):
+        """
+        记录一次请求的结果
+        
+        Args:
+            model: 主请求的模型
+            ttft: 主请求的首字延迟（对冲请求胜出时为当时的耗时，即首字延迟的下限；都未产出正文时为None）
+            hedged: 是否发出了对冲请求
+            hedge_won: 对冲请求是否胜出
+            hedge_model: 对冲请求的模型
+            hedge_ttft: 胜出的对冲请求从发出到首字的延迟
+        """
+        with self._lock:
+            self.metrics["requests"] += 1
+            if hedged:
+                self.metrics["hedged"] += 1
+                self.metrics["hedge_wins" if hedge_won else "primary_wins"] += 1
+            if ttft is not None:
+                self._ttft_samples.setdefault(model, deque(maxlen=HEDGE_MAX_SAMPLES)).append(ttft)
+            if hedge_ttft is not None:
+                self._hedge_ttft_samples.setdefault(hedge_model, deque(maxlen=HEDGE_MAX_SAMPLES)).append(hedge_ttft)
+    
+    def snapshot(self) -> dict:
+        """统计数据快照（含对冲率）"""
+        with self._lock:
+            data = dict(self.metrics)
+            hedge_samples = [ttft for samples in self._hedge_ttft_samples.values() for ttft in samples]
+        data["hedge_rate"] = data["hedged"] / data["requests"] if data["requests"] else 0.0
+        data["hedge_ttft"] = sum(hedge_samples) / len(hedge_samples) if hedge_samples else 0.0
+        return data
+
+
+@st.cache_resource(show_spinner=False)
+def get_hedge_stats() -> HedgeStats:
+    """获取进程级对冲统计（所有会话共享）"""
+    return HedgeStats()
+
+
+async def _pump_stream(source: str, async_gen: AsyncGenerator, output: asyncio.Queue):
+    """将异步流的 chunk 连同来源标记写入队列，结束时写入 (source, None)"""
+    try:
+        async for chunk in async_gen:
+            await output.put((source, chunk))
+    finally:
+        await async_gen.aclose()
+        output.put_nowait((source, None))
+
+
+async def _hedged_stream_async(contents, system_prompt: str, ctx: dict) -> AsyncGenerator[dict, None]:
+    """
+    对冲流式请求：主请求超过首字延迟阈值仍未产出正文时，再发出一个相同的请求
+    （可指定更快的模型），先产出正文的请求胜出，另一个被取消
+    
+    Yields:
+        dict: 与 _generate_stream_async 相同的 chunk 字典；对冲请求胜出时先产出
+              {"type": "hedge", "content": 对冲请求的模型}（主请求并未失败，与降级的 model 类型区分）
+    """
+    stats = get_hedge_stats()
+    primary_model = ctx["model"]
+    threshold = stats.threshold(primary_model, ctx.get("hedge_percentile", 90))
+    started = time.monotonic()
+    
+    output = asyncio.Queue()
+    base_ctx = dict(ctx, hedge=False)
+    tasks = {"primary": asyncio.ensure_future(
+        _pump_stream("primary", _generate_stream_async(contents, system_prompt, base_ctx), output)
+    )}
+    hedge_model = ctx.get("hedge_model") or primary_model
+    buffered = {"primary": [], "hedge": []}  # 胜出前暂存的非正文 chunk（如思考过程）
+    finished = set()
+    winner = None
+    hedge_started = None
+    
+    try:
+        # 等待任一请求产出首个正文
+        while winner is None:
+            timeout = None
+            if "hedge" not in tasks:
+                timeout = max(threshold - (time.monotonic() - started), 0)
+            try:
+                source, chunk = await asyncio.wait_for(output.get(), timeout)
+            except asyncio.TimeoutError:
+                # 超过阈值，发出对冲请求（对冲请求不读写缓存）
+                hedge_ctx = dict(base_ctx, model=hedge_model, use_cache=False)
+                hedge_started = time.monotonic()
+                tasks["hedge"] = asyncio.ensure_future(
+                    _pump_stream("hedge", _generate_stream_async(contents, system_prompt, hedge_ctx), output)
+                )
+                continue
+            
+            if chunk is None:
+                finished.add(source)
+                if finished == set(tasks):
+                    # 都未产出正文就结束：按主请求的结果输出（如错误信息）
+                    winner = "primary"
+                continue
+            if chunk["type"] == "queue":
+                # 排队状态直接转发
+                yield chunk
+                continue
+            if chunk["type"] == "text":
+                winner = source
+            elif chunk["type"] == "error" and "hedge" not in tasks:
+                # 主请求在阈值前失败（自身重试已用尽），不再对冲
+                winner = "primary"
+            buffered[source].append(chunk)
+        
+        # 主请求产出首字时记录其首字延迟；对冲请求胜出时主请求的首字延迟至少为当前耗时，
+        # 以该下限计入样本，避免阈值只由较快的请求决定
+        now = time.monotonic()
+        got_text = any(chunk["type"] == "text" for chunk in buffered[winner])
+        stats.record(
+            primary_model,
+            now - started if got_text else None,
+            hedged="hedge" in tasks,
+            hedge_won=winner == "hedge",
+            hedge_model=hedge_model,
+            hedge_ttft=now - hedge_started if winner == "hedge" and got_text else None,
         )
         
-        # 构建包含图片的内容
-        contents = [
-            types.Part.from_bytes(data=image_data, mime_type=mime_type),
-            prompt
-        ]
+        # 取消落败的请求
+        for source, task in tasks.items():
+            if source != winner:
+                task.cancel()
+        
+        if winner == "hedge":
+            yield {"type": "hedge", "content": hedge_model}
+        for chunk in buffered[winner]:
+            yield chunk
+        # 继续输出胜出请求的剩余内容
+        while winner not in finished:
+            source, chunk = await output.get()
+            if source != winner:
+                continue
+            if chunk is None:
+                finished.add(source)
+                continue
+            yield chunk
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+
+# ============================================
+# 异步调用引擎
+# ============================================
+
+# 同时进行中的模型请求上限（整个进程共享）
+LLM_MAX_CONCURRENCY = 16
+
+# 思考模式的token预算
+THINKING_BUDGET = 10000
+
+# 取消后等待后台任务收尾（结算已消耗token）的最长时间（秒）
+STREAM_CANCEL_GRACE_SECONDS = 2.0
+
+# 每个事件循环对应的并发信号量
+_LLM_SEMAPHORES = {}
+
+
+def _get_llm_semaphore() -> asyncio.Semaphore:
+    """获取当前事件循环的并发信号量，限制同时进行的请求数"""
+    loop = asyncio.get_running_loop()
+    semaphore = _LLM_SEMAPHORES.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        _LLM_SEMAPHORES[loop] = semaphore
+    return semaphore
+
+
+class CancellationToken:
+    """
+    跨线程的取消令牌
+    
+    由后台任务持有，并通过调用参数 ctx["cancel_token"] 传到调用层。取消时立即执行已注册的回调
+    （取消事件循环中的请求任务，正在等待的HTTP读取随之中断、连接关闭），不必等到下一个 chunk；
+    同时累计各次调用已消耗的token，中止后用于报告用量。
+    """
+    
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._consumed_tokens = 0
+    
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+    
+    @property
+    def consumed_tokens(self) -> int:
+        return self._consumed_tokens
+    
+    def cancel(self):
+        """触发取消并执行所有回调（重复调用无效果）"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning("cancel callback failed: %s", e)
+    
+    def add_callback(self, callback):
+        """注册取消回调；已取消时立即执行"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+    
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+    
+    def wait(self, timeout: float) -> bool:
+        """
+        等待至多 timeout 秒（用于替代轮询中的 time.sleep）
         
-        response = client.models.generate_content(
-            model=get_selected_model(),
-            contents=contents,
-            config=config
-        )
-        return response.text
-    except Exception as e:
-        st.error(f"图片处理API调用失败: {str(e)}")
-        st.session_state.last_error = str(e)
-        return None
+        Returns:
+            bool: 等待期间是否已被取消
+        """
+        return self._event.wait(timeout)
+    
+    def add_usage(self, tokens: int):
+        with self._lock:
+            self._consumed_tokens += tokens
+
+
+class AsyncGeminiEngine:
+    """
+    后台事件循环引擎
+    
+    在独立线程中运行 asyncio 事件循环，所有异步模型调用都在其中执行；
+    Streamlit 脚本线程通过 run() / stream() 桥接获取结果，不阻塞事件循环。
+    """
+    
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name="gemini-async-engine", daemon=True)
+        self._thread.start()
+    
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+    
+    def submit(self, coro) -> concurrent.futures.Future:
+        """
+        提交协程到引擎事件循环
+        
+        Returns:
+            concurrent.futures.Future: 可用于获取结果或取消任务
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+    
+    def run(self, coro, timeout: Optional[float] = None, token: Optional[CancellationToken] = None):
+        """
+        提交协程并等待结果（脚本线程或后台任务线程中调用）
+        
+        Args:
+            coro: 协程
+            timeout: 等待超时（秒）
+            token: 取消令牌，触发时立即取消协程并抛出 CancelledError
+        """
+        future = self.submit(coro)
+        if token is not None:
+            token.add_callback(future.cancel)
+        try:
+            return future.result(timeout=timeout)
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            if token is not None:
+                token.remove_callback(future.cancel)
+    
+    def stream(self, async_gen: AsyncGenerator, token: Optional[CancellationToken] = None) -> Generator[dict, None, None]:
+        """
+        将异步生成器桥接为同步生成器，供Streamlit脚本线程逐块消费
+        
+        消费方提前退出（break、异常或页面重跑）时，会取消后台任务并关闭底层HTTP流；
+        传入取消令牌时，令牌触发后立即取消（模型仍在思考、尚未返回 chunk 时同样有效）。
+        
+        Args:
+            async_gen: 产出 chunk 字典的异步生成器
+            token: 取消令牌（可选）
+        
+        Yields:
+            dict: 与异步生成器相同的 chunk 字典
+        """
+        items = queue.Queue()
+        done = object()
+        pump_finished = threading.Event()
+        
+        async def pump():
+            try:
+                async for item in async_gen:
+                    items.put(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                items.put({"type": "error", "content": str(e)})
+            finally:
+                try:
+                    await async_gen.aclose()
+                finally:
+                    items.put(done)
+                    pump_finished.set()
+        
+        future = self.submit(pump())
+        
+        def abort():
+            # 取消后台任务：正在等待的HTTP读取被中断，底层响应流随之关闭；同时唤醒阻塞的消费方
+            future.cancel()
+            items.put(done)
+        
+        if token is not None:
+            token.add_callback(abort)
+        try:
+            while True:
+                item = items.get()
+                if item is done:
+                    break
+                yield item
+        finally:
+            if token is not None:
+                token.remove_callback(abort)
+            if not future.done():
+                future.cancel()
+            if token is not None and token.cancelled:
+                # 等待后台任务收尾（结算已消耗的token），调用方随后报告用量
+                pump_finished.wait(STREAM_CANCEL_GRACE_SECONDS)
+    
+    def shutdown(self):
+        """取消所有未完成的任务并停止事件循环"""
+        def _cancel_all():
+            for task in asyncio.all_tasks(self.loop):
+                task.cancel()
+            self.loop.stop()
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(_cancel_all)
+        self._thread.join(timeout=5)
+
+
+@st.cache_resource(show_spinner=False)
+def get_async_engine() -> AsyncGeminiEngine:
+    """获取进程级异步调用引擎（所有会话共享）"""
+    engine = AsyncGeminiEngine()
+    atexit.register(engine.shutdown)
+    return engine
+
+
+def get_call_context() -> dict:
+    """
+    在脚本线程中采集模型调用所需的会话参数
+    
+    后台事件循环无法访问 st.session_state，异步接口通过该字典获取配置；
+    后台任务线程中返回任务提交时采集的参数。
+    
+    Returns:
+        dict: {"api_key", "use_key_pool", "model", "fallback_models", "use_cache", "bypass_cache",
+               "hedge", "hedge_model", "hedge_percentile", "cancel_token"}
+        脚本线程中 cancel_token 为None（由页面重跑中断），后台任务中为任务的取消令牌；
+        非流式调用结束后还会写入 "model_used"（见 apply_model_used）
+    """
+    job = get_current_job()
+    if job is not None:
+        return job.ctx
+    api_key = st.session_state.get("api_key", "")
+    mode = st.session_state.get("selected_function", "")
+    key_pool = get_api_key_pool()
+    return {
+        "api_key": api_key,
+        # 使用 secrets 配置的 Key 时由 Key 池在多个 Key 间分配
+        "use_key_pool": len(key_pool.api_keys) > 1 and api_key in key_pool,
+        "model": get_selected_model(),
+        # 模型过载时依次尝试的备用模型
+        "fallback_models": get_fallback_models(mode, get_selected_model())
+        if st.session_state.get("model_fallback_enabled", True) else [],
+        "use_cache": is_response_cache_enabled(),
+        "bypass_cache": st.session_state.get("bypass_response_cache", False),
+        # 对冲请求（仅对首字延迟敏感的功能）
+        "hedge": mode in HEDGE_MODES and st.session_state.get("hedge_enabled", False),
+        "hedge_model": st.session_state.get("hedge_model", ""),
+        "hedge_percentile": st.session_state.get("hedge_percentile", 90),
+        "cancel_token": None,
+    }
+
+
+def build_generate_config(system_prompt: str, model: str, enable_thinking: bool = True,
+                          response_schema: Optional[dict] = None) -> types.GenerateContentConfig:
+    """
+    构建生成配置
+    
+    Args:
+        system_prompt: 系统提示词
+        model: 模型名称
+        enable_thinking: 模型支持时是否启用思考模式
+        response_schema: 结构化输出的JSON Schema（可选，提供时要求模型返回JSON）
+    
+    Returns:
+        types.GenerateContentConfig
+    """
+    use_thinking = enable_thinking and ("2.5" in model or "think" in model.lower())
+    return types.GenerateContentConfig(
+        system_instruction=system_prompt if system_prompt else None,
+        thinking_config=types.ThinkingConfig(
+            thinking_budget=THINKING_BUDGET,  # 允许的思考token数
+            include_thoughts=True  # 返回思考摘要（thought=True 的 Part）
+        ) if use_thinking else None,
+        response_mime_type="application/json" if response_schema else None,
+        response_schema=response_schema
+    )
+
+
+def build_image_contents(image_data: bytes, prompt: str, mime_type: str = "image/png") -> list:
+    """构建包含图片的请求内容"""
+    return [
+        types.Part.from_bytes(data=image_data, mime_type=mime_type),
+        prompt
+    ]
+
+
+# 断点续写：提示中引用的已生成结尾长度、拼接时检测重叠的最大/最小长度
+STREAM_RESUME_TAIL_CHARS = 200
+STREAM_RESUME_MAX_OVERLAP = 400
+STREAM_RESUME_MIN_OVERLAP = 4
+
+
+def to_content_parts(contents) -> list:
+    """
+    将请求内容统一转换为 Part 列表（用于构建多轮请求）
+    
+    Args:
+        contents: 字符串，或由字符串、Part、File句柄组成的列表
+    
+    Returns:
+        list: types.Part 列表
+    """
+    items = contents if isinstance(contents, list) else [contents]
+    parts = []
+    for item in items:
+        if isinstance(item, str):
+            parts.append(types.Part.from_text(text=item))
+        elif isinstance(item, types.File):
+            parts.append(types.Part.from_uri(file_uri=item.uri, mime_type=item.mime_type))
+        else:
+            parts.append(item)
+    return parts
+
+
+def build_continuation_contents(contents, partial_text: str) -> list:
+    """
+    构建断点续写的请求内容：原始请求 + 已生成的部分（作为模型回复）+ 继续指令
+    
+    Args:
+        contents: 原始请求内容（字符串，或Part、File句柄列表）
+        partial_text: 中断前已输出的正文
+    
+    Returns:
+        list: types.Content 列表
+    """
+    user_parts = to_content_parts(contents)
+    tail = partial_text[-STREAM_RESUME_TAIL_CHARS:]
+    return [
+        types.Content(role="user", parts=user_parts),
+        types.Content(role="model", parts=[types.Part.from_text(text=partial_text)]),
+        types.Content(role="user", parts=[types.Part.from_text(
+            text=f"上一条回复因网络原因中断，请从中断处继续输出，直接接着以下结尾往下写，"
+                 f"不要重复已输出的内容，也不要添加任何说明：\n\n{tail}"
+        )]),
+    ]
+
+
+class StreamSplicer:
+    """
+    断点续写拼接器
+    
+    续写的开头可能重复中断前的结尾，先缓冲续写开头的一段文本，
+    找到与已输出内容的最长重叠后去掉重复部分，保证调用方看到的是一段连续输出。
+    """
+    
+    def __init__(self, partial_text: str):
+        self.partial_tail = partial_text[-STREAM_RESUME_MAX_OVERLAP:]
+        self.buffer = ""
+        self.spliced = False
+    
+    def _splice(self) -> str:
+        """去掉缓冲区开头与已输出结尾重叠的部分"""
+        self.spliced = True
+        max_len = min(len(self.partial_tail), len(self.buffer))
+        for length in range(max_len, STREAM_RESUME_MIN_OVERLAP - 1, -1):
+            if self.partial_tail.endswith(self.buffer[:length]):
+                return self.buffer[length:]
+        return self.buffer
+    
+    def feed(self, text: str) -> str:
+        """
+        接收续写的文本片段
+        
+        Returns:
+            str: 可以输出的文本（仍在缓冲时返回空字符串）
+        """
+        if self.spliced:
+            return text
+        self.buffer += text
+        if len(self.buffer) < STREAM_RESUME_MAX_OVERLAP:
+            return ""
+        return self._splice()
+    
+    def flush(self) -> str:
+        """续写结束时输出剩余缓冲"""
+        return "" if self.spliced else self._splice()
+
+
+def decode_stream_chunk(chunk) -> list:
+    """
+    解码一个流式响应 chunk
+    
+    直接读取 candidates → content.parts，按 Part.thought 区分思考摘要和正文，
+    文本、图片、视频等任意请求内容的响应都使用同一套解码。
+    
+    Args:
+        chunk: types.GenerateContentResponse
+    
+    Returns:
+        list: [{"type": "thinking"|"text", "content": str}, ...]
+    """
+    decoded = []
+    for candidate in chunk.candidates or ():
+        content = candidate.content
+        if content is None:
+            continue
+        for part in content.parts or ():
+            text = part.text
+            if text:
+                decoded.append({"type": "thinking" if part.thought else "text", "content": text})
+    return decoded
+
+
+async def _generate_async(contents, system_prompt: str, ctx: dict, response_schema: Optional[dict] = None) -> str:
+    """
+    异步非流式生成（带响应缓存）
+    
+    Args:
+        contents: 请求内容（字符串或Part列表）
+        system_prompt: 系统提示词
+        ctx: get_call_context() 返回的调用参数
+        response_schema: 结构化输出的JSON Schema（可选）
+    
+    Returns:
+        str: 模型返回的文本（实际产出结果的模型写入 ctx["model_used"]，由调用方通过 apply_model_used 记录）
+    """
+    model = ctx["model"]
+    config = build_generate_config(system_prompt, model, enable_thinking=False, response_schema=response_schema)
+    
+    # 优先读取响应缓存
+    if ctx["use_cache"]:
+        cache_key = make_response_cache_key(model, system_prompt, contents, config)
+        cached = lookup_response_cache(cache_key, ctx["bypass_cache"])
+        if cached is not None:
+            ctx["model_used"] = model
+            return cached
+    
+    reserved = estimate_reserved_tokens(contents)
+    models = [model] + list(ctx.get("fallback_models", []))
+    
+    for model_index, current_model in enumerate(models):
+        current_config = config if current_model == model else build_generate_config(
+            system_prompt, current_model, enable_thinking=False, response_schema=response_schema
+        )
+        
+        async def request(api_key: str):
+            request_sent = False
+            try:
+                # 排队和请求期间占用客户端，避免被空闲回收
+                with get_client_registry().lease(api_key) as client:
+                    # 先通过限流排队，再占用并发名额
+                    async for _ in wait_for_admission(api_key, current_model, reserved):
+                        pass
+                    async with _get_llm_semaphore():
+                        request_sent = True
+                        response = await client.aio.models.generate_content(
+                            model=current_model,
+                            contents=contents,
+                            config=current_config
+                        )
+            except asyncio.CancelledError:
+                # 被取消令牌中止：请求已发出时按输入估算计入消耗
+                if request_sent:
+                    used_tokens = estimate_consumed_tokens(contents, 0)
+                    get_rate_limiter().settle(api_key, current_model, reserved, used_tokens)
+                    get_api_key_pool().record_usage(api_key, used_tokens)
+                    record_call_usage(ctx, used_tokens)
+                raise
+            used_tokens = get_usage_tokens(response.usage_metadata)
+            get_rate_limiter().settle(api_key, current_model, reserved, used_tokens)
+            get_api_key_pool().record_usage(api_key, used_tokens)
+            record_call_usage(ctx, used_tokens)
+            return response
+        
+        try:
+            response = await get_retry_scheduler().run(
+                request, lambda: select_api_key(ctx, current_model), current_model
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 当前模型过载或熔断，改用降级链上的下一个模型
+            if should_fallback(e) and model_index < len(models) - 1:
+                continue
+            raise
+        
+        # 降级模型的结果不写入缓存，避免之后一直复用降级结果
+        if ctx["use_cache"] and response.text and current_model == model:
+            get_response_cache().put(cache_key, response.text, model)
+        ctx["model_used"] = current_model
+        return response.text
+
+
+async def _generate_stream_async(contents, system_prompt: str, ctx: dict) -> AsyncGenerator[dict, None]:
+    """
+    异步流式生成核心：响应缓存、自动重试（中途出错时从已生成内容处续写）、模型降级、思考过程解析
+    
+    Args:
+        contents: 请求内容（字符串，或由字符串、Part、File句柄组成的列表）
+        system_prompt: 系统提示词
+        ctx: get_call_context() 返回的调用参数
+    
+    Yields:
+        dict: {"type": "text"|"thinking"|"error"|"retry"|"queue"|"model"|"hedge", "content": str}
+        （model 类型表示已降级，content 为实际使用的模型名）
+    """
+    # 获取当前选择的模型
+    selected_model = ctx["model"]
+    
+    # 构建配置 - 启用思考过程（如果模型支持）
+    config = build_generate_config(system_prompt, selected_model)
+    logger.debug("stream model=%s thinking_config=%s", selected_model, config.thinking_config)
+    
+    # 命中响应缓存时直接按流式协议回放
+    if ctx["use_cache"]:
+        cache_key = make_response_cache_key(selected_model, system_prompt, contents, config)
+        cached = lookup_response_cache(cache_key, ctx["bypass_cache"])
+        if cached is not None:
+            for item in replay_cached_response(cached):
+                yield item
+            return
+    
+    if not ctx["api_key"]:
+        yield {"type": "error", "content": "API客户端初始化失败，请检查API Key"}
+        return
+    
+    # 已输出的正文（跨重试、跨模型保留），成功完成后写入缓存
+    response_text = ""
+    scheduler = get_retry_scheduler()
+    registry = get_client_registry()
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    
+    # 当前模型重试用尽或熔断时，按降级链依次改用备用模型
+    models = [selected_model] + list(ctx.get("fallback_models", []))
+    
+    for model_index, current_model in enumerate(models):
+        if model_index > 0:
+            # 通知调用方实际产出结果的模型已变化
+            yield {"type": "model", "content": current_model}
+            config = build_generate_config(system_prompt, current_model)
+        has_next_model = model_index < len(models) - 1
+        
+        for attempt in range(RETRY_MAX_ATTEMPTS):
+            request_sent = False
+            output_chars = 0  # 本次尝试已收到的正文和思考字符数（取消时估算用量）
+            usage_metadata = None
+            leased_key = None  # 本次尝试占用的客户端对应的 Key，流结束后释放
+            probe = False  # 本次尝试是否为熔断半开状态下的探测请求
+            try:
+                # 每次尝试重新选择 Key（Key 池中被限流的 Key 会被跳过）
+                api_key = select_api_key(ctx, current_model)
+                probe = scheduler.check(api_key, current_model)
+                # 流式输出可能持续较长时间，占用期间客户端不会被空闲回收
+                client = registry.acquire(api_key)
+                leased_key = api_key
+                
+                # 已有部分输出时发起续写请求，避免重复输出和浪费已生成的内容
+                request_contents = contents
+                splicer = None
+                if response_text:
+                    request_contents = build_continuation_contents(contents, response_text)
+                    splicer = StreamSplicer(response_text)
+                
+                # 通过限流排队（排队期间向调用方报告位置）
+                reserved = estimate_reserved_tokens(request_contents)
+                async for queue_chunk in wait_for_admission(api_key, current_model, reserved):
+                    yield queue_chunk
+                
+                async with _get_llm_semaphore():
+                    request_sent = True
+                    # 使用流式API
+                    response_stream = await client.aio.models.generate_content_stream(
+                        model=current_model,
+                        contents=request_contents,
+                        config=config
+                    )
+                    
+                    async for chunk in response_stream:
+                        # 最后一个 chunk 带有完整的用量统计
+                        if chunk.usage_metadata:
+                            usage_metadata = chunk.usage_metadata
+                        
+                        for item in decode_stream_chunk(chunk):
+                            output_chars += len(item["content"])
+                            if item["type"] == "text" and splicer:
+                                item["content"] = splicer.feed(item["content"])
+                                if not item["content"]:
+                                    continue
+                            if item["type"] == "text":
+                                response_text += item["content"]
+                            yield item
+                    
+                    if debug_enabled:
+                        logger.debug("stream finished model=%s chars=%d usage=%s",
+                                     current_model, len(response_text), usage_metadata)
+                    
+                    # 续写较短时缓冲区可能还未输出
+                    if splicer:
+                        text = splicer.flush()
+                        if text:
+                            response_text += text
+                            yield {"type": "text", "content": text}
+                
+                # 成功完成，结算限流额度、写入缓存并退出
+                scheduler.record_success(api_key, current_model)
+                used_tokens = get_usage_tokens(usage_metadata)
+                get_rate_limiter().settle(api_key, current_model, reserved, used_tokens)
+                get_api_key_pool().record_usage(api_key, used_tokens)
+                record_call_usage(ctx, used_tokens)
+                # 降级模型的结果不写入缓存，避免之后一直复用降级结果
+                if ctx["use_cache"] and model_index == 0:
+                    get_response_cache().put(cache_key, response_text, selected_model)
+                return
+            
+            except asyncio.CancelledError:
+                # 被取消令牌或消费方中止（排队、重试等待中同样立即生效）：底层流已随任务取消关闭，
+                # 请求已发出时按已收到的用量统计（没有则估算）结算
+                if request_sent:
+                    used_tokens = get_usage_tokens(usage_metadata) or estimate_consumed_tokens(request_contents, output_chars)
+                    get_rate_limiter().settle(api_key, current_model, reserved, used_tokens)
+                    get_api_key_pool().record_usage(api_key, used_tokens)
+                    record_call_usage(ctx, used_tokens)
+                raise
+            except CircuitOpenError as e:
+                # 熔断中：有备用模型时立即切换，否则直接失败
+                if has_next_model:
+                    yield {"type": "retry", "content": f"⚠️ {current_model} {e}，改用 {models[model_index + 1]}..."}
+                    break
+                yield {"type": "error", "content": str(e)}
+                return
+            except Exception as e:
+                # 由调度器判断是否可重试以及等待时长
+                retry_delay = scheduler.record_failure(api_key, current_model, e, attempt)
+                if probe:
+                    # 探测已有结论，重试等待期间不再占用探测名额
+                    scheduler.release_probe(api_key, current_model)
+                    probe = False
+                
+                if retry_delay is not None:
+                    # 通知用户正在重试
+                    remaining = RETRY_MAX_ATTEMPTS - attempt - 1
+                    resume_hint = "，将从已生成内容处继续" if response_text else ""
+                    yield {
+                        "type": "retry", 
+                        "content": f"⚠️ 服务暂时不可用 ({describe_error(e)})，{retry_delay:.0f}秒后自动重试（剩余{remaining}次）{resume_hint}..."
+                    }
+                    await asyncio.sleep(retry_delay)
+                    continue
+                elif should_fallback(e) and has_next_model:
+                    # 重试用尽，改用降级链上的下一个模型
+                    yield {
+                        "type": "retry",
+                        "content": f"⚠️ {current_model} 暂时不可用 ({describe_error(e)})，改用 {models[model_index + 1]}..."
+                    }
+                    break
+                else:
+                    # 不可重试或已无备用模型
+                    yield {"type": "error", "content": str(e)}
+                    return
+            finally:
+                if probe:
+                    scheduler.release_probe(api_key, current_model)
+                if leased_key is not None:
+                    registry.release(leased_key)
+
+
+async def call_gemini_async(prompt: str, system_prompt: str = "", ctx: Optional[dict] = None) -> str:
+    """
+    异步调用Gemini API（非流式）
+    
+    Args:
+        prompt: 用户输入的提示词
+        system_prompt: 系统提示词
+        ctx: 调用参数，后台线程中必须显式传入 get_call_context() 的结果
+    
+    Returns:
+        str: API返回的文本内容（失败时抛出异常）
+    """
+    return await _generate_async(prompt, system_prompt, ctx or get_call_context())
+
+
+async def call_gemini_with_image_async(image_data: bytes, prompt: str, system_prompt: str = "",
+                                       mime_type: str = "image/png", ctx: Optional[dict] = None) -> str:
+    """
+    异步调用Gemini API处理图片（非流式）
+    
+    Returns:
+        str: API返回的文本内容（失败时抛出异常）
+    """
+    contents = build_image_contents(image_data, prompt, mime_type)
+    return await _generate_async(contents, system_prompt, ctx or get_call_context())
+
+
+async def call_gemini_stream_async(prompt: str, system_prompt: str = "", ctx: Optional[dict] = None) -> AsyncGenerator[dict, None]:
+    """
+    异步流式调用Gemini API
+    
+    Args:
+        prompt: 用户输入的提示词
+        system_prompt: 系统提示词
+        ctx: 调用参数，后台线程中必须显式传入 get_call_context() 的结果
+    
+    Yields:
+        dict: {"type": "text"|"thinking"|"error"|"retry"|"queue"|"model"|"hedge", "content": str}
+    """
+    ctx = ctx or get_call_context()
+    stream = _hedged_stream_async if ctx.get("hedge") else _generate_stream_async
+    async for item in stream(prompt, system_prompt, ctx):
+        yield item
+
+
+async def call_gemini_with_image_stream_async(image_data: bytes, prompt: str, system_prompt: str = "",
+                                              mime_type: str = "image/png", ctx: Optional[dict] = None) -> AsyncGenerator[dict, None]:
+    """
+    异步流式调用Gemini API处理图片
+    
+    Yields:
+        dict: {"type": "text"|"thinking"|"error"|"retry"|"queue", "content": str}
+    """
+    contents = build_image_contents(image_data, prompt, mime_type)
+    async for item in _generate_stream_async(contents, system_prompt, ctx or get_call_context()):
+        yield item
+
+
+def get_cancel_token() -> Optional[CancellationToken]:
+    """当前后台任务的取消令牌（脚本线程中返回None）"""
+    job = get_current_job()
+    return job.token if job is not None else None
+
+
+def run_async(coro):
+    """在异步引擎中执行协程并等待结果（用于并行扇出；后台任务中止时立即取消）"""
+    return get_async_engine().run(coro, token=get_cancel_token())
+
+
+def _consume_stream_in_session(async_gen: AsyncGenerator) -> Generator[dict, None, None]:
+    """
+    在脚本线程（或后台任务线程）中消费异步流，并维护运行状态（中止标志、错误、思考过程）
+    
+    Yields:
+        dict: {"type": "text"|"thinking"|"error"|"retry"|"queue"|"stopped", "content": str}
+    """
+    state = get_run_state()
+    # 清空之前的错误
+    state.last_error = ""
+    state.thinking_content = ""
+    state.last_model_used = get_call_context()["model"]
+    token = get_cancel_token()
+    
+    for chunk in get_async_engine().stream(async_gen, token):
+        # 检查是否需要中止（退出循环时后台请求会被取消）
+        if state.should_stop:
+            break
+        
+        if chunk["type"] == "thinking":
+            state.thinking_content += chunk["content"]
+        elif chunk["type"] in ("error", "retry"):
+            state.last_error = chunk["content"]
+        elif chunk["type"] in ("model", "hedge"):
+            # 已降级到备用模型或由对冲请求输出，记录实际产出结果的模型
+            state.last_model_used = chunk["content"]
+        yield chunk
+    
+    # 后台任务中由取消令牌立即关闭流；脚本线程中在收到下一个 chunk 时退出
+    if state.should_stop:
+        yield {"type": "stopped", "content": f"用户已中止生成{format_consumed_tokens(token)}"}
+        state.should_stop = False
+
+
+def call_gemini(prompt: str, system_prompt: str = "") -> Optional[str]:
+    """
+    调用Gemini API（非流式，用于内部处理）
+    
+    Args:
+        prompt: 用户输入的提示词
+        system_prompt: 系统提示词
+    
+    Returns:
+        API返回的文本内容，失败返回None
+    """
+    if get_gemini_client() is None:
+        return None
+    ctx = get_call_context()
+    try:
+        result = run_async(call_gemini_async(prompt, system_prompt, ctx))
+        apply_model_used(ctx)
+        return result
+    except Exception as e:
+        st.error(f"API调用失败: {str(e)}")
+        st.session_state.last_error = str(e)
+        return None
+
+
+def call_gemini_with_image(image_data: bytes, prompt: str, system_prompt: str = "", mime_type: str = "image/png") -> Optional[str]:
+    """
+    调用Gemini API处理图片（非流式）
+    
+    Args:
+        image_data: 图片的字节数据
+        prompt: 用户输入的提示词
+        system_prompt: 系统提示词
+        mime_type: 图片的MIME类型（image/png, image/jpeg, application/pdf）
+    
+    Returns:
+        API返回的文本内容，失败返回None
+    """
+    if get_gemini_client() is None:
+        return None
+    ctx = get_call_context()
+    try:
+        result = run_async(call_gemini_with_image_async(image_data, prompt, system_prompt, mime_type, ctx))
+        apply_model_used(ctx)
+        return result
+    except Exception as e:
+        st.error(f"图片处理API调用失败: {str(e)}")
+        st.session_state.last_error = str(e)
+        return None
+
+
+def call_gemini_with_image_stream(image_data: bytes, prompt: str, system_prompt: str = "", mime_type: str = "image/png", thinking_container=None) -> Generator[dict, None, None]:
+    """
+    流式调用Gemini API处理图片，支持中止、错误展示和自动重试
+    
+    Args:
+        image_data: 图片的字节数据
+        prompt: 用户输入的提示词
+        system_prompt: 系统提示词
+        mime_type: 图片的MIME类型
+        thinking_container: 用于显示思考过程的容器（可选）
+    
+    Yields:
+        dict: {"type": "text"|"thinking"|"error"|"retry"|"queue", "content": str}
+    """
+    yield from _consume_stream_in_session(
+        call_gemini_with_image_stream_async(image_data, prompt, system_prompt, mime_type, get_call_context())
+    )
+
+
+def call_gemini_stream(prompt: str, system_prompt: str = "", thinking_container=None) -> Generator[dict, None, None]:
+    """
+    流式调用Gemini API，支持中止、错误展示、思考过程和自动重试
+    
+    Args:
+        prompt: 用户输入的提示词
+        system_prompt: 系统提示词
+        thinking_container: 用于显示思考过程的容器（可选）
+    
+    Yields:
+        dict: {"type": "text"|"thinking"|"error"|"retry"|"queue", "content": str}
+    """
+    yield from _consume_stream_in_session(
+        call_gemini_stream_async(prompt, system_prompt, get_call_context())
+    )
+
+
+# 流式渲染合帧：每次 markdown() 都会把完整文本重新发送并解析，逐 chunk 刷新的总开销随长度平方增长
+STREAM_RENDER_FPS = 10  # 每秒最多刷新次数
+STREAM_RENDER_SLOWDOWN_CHARS = 5000  # 文本每增长这么多字符，刷新间隔增加一倍基础间隔
+
+
+class StreamRenderer:
+    """
+    流式输出的合帧渲染器
+    
+    update() 只记录最新文本，距上一帧超过刷新间隔才真正调用 container.markdown()；
+    文本越长刷新间隔越大，整篇推送的数据量近似线性。flush() 输出最终结果（不带光标）。
+    """
+    
+    def __init__(self, container, template: str = "{text}", cursor: str = " ▌", fps: int = STREAM_RENDER_FPS):
+        """
+        Args:
+            container: Streamlit容器对象（需支持 markdown()，如 st.empty()）
+            template: 渲染模板，{text} 处替换为当前文本
+            cursor: 生成过程中附加在文本末尾的光标
+            fps: 每秒最多刷新次数
+        """
+        self.container = container
+        self.template = template
+        self.cursor = cursor
+        self.base_interval = 1.0 / fps
+        self.text = ""
+        self.frames = 0
+        self._last_render = 0.0
+        self._rendered = None
+    
+    def _visible(self) -> str:
+        """需要重新渲染的文本"""
+        return self.text
+    
+    def _slot(self):
+        """渲染目标容器"""
+        return self.container
+    
+    def _interval(self) -> float:
+        return self.base_interval * (1 + len(self._visible()) // STREAM_RENDER_SLOWDOWN_CHARS)
+    
+    def _render(self, text: str):
+        if text == self._rendered:
+            return
+        self._slot().markdown(self.template.format(text=text))
+        self._rendered = text
+        self.frames += 1
+        self._last_render = time.monotonic()
+    
+    def update(self, text: str):
+        """记录最新的完整文本，到达刷新间隔时渲染一帧（首帧立即渲染）"""
+        self.text = text
+        if time.monotonic() - self._last_render >= self._interval():
+            self._render(self._visible() + self.cursor)
+    
+    def flush(self):
+        """渲染最终文本（去掉光标）"""
+        visible = self._visible()
+        if visible:
+            self._render(visible)
+
+
+class PrdDocumentRenderer(StreamRenderer):
+    """
+    以 render_prd_document 的文档样式渲染流式内容（快速生成时各章节并行写入同一份文档）
+    """
+    
+    def __init__(self, container, title: str = "策划案", cursor: str = " ▌", fps: int = STREAM_RENDER_FPS):
+        """
+        Args:
+            container: Streamlit容器对象（st.empty() 或后台任务画布的占位）
+            title: 文档标题
+            cursor: 生成过程中附加在文本末尾的光标（调用方也可以直接在正在撰写的章节中插入光标）
+            fps: 每秒最多刷新次数
+        """
+        super().__init__(container, cursor=cursor, fps=fps)
+        self.title = title
+    
+    def _render(self, text: str):
+        if text == self._rendered:
+            return
+        render_prd_document(text, self.title, container=self._slot())
+        self._rendered = text
+        self.frames += 1
+        self._last_render = time.monotonic()
+
+
+class SegmentedStreamRenderer(StreamRenderer):
+    """
+    按章节分段的流式渲染器（用于策划案正文）
+    
+    在 format_prd_content 识别的一级标题处切分输出：已完成的章节写入各自的 st.empty() 后不再更新，
+    只重新渲染正在输出的章节，单次刷新的开销与当前章节长度成正比。
+    章节编号需依次递增且分隔符一致，正文中的编号列表和代码块不会被误切分。
+    """
+    
+    def __init__(self, container, cursor: str = " ▌", fps: int = STREAM_RENDER_FPS):
+        """
+        Args:
+            container: Streamlit容器对象（st.empty() 或 st.container()），各章节在其中依次追加
+            cursor: 生成过程中附加在当前章节末尾的光标
+            fps: 每秒最多刷新次数
+        """
+        super().__init__(container, cursor=cursor, fps=fps)
+        self.segments = 0
+        self._parent = None
+        self._placeholder = None
+        self._segment_start = 0  # 当前章节在全文中的起始位置
+        self._scan_pos = 0  # 下一个待检查的行首位置
+        self._chapter = 0  # 已出现的最大章节编号
+        self._separator = None  # 第一章标题使用的分隔符（、或 .），后续章节需保持一致
+        self._list_number = None  # 上一行为编号列表项时的编号，用于识别连续列表
+        self._in_fence = False  # 是否位于 ``` 代码块内
+    
+    def _visible(self) -> str:
+        return self.text[self._segment_start:]
+    
+    def _slot(self):
+        if self._placeholder is None:
+            if self._parent is None:
+                self._parent = self.container.container()
+            self._placeholder = self._parent.empty()
+            self.segments += 1
+        return self._placeholder
+    
+    def _is_next_chapter(self, line: str) -> bool:
+        """判断一行是否为下一章标题，同时维护代码块和编号列表状态"""
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            self._in_fence = not self._in_fence
+            return False
+        if self._in_fence:
+            return False
+        number = get_display_chapter_number(stripped)
+        if number is None:
+            self._list_number = None
+            return False
+        # 紧接在上一个编号之后的行属于同一个列表
+        in_list = self._list_number is not None and number == self._list_number + 1
+        separator = re.sub(r'\*\*', '', stripped).lstrip('#').strip()[len(str(number))]
+        if number != self._chapter + 1 or in_list or separator != (self._separator or separator):
+            self._list_number = number
+            return False
+        self._list_number = None
+        self._separator = separator
+        return True
+    
+    def _split_chapters(self):
+        """检查新增的完整行，遇到下一章标题时冻结当前章节"""
+        end = self.text.rfind("\n") + 1
+        while self._scan_pos < end:
+            line_end = self.text.index("\n", self._scan_pos)
+            if self._is_next_chapter(self.text[self._scan_pos:line_end]):
+                self._chapter += 1
+                if self._scan_pos > self._segment_start:
+                    # 以最终内容（不带光标）定格上一章，之后不再触碰该容器
+                    self._render(self.text[self._segment_start:self._scan_pos])
+                    self._freeze_slot()
+                    self._placeholder = None
+                    self._rendered = None
+                    self._segment_start = self._scan_pos
+            self._scan_pos = line_end + 1
+    
+    def _freeze_slot(self):
+        """通知后台任务画布该章节已定格，页面轮询时不再重发（st.empty() 无需处理）"""
+        freeze = getattr(self._placeholder, "freeze", None)
+        if freeze is not None:
+            freeze()
+    
+    def update(self, text: str):
+        self.text = text
+        self._split_chapters()
+        if time.monotonic() - self._last_render >= self._interval():
+            self._render(self._visible() + self.cursor)
+    
+    def flush(self):
+        """渲染最终文本并定格最后一章"""
+        super().flush()
+        if self._visible():
+            self._freeze_slot()
+
+
+def stream_to_container(prompt: str, system_prompt: str, container, thinking_container=None, status_container=None,
+                        text_callback=None, segmented: bool = False) -> tuple:
+    """
+    流式输出到Streamlit容器，实时显示打字效果，支持中止、错误展示和思考过程
+    
+    Args:
+        prompt: 用户输入的提示词
+        system_prompt: 系统提示词
+        container: Streamlit容器对象（如st.empty()或st.container()）
+        thinking_container: 用于显示思考过程的容器（可选）
+        status_container: 用于显示状态信息的容器（可选）
+        text_callback: 每收到一段正文后以当前完整文本调用（可选）
+        segmented: 是否按章节分段渲染（输出为策划案正文时使用）
+    
+    Returns:
+        tuple: (完整的响应文本, 是否成功, 错误信息)
+    """
+    full_response = ""
+    thinking_text = ""
+    error_msg = ""
+    was_stopped = False
+    was_queued = False
+    renderer = SegmentedStreamRenderer(container) if segmented else StreamRenderer(container)
+    thinking_renderer = StreamRenderer(thinking_container, template="💭 **模型思考中...**\n\n{text}",
+                                       cursor="") if thinking_container else None
+    
+    # 使用生成器进行流式输出
+    for chunk_data in call_gemini_stream(prompt, system_prompt, thinking_container):
+        chunk_type = chunk_data.get("type", "text")
+        chunk_content = chunk_data.get("content", "")
+        
+        if chunk_type == "text":
+            # 排队结束、开始输出后清除排队提示
+            if was_queued and status_container:
+                status_container.empty()
+                was_queued = False
+            full_response += chunk_content
+            # 实时更新显示内容，添加光标效果
+            renderer.update(full_response)
+            if text_callback:
+                text_callback(full_response)
+        elif chunk_type == "thinking":
+            thinking_text += chunk_content
+            # 显示思考过程
+            if thinking_renderer:
+                thinking_renderer.update(thinking_text)
+        elif chunk_type == "queue":
+            # 显示限流排队位置
+            was_queued = True
+            if status_container:
+                status_container.info(chunk_content)
+        elif chunk_type == "model":
+            # 显示模型降级信息
+            if status_container:
+                status_container.info(f"🔄 当前模型暂时不可用，已自动切换到 {chunk_content}")
+            else:
+                st.info(f"🔄 当前模型暂时不可用，已自动切换到 {chunk_content}")
+        elif chunk_type == "hedge":
+            # 对冲请求先返回（主请求只是较慢，并未失败）
+            if status_container:
+                status_container.info(f"⚡ 主请求响应较慢，已由对冲请求（{chunk_content}）输出")
+        elif chunk_type == "retry":
+            # 显示重试状态
+            if status_container:
+                status_container.warning(chunk_content)
+            else:
+                st.warning(chunk_content)
+        elif chunk_type == "error":
+            error_msg = chunk_content
+            if status_container:
+                status_container.error(f"❌ API调用失败: {error_msg}")
+            else:
+                st.error(f"❌ API调用失败: {error_msg}")
+            break
+        elif chunk_type == "stopped":
+            was_stopped = True
+            if status_container:
+                status_container.warning(f"⏹️ {chunk_content}")
+            break
+    
+    # 移除光标，显示最终结果（合帧期间积压的内容在此一次性输出）
+    if thinking_renderer:
+        thinking_renderer.flush()
+    if full_response:
+        renderer.flush()
+    
+    # 判断是否成功
+    success = bool(full_response) and not error_msg and not was_stopped
+    
+    return (full_response, success, error_msg)
+
+
+def stream_generator(prompt: str, system_prompt: str):
+    """
+    创建流式输出生成器，配合st.write_stream使用
+    
+    Args:
+        prompt: 用户输入的提示词
+        system_prompt: 系统提示词
+    
+    Yields:
+        文本片段
+    """
+    for chunk_data in call_gemini_stream(prompt, system_prompt):
+        if chunk_data.get("type") == "text":
+            yield chunk_data.get("content", "")
+
+
+def generate_prd(user_input: str, use_stream: bool = False, container=None, thinking_container=None, status_container=None,
+                 text_callback=None) -> tuple:
+    """
+    功能模块1：生成策划案（支持流式输出）
+    
+    Args:
+        user_input: 用户输入的功能描述
+        use_stream: 是否使用流式输出
+        container: Streamlit容器对象，用于流式显示
+        thinking_container: 用于显示思考过程的容器
+        status_container: 用于显示状态信息的容器
+        text_callback: 流式输出时的文本回调（如边生成边复检）
+    
+    Returns:
+        tuple: (生成的策划案文本, 是否成功, 错误信息)
+    """
+    prompt = f"请根据以下功能描述生成完整的策划案：\n\n{user_input}"
+    
+    if use_stream and container:
+        return stream_to_container(prompt, get_system_prompt_with_date(GENERATE_PRD_SYSTEM_PROMPT), container, thinking_container, status_container,
+                                   text_callback=text_callback, segmented=True)
+    else:
+        result = call_gemini(prompt, get_system_prompt_with_date(GENERATE_PRD_SYSTEM_PROMPT))
+        return (result, result is not None, st.session_state.last_error if not result else "")
+
+
+def format_prd_outline(outline: dict) -> str:
+    """
+    将大纲格式化为文本（作为各章节撰写时的共享上下文）
+    
+    Args:
+        outline: generate_prd_outline 返回的大纲
+    
+    Returns:
+        str: 大纲文本
+    """
+    lines = [f"策划案标题：{outline['title']}", "", "【全局关键信息】"]
+    lines += [f"- {fact}" for fact in outline["facts"]]
+    for number, chapter in enumerate(outline["chapters"], 1):
+        lines += ["", f"【{number}、{chapter['title']}】"]
+        lines += [f"- {point}" for point in chapter["points"]]
+    return "\n".join(lines)
+
+
+def generate_prd_outline(user_input: str) -> dict:
+    """
+    快速生成第一步：生成结构化大纲（不启用思考，一次非流式调用）
+    
+    模型返回的章节数与标准章节不一致时，按标准章节对齐：标题以 PRD_STANDARD_CHAPTERS 为准，缺少的章节要点为空。
+    
+    Args:
+        user_input: 用户输入的功能描述
+    
+    Returns:
+        dict: {"title": str, "facts": [str], "chapters": [{"title": str, "points": [str]}]}（固定10章）
+    
+    Raises:
+        ValueError: 大纲不是合法的JSON
+    """
+    prompt = f"请为以下功能描述拟定策划案大纲：\n\n{user_input}"
+    ctx = get_call_context()
+    response = run_async(_generate_async(prompt, PRD_OUTLINE_SYSTEM_PROMPT, ctx, response_schema=PRD_OUTLINE_SCHEMA))
+    apply_model_used(ctx)
+    try:
+        data = json.loads(response)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"大纲格式错误: {e}")
+    chapters = data.get("chapters") or []
+    return {
+        "title": str(data.get("title") or "策划案").strip(),
+        "facts": [str(fact).strip() for fact in data.get("facts") or []],
+        "chapters": [
+            {
+                "title": title,
+                "points": [str(point).strip() for point in (chapters[i].get("points") or [])] if i < len(chapters) else [],
+            }
+            for i, (title, _) in enumerate(PRD_STANDARD_CHAPTERS)
+        ],
+    }
+
+
+async def expand_prd_chapters_async(user_input: str, outline: dict, ctx: dict) -> AsyncGenerator[dict, None]:
+    """
+    快速生成第二步：按大纲并发撰写各章节，多路流式输出合并为一路
+    
+    Args:
+        user_input: 用户输入的功能描述
+        outline: generate_prd_outline 返回的大纲
+        ctx: get_call_context() 返回的调用参数
+    
+    Yields:
+        dict: {"type": "item", "content": (章节编号, chunk)}，chunk 为流式协议的 dict，
+              某章结束时 chunk 为 None
+    """
+    outline_text = format_prd_outline(outline)
+    system_prompt = get_system_prompt_with_date(PRD_CHAPTER_SYSTEM_PROMPT)
+    chunk_queue = asyncio.Queue()
+    
+    async def expand(number: int, title: str):
+        prompt = f"""【功能描述】
+{user_input}
+
+【策划案大纲】
+{outline_text}
+
+请撰写第{number}章「{title}」，从一级标题“{number}、{title}”开始，只输出本章。"""
+        try:
+            async for chunk in call_gemini_stream_async(prompt, system_prompt, ctx):
+                await chunk_queue.put((number, chunk))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await chunk_queue.put((number, {"type": "error", "content": str(e)}))
+        await chunk_queue.put((number, None))
+    
+    tasks = [
+        asyncio.ensure_future(expand(number, chapter["title"]))
+        for number, chapter in enumerate(outline["chapters"], 1)
+    ]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            number, chunk = await chunk_queue.get()
+            if chunk is None:
+                remaining -= 1
+            yield {"type": "item", "content": (number, chunk)}
+    finally:
+        # 消费方提前退出时取消尚未完成的章节
+        for task in tasks:
+            task.cancel()
+
+
+def normalize_prd_chapter(number: int, title: str, text: str) -> str:
+    """章节正文没有以本章一级标题开头时补上标题（保证 format_prd_content 和章节切分能识别）"""
+    text = text.strip()
+    first_line = text.split("\n")[0] if text else ""
+    if get_display_chapter_number(first_line) != number:
+        text = f"{number}、{title}\n\n{text}"
+    return text
+
+
+def assemble_fast_prd(outline: dict, chapter_texts: dict, writing: Optional[set] = None) -> str:
+    """
+    按章节顺序拼接快速生成的策划案
+    
+    Args:
+        outline: 大纲
+        chapter_texts: 章节编号 -> 已生成的正文
+        writing: 正在撰写的章节编号（在其末尾显示光标，尚无内容的章节显示占位提示）；为None时表示最终结果
+    
+    Returns:
+        str: 策划案全文
+    """
+    parts = [f"{outline['title']}", f"创建日期：{datetime.now().strftime('%Y-%m-%d')}"]
+    for number, chapter in enumerate(outline["chapters"], 1):
+        text = chapter_texts.get(number, "")
+        if writing is None or text.strip():
+            body = normalize_prd_chapter(number, chapter["title"], text)
+            parts.append(body + (" ▌" if writing and number in writing else ""))
+        else:
+            parts.append(f"{number}、{chapter['title']}\n\n⏳ 撰写中...")
+    return "\n\n".join(parts)
+
+
+def generate_prd_fast(user_input: str, container, status_container=None, text_callback=None) -> tuple:
+    """
+    快速生成策划案：先生成结构化大纲，再按大纲并发撰写10个章节，按顺序拼接
+    
+    总耗时约为一次大纲调用加最长章节的撰写时间；页面以 render_prd_document 的样式展示，
+    各章节在文档中各自的位置上流式写入。
+    
+    Args:
+        user_input: 用户输入的功能描述
+        container: Streamlit容器对象，用于显示文档
+        status_container: 用于显示状态信息的容器（可选）
+        text_callback: 以按顺序已完成的章节拼接的文本调用（如边生成边复检），文本只会向后增长
+    
+    Returns:
+        tuple: (生成的策划案文本, 是否成功, 错误信息)
+    """
+    state = get_run_state()
+    state.last_error = ""
+    state.last_model_used = get_call_context()["model"]
+    token = get_cancel_token()
+    if status_container:
+        status_container.info("🗂️ 正在拟定大纲...")
+    try:
+        outline = generate_prd_outline(user_input)
+    except Exception as e:
+        if state.should_stop:
+            if status_container:
+                status_container.warning(f"⏹️ 用户已中止生成{format_consumed_tokens(token)}")
+            return ("", False, "")
+        state.last_error = str(e)
+        if status_container:
+            status_container.error(f"❌ 大纲生成失败: {e}")
+        return ("", False, f"大纲生成失败: {e}")
+    
+    renderer = PrdDocumentRenderer(container, title=outline["title"], cursor="")
+    chapter_texts = {}
+    writing = set(range(1, len(outline["chapters"]) + 1))
+    chapter_errors = {}
+    done_prefix = 0  # 按顺序已完成的章节数（用于文本回调）
+    renderer.update(assemble_fast_prd(outline, chapter_texts, writing))
+    
+    stream = expand_prd_chapters_async(user_input, outline, get_call_context())
+    for chunk_data in get_async_engine().stream(stream, token):
+        if state.should_stop:
+            break
+        number, chunk = chunk_data["content"]
+        if chunk is None:
+            writing.discard(number)
+            # 文本回调只接收按顺序连续完成的章节，保证文本只向后增长
+            while done_prefix < len(outline["chapters"]) and done_prefix + 1 not in writing:
+                done_prefix += 1
+                if text_callback and not chapter_errors:
+                    done = {n: chapter_texts.get(n, "") for n in range(1, done_prefix + 1)}
+                    prefix = assemble_fast_prd(dict(outline, chapters=outline["chapters"][:done_prefix]), done)
+                    text_callback(prefix + "\n\n")
+        elif chunk["type"] == "text":
+            chapter_texts[number] = chapter_texts.get(number, "") + chunk["content"]
+        elif chunk["type"] == "error":
+            chapter_errors[number] = chunk["content"]
+            state.last_error = chunk["content"]
+        elif chunk["type"] in ("model", "hedge"):
+            state.last_model_used = chunk["content"]
+        elif chunk["type"] in ("retry", "queue") and status_container:
+            status_container.info(f"第{number}章：{chunk['content']}")
+            continue
+        else:
+            continue
+        if status_container:
+            finished = len(outline["chapters"]) - len(writing)
+            status_container.info(f"⚡ 各章节并行撰写中：{finished}/{len(outline['chapters'])} 章已完成")
+        renderer.update(assemble_fast_prd(outline, chapter_texts, writing))
+    
+    if state.should_stop:
+        result = assemble_fast_prd(outline, chapter_texts) if chapter_texts else ""
+        renderer.text = result
+        renderer.flush()
+        if status_container:
+            status_container.warning(f"⏹️ 用户已中止生成{format_consumed_tokens(token)}")
+        return (result, False, "")
+    
+    result = assemble_fast_prd(outline, chapter_texts)
+    renderer.text = result
+    renderer.flush()
+    if chapter_errors:
+        failed = "、".join(f"第{number}章" for number in sorted(chapter_errors))
+        error_msg = f"{failed}撰写失败: {chapter_errors[min(chapter_errors)]}"
+        if status_container:
+            status_container.error(f"❌ {error_msg}")
+        return (result, False, error_msg)
+    if status_container:
+        status_container.empty()
+    return (result, True, "")
+
+
+def ai_self_check(prd_content: str, use_stream: bool = False, container=None, thinking_container=None, status_container=None,
+                  parallel: Optional[bool] = None) -> tuple:
+    """
+    AI自检功能：对策划案进行复检清单检查（支持流式输出）
+    
+    Args:
+        prd_content: 策划案内容
+        use_stream: 是否使用流式输出
+        container: Streamlit容器对象，用于流式显示
+        thinking_container: 用于显示思考过程的容器
+        status_container: 用于显示状态信息的容器
+        parallel: 是否逐项并行检查（默认跟随侧边栏设置）
+    
+    Returns:
+        tuple: (检查结果报告, 是否成功, 错误信息)
+    """
+    if parallel is None:
+        parallel = st.session_state.get("parallel_self_check", True)
+    if parallel:
+        return ai_self_check_parallel(prd_content, container if use_stream else None, status_container)
+    
+    # 本地规则能判定的条目直接写入报告开头，模型只检查其余条目
+    local_results = local_self_check(prd_content)
+    pending_items = [item for item in SELF_CHECK_ITEMS if item["id"] not in local_results]
+    if not pending_items:
+        report = format_self_check_report(local_results)
+        if use_stream and container:
+            container.markdown(report)
+        return (report, True, "")
+    
+    if local_results:
+        local_items = [item for item in SELF_CHECK_ITEMS if item["id"] in local_results]
+        local_report = format_self_check_report(local_results, final=False, items=local_items).strip()
+        item_list = "\n".join(f"{item['id']}. {item['name']}" for item in pending_items)
+        prompt = f"""请对以下策划案进行复检清单检查，只检查以下条目（其余条目已由本地规则检查，不要重复输出）：
+{item_list}
+
+{prd_content}
+
+请逐一检查上述每一项，给出详细的检查结果。"""
+    else:
+        local_report = ""
+        prompt = f"""请对以下策划案进行复检清单检查：
+
+{prd_content}
+
+请逐一检查每一项，给出详细的检查结果。"""
+    
+    if use_stream and container:
+        if local_report:
+            parent = container.container()
+            parent.markdown(local_report)
+            container = parent.empty()
+        result, success, error = stream_to_container(prompt, SELF_CHECK_SYSTEM_PROMPT, container, thinking_container,
+                                                     status_container)
+    else:
+        result = call_gemini(prompt, SELF_CHECK_SYSTEM_PROMPT)
+        success, error = result is not None, st.session_state.last_error if not result else ""
+    if success and local_report:
+        result = f"{local_report}\n\n{result}"
+    return (result, success, error)
+
+
+async def check_self_check_item_async(prd_content: str, item: dict, ctx: dict) -> dict:
+    """
+    异步检查单个复检清单条目
+    
+    Args:
+        prd_content: 策划案内容
+        item: SELF_CHECK_ITEMS 中的条目
+        ctx: get_call_context() 返回的调用参数
+    
+    Returns:
+        dict: {"id", "name", "verdict", "suggestion", "error"}，失败时 verdict 为空、error 为错误信息
+    """
+    prompt = f"""请检查以下策划案是否满足复检清单第{item['id']}项：{item['name']}
+
+{prd_content}"""
+    result = {"id": item["id"], "name": item["name"], "verdict": "", "suggestion": "", "error": ""}
+    try:
+        response = await _generate_async(prompt, SELF_CHECK_ITEM_SYSTEM_PROMPT, ctx, response_schema=SELF_CHECK_ITEM_SCHEMA)
+        data = json.loads(response)
+        if data.get("verdict") not in SELF_CHECK_VERDICT_LABELS:
+            raise ValueError(f"无效的检查结论: {data.get('verdict')}")
+        result["verdict"] = data["verdict"]
+        result["suggestion"] = str(data.get("suggestion", "")).strip()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+async def self_check_parallel_async(prd_content: str, ctx: dict, items: Optional[list] = None) -> AsyncGenerator[dict, None]:
+    """
+    并发检查复检清单条目，按完成顺序产出结果
+    
+    Args:
+        prd_content: 策划案内容
+        ctx: get_call_context() 返回的调用参数
+        items: 需要检查的条目（默认全部）
+    
+    Yields:
+        dict: {"type": "item", "content": check_self_check_item_async 的结果}
+    """
+    tasks = [
+        asyncio.ensure_future(check_self_check_item_async(prd_content, item, ctx))
+        for item in (items or SELF_CHECK_ITEMS)
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield {"type": "item", "content": await next_done}
+    finally:
+        # 消费方提前退出时取消尚未完成的检查
+        for task in tasks:
+            task.cancel()
+
+
+def format_self_check_report(results: dict, final: bool = True, items: Optional[list] = None) -> str:
+    """
+    将逐项检查结果合并为复检报告（与整体复检的报告格式一致）
+    
+    Args:
+        results: {条目编号: 检查结果}
+        final: 是否为最终报告（非最终报告中未完成的条目显示为检查中）
+        items: 只输出这些条目（默认全部）
+    
+    Returns:
+        str: Markdown格式的复检报告
+    """
+    lines = []
+    for item in items or SELF_CHECK_ITEMS:
+        result = results.get(item["id"])
+        lines.append(f"**{item['id']}. {item['name']}**")
+        if result is None:
+            lines.append("- 判断：⏳ 检查中..." if not final else "- 判断：未检查")
+        elif result["error"]:
+            lines.append(f"- 判断：检查失败（{result['error'][:80]}）")
+        else:
+            lines.append(f"- 判断：{SELF_CHECK_VERDICT_LABELS[result['verdict']]}")
+            if result["suggestion"]:
+                label = "依据" if result["verdict"] == "pass" else "建议"
+                if result.get("local"):
+                    label += "（本地规则）"
+                lines.append(f"- {label}：{result['suggestion']}")
+        lines.append("")
+    
+    if final:
+        counts = {verdict: 0 for verdict in SELF_CHECK_VERDICT_LABELS}
+        for result in results.values():
+            if result["verdict"]:
+                counts[result["verdict"]] += 1
+        lines.append("---")
+        lines.append("**总体评价**")
+        lines.append(
+            f"- 通过 {counts['pass']} 项 / 部分满足 {counts['partial']} 项 / 缺失 {counts['missing']} 项"
+        )
+        # 优先改进建议：缺失项在前，部分满足项在后
+        priority = sorted(
+            (r for r in results.values() if r["verdict"] in ("missing", "partial")),
+            key=lambda r: (r["verdict"] != "missing", r["id"])
+        )
+        if priority:
+            lines.append("")
+            lines.append("**优先改进建议**")
+            for idx, result in enumerate(priority, 1):
+                emoji = SELF_CHECK_VERDICT_LABELS[result["verdict"]].split(" ")[0]
+                lines.append(f"{idx}. {emoji} 第{result['id']}项 {result['name']}：{result['suggestion']}")
+    
+    return "\n".join(lines)
+
+
+def find_prd_section_body(prd_content: str, title: str) -> Optional[str]:
+    """
+    按标题查找章节（忽略编号和 ** / # 标记），返回去掉标题行的正文
+    
+    Returns:
+        str: 章节正文；找不到该章节时返回None
+    """
+    for number, text in split_prd_sections(prd_content):
+        if not number:
+            continue
+        lines = text.strip().split("\n")
+        heading = re.sub(r'\*\*', '', lines[0]).lstrip('#').strip()
+        if title in heading:
+            return "\n".join(lines[1:]).strip()
+    return None
+
+
+def _local_check_item(item_id: int, body: str) -> tuple:
+    """
+    单个条目的本地规则（只处理明确通过或明确不满足的情况）
+    
+    Args:
+        item_id: 复检条目编号
+        body: 对应章节的正文
+    
+    Returns:
+        tuple: (verdict, 依据)，无法确定时 verdict 为None
+    """
+    lines = [re.sub(r'\*\*', '', line).strip() for line in body.split("\n") if line.strip()]
+    if not lines:
+        return ("missing", "章节存在但没有正文")
+    listed = sum(1 for line in lines if LOCAL_SELF_CHECK_LIST_PATTERN.match(line))
+    if item_id == 1:
+        text = "".join(lines)
+        sentences = [s for line in lines for s in re.split(r'[。！？!?；;]', line) if s.strip()]
+        if len(sentences) == 1 and len(text) <= LOCAL_SELF_CHECK_SUMMARY_CHARS:
+            return ("pass", f"功能概述为一句话：{text[:60]}")
+    elif item_id == 8:
+        metrics = sum(1 for line in lines if LOCAL_SELF_CHECK_METRIC_PATTERN.search(line))
+        if metrics >= 3:
+            return ("pass", f"验收标准中有 {metrics} 条含量化指标")
+        if metrics == 0:
+            return ("partial", "验收标准中没有量化指标，建议为每条标准补充数值、比例或时限（如成功率不低于95%、响应时间3秒以内）")
+    elif item_id in (9, 10):
+        if listed >= 2:
+            return ("pass", f"章节逐条列出了 {listed} 项内容")
+    return (None, "")
+
+
+def local_self_check(prd_content: str, items: Optional[list] = None, allow_missing: bool = True) -> dict:
+    """
+    本地规则预检：按章节结构确定性地判定明显通过或明显缺失的条目（毫秒级，不调用模型）
+    
+    只处理 LOCAL_SELF_CHECK_SECTIONS 中能按结构判断的条目，判断不了的条目留给模型检查。
+    
+    Args:
+        prd_content: 策划案内容
+        items: 需要预检的条目（默认全部）
+        allow_missing: 是否允许判定“缺失”（边生成边复检时文本尚不完整，只接受“通过”）
+    
+    Returns:
+        dict: {条目编号: 检查结果}，结果格式与 check_self_check_item_async 一致，并带 local=True
+    """
+    results = {}
+    for item in items or SELF_CHECK_ITEMS:
+        title = LOCAL_SELF_CHECK_SECTIONS.get(item["id"])
+        if title is None:
+            continue
+        body = find_prd_section_body(prd_content, title)
+        if body is None:
+            # 章节结构没识别出来但正文提到了该标题时交给模型判断
+            if title in prd_content:
+                continue
+            verdict, reason = "missing", f"策划案中没有「{title}」章节"
+        else:
+            verdict, reason = _local_check_item(item["id"], body)
+        if verdict is None or (verdict != "pass" and not allow_missing):
+            continue
+        results[item["id"]] = {"id": item["id"], "name": item["name"], "verdict": verdict,
+                               "suggestion": reason, "error": "", "local": True}
+    return results
+
+
+def ai_self_check_parallel(prd_content: str, container=None, status_container=None) -> tuple:
+    """
+    并行复检：10个清单条目同时检查，结果合并为完整报告
+    
+    Args:
+        prd_content: 策划案内容
+        container: Streamlit容器对象，用于实时显示已完成的条目（可选）
+        status_container: 用于显示状态信息的容器（可选）
+    
+    Returns:
+        tuple: (检查结果报告, 是否成功, 错误信息)
+    """
+    state = get_run_state()
+    state.last_error = ""
+    # 本地规则能判定的条目不再调用模型
+    results = local_self_check(prd_content)
+    pending_items = [item for item in SELF_CHECK_ITEMS if item["id"] not in results]
+    was_stopped = False
+    if not pending_items:
+        return _finish_self_check(results, was_stopped, container, status_container)
+    if get_gemini_client() is None:
+        return ("", False, "API客户端初始化失败，请检查API Key")
+    if container and results:
+        container.markdown(format_self_check_report(results, final=False))
+    
+    ctx = get_call_context()
+    for chunk_data in get_async_engine().stream(self_check_parallel_async(prd_content, ctx, pending_items),
+                                                get_cancel_token()):
+        # 检查是否需要中止（退出循环时后台检查会被取消）
+        if state.should_stop:
+            was_stopped = True
+            state.should_stop = False
+            if status_container:
+                status_container.warning("⏹️ 检查已中止")
+            break
+        if chunk_data.get("type") != "item":
+            continue
+        result = chunk_data["content"]
+        results[result["id"]] = result
+        if container:
+            container.markdown(format_self_check_report(results, final=False))
+        if status_container:
+            status_container.info(f"🔍 并行复检进度：{len(results)}/{len(SELF_CHECK_ITEMS)}"
+                                  f"（{len(SELF_CHECK_ITEMS) - len(pending_items)} 项由本地规则判定）")
+    
+    apply_model_used(ctx)
+    return _finish_self_check(results, was_stopped, container, status_container)
+
+
+def _finish_self_check(results: dict, was_stopped: bool, container=None, status_container=None) -> tuple:
+    """
+    合并逐项检查结果并生成最终报告
+    
+    Returns:
+        tuple: (检查结果报告, 是否成功, 错误信息)
+    """
+    report = format_self_check_report(results)
+    if container:
+        container.markdown(report)
+    
+    failed = [r for r in results.values() if r["error"]]
+    if was_stopped:
+        return (report, False, "")
+    if not results or len(failed) == len(results):
+        error_msg = failed[0]["error"] if failed else "复检未返回结果"
+        get_run_state().last_error = error_msg
+        return ("", False, error_msg)
+    if failed and status_container:
+        status_container.warning(f"⚠️ {len(failed)} 项检查失败，其余结果已合并")
+    elif status_container:
+        status_container.empty()
+    return (report, True, "")
+
+
+class SelfCheckPipeline:
+    """
+    边生成边复检
+    
+    策划案流式生成时逐行识别一级标题（章节），某个章节写完（出现下一章标题）后，
+    依赖章节已全部就绪的复检条目立即提交到后台并行检查；生成结束时提交剩余条目。
+    提交前先做本地规则预检，能判定的条目不再调用模型（生成过程中只接受“通过”）。
+    实例由生成策划案的后台任务持有，生成结束后在同一任务中收集结果。
+    """
+    
+    def __init__(self, ctx: dict):
+        self.ctx = ctx
+        self.futures = {}  # 条目编号 -> concurrent.futures.Future
+        self.local_results = {}  # 本地规则已判定的条目：条目编号 -> 检查结果
+        self.early_submitted = 0  # 生成结束前已提交的条目数
+        self._scan_pos = 0  # 已扫描的完整行末尾位置
+        self._current_chapter = 0
+        self._separator = None  # 第一章标题使用的分隔符（、或 .），后续章节需保持一致
+    
+    def _submit(self, prd_text: str, completed_chapter: Optional[int] = None):
+        """提交依赖章节已全部完成的条目（completed_chapter 为None时提交全部剩余条目）"""
+        engine = get_async_engine()
+        for item in SELF_CHECK_ITEMS:
+            if item["id"] in self.futures or item["id"] in self.local_results:
+                continue
+            if completed_chapter is not None and max(item["chapters"]) > completed_chapter:
+                continue
+            local = local_self_check(prd_text, [item], allow_missing=completed_chapter is None)
+            if local:
+                self.local_results.update(local)
+                continue
+            self.futures[item["id"]] = engine.submit(check_self_check_item_async(prd_text, item, self.ctx))
+            if completed_chapter is not None:
+                self.early_submitted += 1
+    
+    def feed(self, full_text: str):
+        """
+        接收当前已生成的完整文本（stream_to_container 的文本回调）
+        
+        Args:
+            full_text: 截至目前的策划案全文
+        """
+        end = full_text.rfind("\n")
+        while self._scan_pos <= end:
+            line_end = full_text.index("\n", self._scan_pos)
+            line_start = self._scan_pos
+            self._scan_pos = line_end + 1
+            line = full_text[line_start:line_end].strip()
+            chapter = get_prd_chapter_number(line)
+            # 只认连续递增且分隔符一致的章节号，避免正文中的编号列表被误判为章节
+            if chapter != self._current_chapter + 1:
+                continue
+            separator = line[len(str(chapter))]
+            if self._separator is None:
+                self._separator = separator
+            elif separator != self._separator:
+                continue
+            if self._current_chapter > 0:
+                self._submit(full_text[:line_start], self._current_chapter)
+            self._current_chapter = chapter
+    
+    def finish(self, prd_content: str):
+        """生成结束：剩余条目基于完整策划案提交检查"""
+        self._submit(prd_content)
+    
+    def cancel(self):
+        """取消所有未完成的检查"""
+        for future in self.futures.values():
+            future.cancel()
+    
+    def collect(self, container=None, status_container=None) -> tuple:
+        """
+        等待所有条目检查完成并合并报告，支持中止
+        
+        Returns:
+            tuple: (检查结果报告, 是否成功, 错误信息)
+        """
+        state = get_run_state()
+        state.last_error = ""
+        results = dict(self.local_results)
+        was_stopped = False
+        pending = set(self.futures.values())
+        if container and results:
+            container.markdown(format_self_check_report(results, final=False))
+        item_ids = {future: item_id for item_id, future in self.futures.items()}
+        while pending:
+            if state.should_stop:
+                was_stopped = True
+                state.should_stop = False
+                self.cancel()
+                if status_container:
+                    status_container.warning("⏹️ 检查已中止")
+                break
+            done, pending = concurrent.futures.wait(pending, timeout=0.2, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.cancelled():
+                    continue
+                try:
+                    results[item_ids[future]] = future.result()
+                except Exception as e:
+                    item = SELF_CHECK_ITEMS[item_ids[future] - 1]
+                    results[item["id"]] = {"id": item["id"], "name": item["name"], "verdict": "", "suggestion": "", "error": str(e)}
+            if done:
+                if container:
+                    container.markdown(format_self_check_report(results, final=False))
+                if status_container:
+                    status_container.info(
+                        f"🔍 并行复检进度：{len(results)}/{len(SELF_CHECK_ITEMS)}"
+                        f"（{self.early_submitted} 项在生成过程中已提前开始，{len(self.local_results)} 项由本地规则判定）"
+                    )
+        apply_model_used(self.ctx)
+        return _finish_self_check(results, was_stopped, container, status_container)
+
+
+def optimize_prd_initial(old_prd: str, feedback: str, use_stream: bool = False, container=None, thinking_container=None, status_container=None) -> tuple:
+    """
+    优化策划案 - 初始修正（支持流式输出）
+    
+    Args:
+        old_prd: 旧策划案
+        feedback: 用户的修改意见
+        use_stream: 是否使用流式输出
+        container: Streamlit容器对象，用于流式显示
+        thinking_container: 用于显示思考过程的容器
+        status_container: 用于显示状态信息的容器
+    
+    Returns:
+        tuple: (初步修正后的策划案, 是否成功, 错误信息)
+    """
+    prompt = f"""【旧策划案】
+{old_prd}
+
+【用户修改意见】
+{feedback if feedback else "无特别意见，请根据复检清单进行检查和完善"}
+
+请根据复检清单检查旧案，结合用户意见进行修改和填补。"""
+    
+    if use_stream and container:
+        return stream_to_container(prompt, INITIAL_FIX_SYSTEM_PROMPT, container, thinking_container, status_container,
+                                   segmented=True)
+    else:
+        result = call_gemini(prompt, INITIAL_FIX_SYSTEM_PROMPT)
+        return (result, result is not None, st.session_state.last_error if not result else "")
 
 
-def call_gemini_with_image_stream(image_data: bytes, prompt: str, system_prompt: str = "", mime_type: str = "image/png", thinking_container=None) -> Generator[dict, None, None]:
+def developer_review(current_prd: str, use_stream: bool = False, container=None, thinking_container=None,
+                     status_container=None, reviewed_prd: str = "", personas: Optional[list] = None) -> tuple:
     """
-    流式调用Gemini API处理图片，支持中止、错误展示和自动重试
+    开发人员角色审查策划案（支持流式输出）
+    
+    传入上一轮审查过的版本时进行增量审查：未修改的章节只发送标题和摘要，修改或新增的章节发送全文
+    （见 build_review_digest）；修改范围过大时仍发送全文。
+    指定审查团角色时各角色并发审查，合并去重后作为本轮问题（见 developer_review_panel）。
     
     Args:
-        image_data: 图片的字节数据
-        prompt: 用户输入的提示词
-        system_prompt: 系统提示词
-        mime_type: 图片的MIME类型
-        thinking_container: 用于显示思考过程的容器（可选）
+        current_prd: 当前版本的策划案
+        use_stream: 是否使用流式输出
+        container: Streamlit容器对象，用于流式显示
+        thinking_container: 用于显示思考过程的容器
+        status_container: 用于显示状态信息的容器
+        reviewed_prd: 上一轮审查过的策划案（为空时审查全文）
+        personas: 审查团角色（REVIEW_PERSONAS 的键，为空时由单个通用开发人员审查）
     
-    Yields:
-        dict: {"type": "text"|"thinking"|"error"|"retry", "content": str}
+    Returns:
+        tuple: (开发人员提出的问题列表, 是否成功, 错误信息)
     """
-    # 清空之前的错误
-    st.session_state.last_error = ""
-    st.session_state.thinking_content = ""
+    digest = build_review_digest(reviewed_prd, current_prd) if reviewed_prd else None
+    if digest:
+        prompt = f"""以下策划案上一轮已审查过，本轮只修改了部分章节。
+
+【未修改的章节】（上一轮已审查，仅列出标题和摘要）
+{digest["unchanged"]}
+
+【本轮修改或新增的章节】（完整内容）
+{digest["changed"]}
+
+请重点审查修改或新增的章节，并结合其他章节的摘要检查前后是否一致，提出你的问题和疑虑。"""
+        if status_container:
+            status_container.info(
+                f"📑 增量审查：{digest['changed_count']}/{digest['total_count']} 章有修改，"
+                f"发送 {len(prompt)} 字（全文 {len(current_prd)} 字）"
+            )
+    else:
+        prompt = f"""请审查以下策划案，提出你的问题和疑虑：
+
+{current_prd}"""
+    
+    if personas and use_stream and container:
+        return developer_review_panel(prompt, personas, container, status_container)
+    if use_stream and container:
+        return stream_to_container(prompt, DEVELOPER_REVIEW_PROMPT, container, thinking_container, status_container)
+    else:
+        result = call_gemini(prompt, DEVELOPER_REVIEW_PROMPT)
+        return (result, result is not None, st.session_state.last_error if not result else "")
+
+
+def split_prd_sections(prd_content: str) -> list:
+    """
+    按一级标题（章节）切分策划案
     
-    # 重试配置
-    max_retries = 3
-    retry_delay = 5
-    retryable_errors = ["503", "429", "overloaded", "UNAVAILABLE", "RESOURCE_EXHAUSTED", "rate limit"]
+    只认连续递增且分隔符一致的章节号，避免正文中的编号列表被误判为章节；代码块内的行不参与判断。
     
-    for attempt in range(max_retries):
-        try:
-            client = get_gemini_client()
-            if client is None:
-                yield {"type": "error", "content": "API客户端初始化失败，请检查API Key"}
-                return
-            
-            # 构建配置
-            config = types.GenerateContentConfig(
-                system_instruction=system_prompt if system_prompt else None,
-                thinking_config=types.ThinkingConfig(
-                    thinking_budget=10000
-                ) if "2.5" in get_selected_model() or "think" in get_selected_model().lower() else None
-            )
-            
-            # 构建包含图片的内容
-            contents = [
-                types.Part.from_bytes(data=image_data, mime_type=mime_type),
-                prompt
-            ]
-            
-            # 使用流式API
-            response_stream = client.models.generate_content_stream(
-                model=get_selected_model(),
-                contents=contents,
-                config=config
-            )
-            
-            for chunk in response_stream:
-                # 检查是否需要中止
-                if st.session_state.should_stop:
-                    yield {"type": "stopped", "content": "用户已中止生成"}
-                    st.session_state.should_stop = False
-                    return
-                
-                # 处理思考过程（如果有）
-                if hasattr(chunk, 'candidates') and chunk.candidates:
-                    for candidate in chunk.candidates:
-                        if hasattr(candidate, 'content') and candidate.content:
-                            for part in candidate.content.parts:
-                                # 检查是否是思考内容 - thought 属性直接包含思考文本
-                                thinking_text = ""
-                                
-                                # thought 属性直接包含思考文本
-                                if hasattr(part, 'thought') and part.thought:
-                                    thinking_text = part.thought
-                                
-                                if thinking_text:
-                                    st.session_state.thinking_content += thinking_text
-                                    yield {"type": "thinking", "content": thinking_text}
-                                elif hasattr(part, 'text') and part.text:
-                                    yield {"type": "text", "content": part.text}
-                elif chunk.text:
-                    yield {"type": "text", "content": chunk.text}
-            
-            return
-                    
-        except Exception as e:
-            error_msg = str(e)
-            st.session_state.last_error = error_msg
-            
-            is_retryable = any(err_key in error_msg for err_key in retryable_errors)
-            
-            if is_retryable and attempt < max_retries - 1:
-                remaining = max_retries - attempt - 1
-                yield {
-                    "type": "retry", 
-                    "content": f"⚠️ 服务暂时不可用 ({error_msg[:50]}...)，{retry_delay}秒后自动重试（剩余{remaining}次）..."
-                }
-                time.sleep(retry_delay)
-                retry_delay = min(retry_delay * 2, 30)
-                continue
-            else:
-                yield {"type": "error", "content": error_msg}
-                return
+    Returns:
+        list: [(章节编号, 章节全文)]，第一个章节标题之前的内容编号为0（为空时省略）
+    """
+    document = parse_prd(prd_content)
+    raw_lines = [line.raw for line in document.lines]
+    return [
+        (number, "\n".join(raw_lines[start:end])) for number, start, end in document.chapters()
+        if number or any(line.stripped for line in document.lines[start:end])
+    ]
 
+# 补丁块的开始和结束标记（PLANNER_PATCH_PROMPT 约定的格式）
+PRD_PATCH_START_PATTERN = re.compile(r'^<<<\s*(REPLACE|ADD)\s+(\d+)\s*>>>$')
+PRD_PATCH_END = "<<<END>>>"
 
-def call_gemini_stream(prompt: str, system_prompt: str = "", thinking_container=None) -> Generator[dict, None, None]:
+
+def parse_prd_patch(patch_text: str) -> list:
     """
-    流式调用Gemini API，支持中止、错误展示、思考过程和自动重试
+    解析补丁模式的输出
+    
+    Returns:
+        list: [(操作 REPLACE|ADD, 章节编号, 章节全文)]
+    
+    Raises:
+        ValueError: 补丁块不完整或没有补丁
+    """
+    patches = []
+    current = None
+    for line in patch_text.split("\n"):
+        stripped = line.strip()
+        match = PRD_PATCH_START_PATTERN.match(stripped)
+        if match:
+            if current is not None:
+                raise ValueError(f"第 {current[1]} 章的补丁缺少结束标记")
+            current = (match.group(1), int(match.group(2)), [])
+        elif stripped == PRD_PATCH_END:
+            if current is None:
+                raise ValueError("结束标记前缺少开始标记")
+            patches.append((current[0], current[1], "\n".join(current[2]).strip("\n")))
+            current = None
+        elif current is not None:
+            current[2].append(line)
+    if current is not None:
+        raise ValueError(f"第 {current[1]} 章的补丁缺少结束标记")
+    if not patches:
+        raise ValueError("输出中没有补丁块")
+    return patches
+
+
+def apply_prd_patch(prd_content: str, patches: list) -> str:
+    """
+    将补丁应用到策划案的章节上并校验结果
     
     Args:
-        prompt: 用户输入的提示词
-        system_prompt: 系统提示词
-        thinking_container: 用于显示思考过程的容器（可选）
+        prd_content: 当前策划案
+        patches: parse_prd_patch 的结果
     
-    Yields:
-        dict: {"type": "text"|"thinking"|"error"|"retry", "content": str}
+    Returns:
+        str: 应用补丁后的策划案（章节之间统一空一行）
+    
+    Raises:
+        ValueError: 补丁与现有章节不匹配，或应用后的章节结构不完整
     """
-    # 清空之前的错误
-    st.session_state.last_error = ""
-    st.session_state.thinking_content = ""
+    chapters = dict(split_prd_sections(prd_content))
+    last_chapter = max(chapters)
+    for action, number, content in patches:
+        first_line = next((line for line in content.split("\n") if line.strip()), "")
+        if get_display_chapter_number(first_line) != number:
+            raise ValueError(f"第 {number} 章的补丁没有以该章标题开头")
+        if action == "REPLACE" and (number == 0 or number not in chapters):
+            raise ValueError(f"策划案中不存在第 {number} 章")
+        if action == "ADD":
+            if number != last_chapter + 1:
+                raise ValueError(f"新增章节的编号应为 {last_chapter + 1}")
+            last_chapter = number
+        chapters[number] = content
+    
+    result = "\n\n".join(chapters[number].strip("\n") for number in sorted(chapters)) + "\n"
+    # 校验：重新切分后每个章节与预期一致（章节连续完整，补丁内容没有混入其他章节的标题）
+    result_chapters = dict(split_prd_sections(result))
+    if sorted(result_chapters) != sorted(chapters) or any(
+        result_chapters[number].strip("\n") != chapters[number].strip("\n") for number in chapters
+    ):
+        raise ValueError("应用补丁后章节结构不完整")
+    return result
+
+
+async def persona_review_parallel_async(prompt: str, personas: list, ctx: dict) -> AsyncGenerator[dict, None]:
+    """
+    审查团各角色并发审查，按完成顺序产出结果
     
-    # 重试配置
-    max_retries = 3
-    retry_delay = 5  # 秒
-    retryable_errors = ["503", "429", "overloaded", "UNAVAILABLE", "RESOURCE_EXHAUSTED", "rate limit"]
+    Args:
+        prompt: 审查输入（与单人审查相同）
+        personas: REVIEW_PERSONAS 的键
+        ctx: get_call_context() 返回的调用参数
     
-    for attempt in range(max_retries):
+    Yields:
+        dict: {"type": "item", "content": (角色, 审查结果, 错误信息)}
+    """
+    async def review(persona: str) -> tuple:
         try:
-            client = get_gemini_client()
-            if client is None:
-                yield {"type": "error", "content": "API客户端初始化失败，请检查API Key"}
-                return
-            
-            # 获取当前选择的模型
-            selected_model = get_selected_model()
-            
-            # 判断是否启用思考模式
-            enable_thinking = "2.5" in selected_model or "think" in selected_model.lower()
-            print(f"[DEBUG] Selected model: {selected_model}")
-            print(f"[DEBUG] Enable thinking: {enable_thinking}")
-            
-            # 构建配置 - 启用思考过程（如果模型支持）
-            config = types.GenerateContentConfig(
-                system_instruction=system_prompt if system_prompt else None,
-                # 尝试启用思考模式（部分模型支持）
-                thinking_config=types.ThinkingConfig(
-                    thinking_budget=10000  # 允许的思考token数
-                ) if enable_thinking else None
-            )
-            
-            print(f"[DEBUG] Config thinking_config: {config.thinking_config}")
-            
-            # 使用流式API
-            response_stream = client.models.generate_content_stream(
-                model=get_selected_model(),
-                contents=prompt,
-                config=config
-            )
-            
-            # 调试标记，只打印一次
-            debug_printed = False
-            
-            for chunk in response_stream:
-                # 检查是否需要中止
-                if st.session_state.should_stop:
-                    yield {"type": "stopped", "content": "用户已中止生成"}
-                    st.session_state.should_stop = False
-                    return
-                
-                # 处理思考过程（如果有）
-                if hasattr(chunk, 'candidates') and chunk.candidates:
-                    for candidate in chunk.candidates:
-                        if hasattr(candidate, 'content') and candidate.content:
-                            for part in candidate.content.parts:
-                                # 获取 part 的类型名（用于调试和检测）
-                                part_type = type(part).__name__
-                                
-                                # 调试：打印 part 的所有属性（仅首次）
-                                if not debug_printed:
-                                    part_attrs = [attr for attr in dir(part) if not attr.startswith('_')]
-                                    print(f"[DEBUG call_gemini_stream] Part type: {part_type}")
-                                    print(f"[DEBUG call_gemini_stream] Part attributes: {part_attrs}")
-                                    # 打印一些关键属性的值
-                                    for attr in ['thought', 'thinking', 'text']:
-                                        if hasattr(part, attr):
-                                            val = getattr(part, attr)
-                                            print(f"[DEBUG call_gemini_stream] part.{attr} = {repr(val)[:100] if val else None}")
-                                    debug_printed = True
-                                
-                                # 检查是否是思考内容 - thought 属性直接包含思考文本
-                                thinking_text = ""
-                                
-                                # 方式1: 检查 thought 属性（直接包含思考文本）
-                                if hasattr(part, 'thought') and part.thought:
-                                    thinking_text = part.thought
-                                    print(f"[DEBUG] Found thinking content: {thinking_text[:50]}...")
-                                
-                                if thinking_text:
-                                    st.session_state.thinking_content += thinking_text
-                                    yield {"type": "thinking", "content": thinking_text}
-                                elif hasattr(part, 'text') and part.text:
-                                    yield {"type": "text", "content": part.text}
-                elif chunk.text:
-                    yield {"type": "text", "content": chunk.text}
-            
-            # 成功完成，退出重试循环
-            return
-                    
+            return (persona, await _generate_async(prompt, build_persona_review_prompt(persona), ctx), "")
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            error_msg = str(e)
-            st.session_state.last_error = error_msg
-            
-            # 检查是否是可重试的错误
-            is_retryable = any(err_key in error_msg for err_key in retryable_errors)
-            
-            if is_retryable and attempt < max_retries - 1:
-                # 通知用户正在重试
-                remaining = max_retries - attempt - 1
-                yield {
-                    "type": "retry", 
-                    "content": f"⚠️ 服务暂时不可用 ({error_msg[:50]}...)，{retry_delay}秒后自动重试（剩余{remaining}次）..."
-                }
-                time.sleep(retry_delay)
-                # 增加下次重试的等待时间（指数退避）
-                retry_delay = min(retry_delay * 2, 30)
-                continue
-            else:
-                # 不可重试或已用完重试次数
-                yield {"type": "error", "content": error_msg}
-                return
+            return (persona, "", str(e))
+    
+    tasks = [asyncio.ensure_future(review(persona)) for persona in personas]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield {"type": "item", "content": await next_done}
+    finally:
+        # 消费方提前退出时取消尚未完成的审查
+        for task in tasks:
+            task.cancel()
+
 
+# 审查结果中一个问题的起始行（数字编号），后续非编号行属于同一个问题
+REVIEW_ITEM_START_PATTERN = re.compile(r'^\s*(?:\*\*)?\d+[、\.．\)）]\s*')
 
-def stream_to_container(prompt: str, system_prompt: str, container, thinking_container=None, status_container=None) -> tuple:
+
+def split_review_items(review_text: str) -> list:
     """
-    流式输出到Streamlit容器，实时显示打字效果，支持中止、错误展示和思考过程
+    将审查结果拆分为问题（编号行及其后的补充说明）
+    
+    Returns:
+        list: 问题全文列表（忽略第一个编号之前的开场白）；没有编号时整段作为一个问题
+    """
+    items = []
+    preamble = []
+    for line in review_text.strip().split("\n"):
+        if REVIEW_ITEM_START_PATTERN.match(line):
+            items.append([line])
+        elif items:
+            items[-1].append(line)
+        else:
+            preamble.append(line)
+    if not items:
+        items = [preamble]
+    return ["\n".join(lines).strip() for lines in items if "\n".join(lines).strip()]
+
+
+def merge_persona_reviews(reviews: list) -> tuple:
+    """
+    合并审查团的问题：与已收录问题相似的视为重复，只保留第一次出现并注明同样提出的角色
     
     Args:
-        prompt: 用户输入的提示词
-        system_prompt: 系统提示词
-        container: Streamlit容器对象（如st.empty()或st.container()）
-        thinking_container: 用于显示思考过程的容器（可选）
-        status_container: 用于显示状态信息的容器（可选）
+        reviews: [(角色, 审查结果)]，按 REVIEW_PERSONAS 的顺序
     
     Returns:
-        tuple: (完整的响应文本, 是否成功, 错误信息)
+        tuple: (合并后的问题（重新编号，按角色分组）, 去重前问题数, 去重后问题数)
     """
-    full_response = ""
-    thinking_text = ""
-    error_msg = ""
-    was_stopped = False
+    merged = []  # [{"persona", "headline", "body", "also"}]
+    total = 0
+    for persona, review_text in reviews:
+        for item in split_review_items(review_text):
+            total += 1
+            body = REVIEW_ITEM_START_PATTERN.sub("", item, count=1)
+            headline = body.split("\n")[0]
+            duplicate = next((
+                entry for entry in merged
+                if difflib.SequenceMatcher(None, headline, entry["headline"]).ratio() >= REFLECTION_QUESTION_SIMILARITY
+            ), None)
+            if duplicate is None:
+                merged.append({"persona": persona, "headline": headline, "body": body, "also": []})
+            elif persona != duplicate["persona"] and persona not in duplicate["also"]:
+                duplicate["also"].append(persona)
+    
+    lines = []
+    number = 0
+    for persona, _ in reviews:
+        entries = [entry for entry in merged if entry["persona"] == persona]
+        if not entries:
+            continue
+        lines.append(f"【{REVIEW_PERSONAS[persona]['name']}】")
+        for entry in entries:
+            number += 1
+            also = "、".join(REVIEW_PERSONAS[p]["name"] for p in entry["also"])
+            suffix = f"（{also}也提出了类似问题）" if also else ""
+            lines.append(f"{number}. {entry['body']}{suffix}")
+        lines.append("")
+    return ("\n".join(lines).strip(), total, len(merged))
+
+
+def developer_review_panel(prompt: str, personas: list, container, status_container=None) -> tuple:
+    """
+    审查团并发审查：各角色的结果完成后立即显示，全部完成后合并去重
     
-    # 使用生成器进行流式输出
-    for chunk_data in call_gemini_stream(prompt, system_prompt, thinking_container):
-        chunk_type = chunk_data.get("type", "text")
-        chunk_content = chunk_data.get("content", "")
-        
-        if chunk_type == "text":
-            full_response += chunk_content
-            # 实时更新显示内容，添加光标效果
-            container.markdown(full_response + " ▌")
-        elif chunk_type == "thinking":
-            thinking_text += chunk_content
-            # 显示思考过程
-            if thinking_container:
-                thinking_container.markdown(f"💭 **模型思考中...**\n\n{thinking_text}")
-        elif chunk_type == "retry":
-            # 显示重试状态
-            if status_container:
-                status_container.warning(chunk_content)
-            else:
-                st.warning(chunk_content)
-        elif chunk_type == "error":
-            error_msg = chunk_content
-            if status_container:
-                status_container.error(f"❌ API调用失败: {error_msg}")
-            else:
-                st.error(f"❌ API调用失败: {error_msg}")
-            break
-        elif chunk_type == "stopped":
-            was_stopped = True
-            if status_container:
-                status_container.warning("⏹️ 生成已中止")
-            break
-        
-        # 强制刷新显示
-        time.sleep(0.01)
+    Args:
+        prompt: 审查输入
+        personas: REVIEW_PERSONAS 的键
+        container: 输出容器（显示各角色进度，最后替换为合并结果）
+        status_container: 用于显示状态信息的容器（可选）
     
-    # 移除光标，显示最终结果
-    if full_response:
-        container.markdown(full_response)
+    Returns:
+        tuple: (合并后的问题, 是否成功, 错误信息)
+    """
+    state = get_run_state()
+    state.last_error = ""
+    if get_gemini_client() is None:
+        return ("", False, "API客户端初始化失败，请检查API Key")
+    
+    results = {}
+    persona_errors = {}
+    canvas = container.container()
+    slots = {}
+    for persona in personas:
+        slots[persona] = canvas.empty()
+        slots[persona].markdown(f"**{REVIEW_PERSONAS[persona]['name']}**：⏳ 审查中...")
+    
+    ctx = get_call_context()
+    stream = persona_review_parallel_async(prompt, personas, ctx)
+    for chunk_data in get_async_engine().stream(stream, get_cancel_token()):
+        if state.should_stop:
+            break
+        if chunk_data.get("type") != "item":
+            continue
+        persona, review_text, error = chunk_data["content"]
+        name = REVIEW_PERSONAS[persona]["name"]
+        if error or not review_text:
+            persona_errors[persona] = error or "未返回结果"
+            slots[persona].warning(f"{name}审查失败：{persona_errors[persona][:80]}")
+        else:
+            results[persona] = review_text
+            slots[persona].markdown(f"**{name}**\n\n{review_text}")
+        if status_container:
+            status_container.info(f"👥 审查团进度：{len(results) + len(persona_errors)}/{len(personas)}")
     
-    # 判断是否成功
-    success = bool(full_response) and not error_msg and not was_stopped
+    apply_model_used(ctx)
+    if state.should_stop:
+        # 中止标志由调用方（reflection_loop）处理
+        return ("", False, "")
+    if not results:
+        error_msg = next(iter(persona_errors.values()), "审查未返回结果")
+        state.last_error = error_msg
+        return ("", False, error_msg)
     
-    return (full_response, success, error_msg)
+    merged, total, kept = merge_persona_reviews([(p, results[p]) for p in personas if p in results])
+    container.markdown(merged)
+    if status_container:
+        failed = f"，{len(persona_errors)} 个角色审查失败" if persona_errors else ""
+        status_container.info(f"👥 {len(results)} 个角色共提出 {total} 个问题，合并重复后保留 {kept} 个{failed}")
+    return (merged, True, "")
 
 
-def stream_generator(prompt: str, system_prompt: str):
+# 增量审查：修改的章节超过全文的该比例时仍审查全文（摘要节省有限，且整体结构可能已变化）
+REVIEW_DIGEST_MAX_CHANGED_RATIO = 0.6
+
+# 未修改章节摘要的最大字数
+REVIEW_DIGEST_SUMMARY_CHARS = 80
+
+
+def summarize_prd_section(section_text: str) -> str:
     """
-    创建流式输出生成器，配合st.write_stream使用
+    未修改章节的一行摘要（本地提取，不调用模型）：标题 + 二级标题列表，没有二级标题时取第一行正文
+    
+    Returns:
+        str: 如 "3、功能流程：3.1 触发入口；3.2 生成流程"
+    """
+    lines = [line.strip() for line in section_text.split("\n") if line.strip()]
+    if not lines:
+        return ""
+    title = re.sub(r'\*\*', '', lines[0]).lstrip('#').strip()
+    subtitles = []
+    for line in lines[1:]:
+        clean_line = re.sub(r'\*\*', '', line).lstrip('#').strip()
+        if PRD_LEVEL2_PATTERN.match(clean_line) and not PRD_LEVEL3_PATTERN.match(clean_line):
+            subtitles.append(clean_line)
+    summary = "；".join(subtitles) if subtitles else (lines[1] if len(lines) > 1 else "")
+    if len(summary) > REVIEW_DIGEST_SUMMARY_CHARS:
+        summary = summary[:REVIEW_DIGEST_SUMMARY_CHARS] + "..."
+    return f"{title}：{summary}" if summary else title
+
+
+def build_review_digest(reviewed_prd: str, current_prd: str) -> Optional[dict]:
+    """
+    构建增量审查的输入：未修改的章节只保留摘要，修改或新增的章节保留全文
     
     Args:
-        prompt: 用户输入的提示词
-        system_prompt: 系统提示词
+        reviewed_prd: 上一轮审查过的策划案
+        current_prd: 当前策划案
     
-    Yields:
-        文本片段
+    Returns:
+        dict: {"unchanged": 摘要列表, "changed": 修改章节全文, "changed_count", "total_count"}；
+              章节无法识别、没有修改或修改范围过大时返回None（审查全文）
     """
-    for chunk_data in call_gemini_stream(prompt, system_prompt):
-        if chunk_data.get("type") == "text":
-            yield chunk_data.get("content", "")
+    reviewed = dict(split_prd_sections(reviewed_prd))
+    sections = [(number, text) for number, text in split_prd_sections(current_prd) if number]
+    if len(sections) < 2:
+        return None
+    changed = [text for number, text in sections if reviewed.get(number, "").strip() != text.strip()]
+    unchanged = [text for number, text in sections if reviewed.get(number, "").strip() == text.strip()]
+    changed_chars = sum(len(text) for text in changed)
+    if not changed or changed_chars > len(current_prd) * REVIEW_DIGEST_MAX_CHANGED_RATIO:
+        return None
+    return {
+        "unchanged": "\n".join(f"- {summarize_prd_section(text)}" for text in unchanged),
+        "changed": "\n\n".join(text.strip("\n") for text in changed),
+        "changed_count": len(changed),
+        "total_count": len(sections),
+    }
 
 
-def generate_prd(user_input: str, use_stream: bool = False, container=None, thinking_container=None, status_container=None) -> tuple:
+def planner_fix(current_prd: str, dev_questions: str, use_stream: bool = False, container=None, thinking_container=None,
+                status_container=None, patch_mode: bool = False) -> tuple:
     """
-    功能模块1：生成策划案（支持流式输出）
+    策划角色根据开发人员问题修改策划案（支持流式输出）
+    
+    补丁模式下模型只输出修改或新增的章节，在本地应用到策划案上；补丁无法应用时改为重新生成全文。
     
     Args:
-        user_input: 用户输入的功能描述
+        current_prd: 当前版本的策划案
+        dev_questions: 开发人员提出的问题
         use_stream: 是否使用流式输出
         container: Streamlit容器对象，用于流式显示
         thinking_container: 用于显示思考过程的容器
         status_container: 用于显示状态信息的容器
+        patch_mode: 是否使用补丁模式（策划案至少有两个可识别的章节时生效）
     
     Returns:
-        tuple: (生成的策划案文本, 是否成功, 错误信息)
+        tuple: (修改后的策划案, 是否成功, 错误信息)
     """
-    prompt = f"请根据以下功能描述生成完整的策划案：\n\n{user_input}"
+    chapter_count = sum(1 for number, _ in split_prd_sections(current_prd) if number)
+    if patch_mode and use_stream and container and chapter_count >= 2:
+        patch_prompt = f"""【当前策划案】（共 {chapter_count} 章）
+{current_prd}
+
+【开发人员提出的问题】
+{dev_questions}
+
+请针对以上问题修改和完善策划案，按补丁格式只输出修改或新增的章节。"""
+        patch_text, success, error = stream_to_container(patch_prompt, PLANNER_PATCH_PROMPT, container,
+                                                         thinking_container, status_container)
+        if not success:
+            return (patch_text, success, error)
+        try:
+            patches = parse_prd_patch(patch_text)
+            updated_prd = apply_prd_patch(current_prd, patches)
+        except ValueError as e:
+            logger.info("planner patch rejected: %s", e)
+            if status_container:
+                status_container.warning(f"⚠️ 补丁无法应用（{e}），改为重新生成完整策划案...")
+        else:
+            changed = "、".join(str(number) for _, number, _ in patches)
+            container.markdown(
+                f"**已更新第 {changed} 章**（其余章节保持不变，补丁 {len(patch_text)} 字 / 全文 {len(updated_prd)} 字）\n\n"
+                + "\n\n".join(content for _, _, content in patches)
+            )
+            return (updated_prd, True, "")
+    
+    prompt = f"""【当前策划案】
+{current_prd}
+
+【开发人员提出的问题】
+{dev_questions}
+
+请针对以上问题修改和完善策划案。"""
     
     if use_stream and container:
-        return stream_to_container(prompt, get_system_prompt_with_date(GENERATE_PRD_SYSTEM_PROMPT), container, thinking_container, status_container)
+        return stream_to_container(prompt, PLANNER_FIX_PROMPT, container, thinking_container, status_container,
+                                   segmented=True)
     else:
-        result = call_gemini(prompt, get_system_prompt_with_date(GENERATE_PRD_SYSTEM_PROMPT))
+        result = call_gemini(prompt, PLANNER_FIX_PROMPT)
         return (result, result is not None, st.session_state.last_error if not result else "")
 
 
-def ai_self_check(prd_content: str, use_stream: bool = False, container=None, thinking_container=None, status_container=None) -> tuple:
+# Reflection 收敛判定：本轮策划案变化比例低于阈值、且开发人员的问题大多是重复的，即提前结束迭代
+REFLECTION_CONVERGENCE_THRESHOLD = 0.05
+
+# 新问题占比低于该值时视为开发人员已提不出新问题
+REFLECTION_QUESTION_NOVELTY_THRESHOLD = 0.3
+
+# 与之前某个问题的相似度达到该值时视为重复问题
+REFLECTION_QUESTION_SIMILARITY = 0.6
+
+# 开发人员审查结果中的问题行（数字编号或列表项）
+REVIEW_QUESTION_PATTERN = re.compile(r'^\s*(?:\*\*)?(?:\d+[、\.．\)）]|[-*•])\s*(.+)$')
+
+
+def measure_prd_change(old_prd: str, new_prd: str) -> float:
     """
-    AI自检功能：对策划案进行复检清单检查（支持流式输出）
-    
-    Args:
-        prd_content: 策划案内容
-        use_stream: 是否使用流式输出
-        container: Streamlit容器对象，用于流式显示
-        thinking_container: 用于显示思考过程的容器
-        status_container: 用于显示状态信息的容器
+    计算两个版本策划案的变化比例：逐章节的归一化编辑距离，按章节长度加权
     
     Returns:
-        tuple: (检查结果报告, 是否成功, 错误信息)
+        float: 0（完全相同）~ 1（完全不同）
     """
-    prompt = f"""请对以下策划案进行复检清单检查：
+    old_sections = dict(split_prd_sections(old_prd))
+    new_sections = dict(split_prd_sections(new_prd))
+    total_weight = 0
+    changed_weight = 0.0
+    for number in set(old_sections) | set(new_sections):
+        old_text = old_sections.get(number, "")
+        new_text = new_sections.get(number, "")
+        weight = max(len(old_text), len(new_text))
+        if not weight:
+            continue
+        total_weight += weight
+        if old_text != new_text:
+            # 中文字符重复率高，关闭 autojunk 避免常用字被当作噪声忽略
+            similarity = difflib.SequenceMatcher(None, old_text, new_text, autojunk=False).ratio()
+            changed_weight += weight * (1 - similarity)
+    return changed_weight / total_weight if total_weight else 0.0
 
-{prd_content}
 
-请逐一检查每一项，给出详细的检查结果。"""
+def extract_review_questions(review_text: str) -> list:
+    """从开发人员审查结果中提取问题（数字编号或列表项的行）"""
+    questions = []
+    for line in review_text.split("\n"):
+        match = REVIEW_QUESTION_PATTERN.match(line)
+        if match:
+            questions.append(match.group(1).strip())
+    return questions
+
+
+def measure_question_novelty(questions: list, previous_questions: list) -> float:
+    """
+    计算本轮问题中新问题的占比（与之前各轮的问题都不相似）
     
-    if use_stream and container:
-        return stream_to_container(prompt, SELF_CHECK_SYSTEM_PROMPT, container, thinking_container, status_container)
+    Returns:
+        float: 0 ~ 1；之前没有问题时为1
+    """
+    if not questions:
+        return 0.0
+    if not previous_questions:
+        return 1.0
+    new_count = 0
+    for question in questions:
+        if all(difflib.SequenceMatcher(None, question, previous).ratio() < REFLECTION_QUESTION_SIMILARITY
+               for previous in previous_questions):
+            new_count += 1
+    return new_count / len(questions)
+
+
+def assess_reflection_convergence(previous_prd: str, current_prd: str, review_text: str,
+                                  previous_questions: list, threshold: float) -> dict:
+    """
+    判断一轮 Reflection 之后是否已收敛
+    
+    Args:
+        previous_prd: 本轮开始前的策划案
+        current_prd: 本轮修改后的策划案
+        review_text: 本轮开发人员审查结果
+        previous_questions: 之前各轮提出的问题（extract_review_questions 的结果）
+        threshold: 变化比例阈值
+    
+    Returns:
+        dict: {"change": 变化比例, "novelty": 新问题占比, "converged": 是否已收敛}
+              审查有内容但解析不出编号问题时 novelty 为None（无法判断，本轮不视为收敛）
+    """
+    change = measure_prd_change(previous_prd, current_prd)
+    questions = extract_review_questions(review_text)
+    if questions:
+        novelty = measure_question_novelty(questions, previous_questions)
+    elif review_text.strip():
+        # 自由格式或无法解析的审查不能说明没有新问题
+        novelty = None
     else:
-        result = call_gemini(prompt, SELF_CHECK_SYSTEM_PROMPT)
-        return (result, result is not None, st.session_state.last_error if not result else "")
+        # 审查没有提出任何问题（如章节并行优化中各章节都未发现问题）
+        novelty = 0.0
+    return {
+        "change": change,
+        "novelty": novelty,
+        "converged": novelty is not None and change < threshold and novelty < REFLECTION_QUESTION_NOVELTY_THRESHOLD,
+    }
 
 
-def optimize_prd_initial(old_prd: str, feedback: str, use_stream: bool = False, container=None, thinking_container=None, status_container=None) -> tuple:
+def estimate_reflection_round_calls(prd: str, review_personas: Optional[list] = None, sharded: bool = False) -> int:
     """
-    优化策划案 - 初始修正（支持流式输出）
+    估算一轮 Reflection 的模型调用次数（用于收敛时计算节省的调用）
     
     Args:
-        old_prd: 旧策划案
-        feedback: 用户的修改意见
-        use_stream: 是否使用流式输出
-        container: Streamlit容器对象，用于流式显示
-        thinking_container: 用于显示思考过程的容器
-        status_container: 用于显示状态信息的容器
+        prd: 当前策划案
+        review_personas: 审查团角色（每个角色一次审查调用，合并在本地完成）
+        sharded: 是否按章节并行（每章审查和修改各一次，另加一次一致性检查）
+    
+    Returns:
+        int: 调用次数
+    """
+    if sharded:
+        chapter_count = sum(1 for number, _ in split_prd_sections(prd) if number)
+        if chapter_count >= 2:
+            return 2 * chapter_count + 1
+    # 审查（审查团时每个角色一次）+ 策划修改一次
+    return (len(review_personas) if review_personas else 1) + 1
+
+
+def describe_convergence(convergence: dict, round_number: int, threshold: float, saved_calls: int) -> str:
+    """收敛时的提示：停止原因和节省的模型调用次数"""
+    return (
+        f"🎯 第 {round_number} 轮后已收敛：策划案变化 {convergence['change']:.1%}（阈值 {threshold:.0%}），"
+        f"新问题仅占 {convergence['novelty']:.0%}，提前结束迭代，节省 {saved_calls} 次模型调用"
+    )
+
+
+async def reflect_chapter_async(number: int, chapter_text: str, outline: str, ctx: dict) -> dict:
+    """
+    章节并行优化中单个章节的审查和修改
+    
+    Args:
+        number: 章节编号
+        chapter_text: 章节全文
+        outline: 全文概要（各章节标题和摘要），保证跨章节引用一致
+        ctx: get_call_context() 返回的调用参数
     
     Returns:
-        tuple: (初步修正后的策划案, 是否成功, 错误信息)
+        dict: {"number", "questions", "text", "error"}，text 为修改后的章节（没有问题时为原文）
     """
-    prompt = f"""【旧策划案】
-{old_prd}
+    result = {"number": number, "questions": "", "text": chapter_text, "error": ""}
+    heading = chapter_text.strip().split("\n")[0]
+    try:
+        review_prompt = f"""【策划案全文概要】（各章节标题和摘要，用于理解上下文）
+{outline}
 
-【用户修改意见】
-{feedback if feedback else "无特别意见，请根据复检清单进行检查和完善"}
+【待审查章节】
+{chapter_text}
 
-请根据复检清单检查旧案，结合用户意见进行修改和填补。"""
-    
-    if use_stream and container:
-        return stream_to_container(prompt, INITIAL_FIX_SYSTEM_PROMPT, container, thinking_container, status_container)
-    else:
-        result = call_gemini(prompt, INITIAL_FIX_SYSTEM_PROMPT)
-        return (result, result is not None, st.session_state.last_error if not result else "")
+请只针对待审查章节提出你的问题和疑虑；涉及其他章节的内容以全文概要为准。"""
+        result["questions"] = (await _generate_async(review_prompt, DEVELOPER_REVIEW_PROMPT, ctx) or "").strip()
+        if not result["questions"]:
+            return result
+        fix_prompt = f"""【策划案全文概要】（各章节标题和摘要，用于保持前后一致）
+{outline}
+
+【当前章节】
+{chapter_text}
+
+【开发人员针对本章提出的问题】
+{result["questions"]}
+
+请针对以上问题修改和完善本章。只输出修改后的完整本章（从一级标题“{heading}”开始），不要输出其他章节，不要改动章节编号。"""
+        result["text"] = (await _generate_async(fix_prompt, PLANNER_FIX_PROMPT, ctx) or "").strip() or chapter_text
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        result["error"] = str(e)
+    return result
 
 
-def developer_review(current_prd: str, use_stream: bool = False, container=None, thinking_container=None, status_container=None) -> tuple:
+async def sharded_reflection_async(chapters: list, outline: str, ctx: dict) -> AsyncGenerator[dict, None]:
     """
-    开发人员角色审查策划案（支持流式输出）
+    各章节并发审查和修改，按完成顺序产出结果
     
     Args:
-        current_prd: 当前版本的策划案
-        use_stream: 是否使用流式输出
-        container: Streamlit容器对象，用于流式显示
-        thinking_container: 用于显示思考过程的容器
-        status_container: 用于显示状态信息的容器
+        chapters: [(章节编号, 章节全文)]
+        outline: 全文概要
+        ctx: get_call_context() 返回的调用参数
     
-    Returns:
-        tuple: (开发人员提出的问题列表, 是否成功, 错误信息)
+    Yields:
+        dict: {"type": "item", "content": reflect_chapter_async 的结果}
     """
-    prompt = f"""请审查以下策划案，提出你的问题和疑虑：
+    tasks = [
+        asyncio.ensure_future(reflect_chapter_async(number, text, outline, ctx))
+        for number, text in chapters
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield {"type": "item", "content": await next_done}
+    finally:
+        # 消费方提前退出时取消尚未完成的章节
+        for task in tasks:
+            task.cancel()
 
-{current_prd}"""
-    
-    if use_stream and container:
-        return stream_to_container(prompt, DEVELOPER_REVIEW_PROMPT, container, thinking_container, status_container)
-    else:
-        result = call_gemini(prompt, DEVELOPER_REVIEW_PROMPT)
-        return (result, result is not None, st.session_state.last_error if not result else "")
 
+def get_section_title(section_text: str) -> str:
+    """章节标题（第一行，去掉 ** 和 # 标记）"""
+    first_line = section_text.strip().split("\n")[0]
+    return re.sub(r'\*\*', '', first_line).lstrip('#').strip()
 
-def planner_fix(current_prd: str, dev_questions: str, use_stream: bool = False, container=None, thinking_container=None, status_container=None) -> tuple:
+
+def sharded_reflection_round(current_prd: str, round_number: int, ui) -> tuple:
     """
-    策划角色根据开发人员问题修改策划案（支持流式输出）
+    章节并行优化的一轮：各章节并发审查和修改（共享全文概要），逐章校验后合并，再做一次跨章节一致性检查
+    
+    单轮耗时取决于最长的章节而不是全文；某个章节失败或修改结果格式不符时保持该章原文。
     
     Args:
-        current_prd: 当前版本的策划案
-        dev_questions: 开发人员提出的问题
-        use_stream: 是否使用流式输出
-        container: Streamlit容器对象，用于流式显示
-        thinking_container: 用于显示思考过程的容器
-        status_container: 用于显示状态信息的容器
+        current_prd: 当前策划案
+        round_number: 轮次（从1开始）
+        ui: 输出容器
     
     Returns:
-        tuple: (修改后的策划案, 是否成功, 错误信息)
+        tuple: (本轮问题（按章节分组）, 修改后的策划案, 错误信息（全部章节都失败时）)
     """
-    prompt = f"""【当前策划案】
-{current_prd}
-
-【开发人员提出的问题】
-{dev_questions}
-
-请针对以上问题修改和完善策划案。"""
+    state = get_run_state()
+    chapters = [(number, text) for number, text in split_prd_sections(current_prd) if number]
+    outline = "\n".join(f"- {summarize_prd_section(text)}" for _, text in chapters)
+    
+    section = ui.expander(f"🧩 第 {round_number} 轮 - 章节并行审查与修改", expanded=True)
+    status_container = section.empty()
+    slots = {}
+    for number, text in chapters:
+        slots[number] = section.empty()
+        slots[number].markdown(f"**{get_section_title(text)}**：⏳ 审查与修改中...")
+    
+    results = {}
+    ctx = get_call_context()
+    stream = sharded_reflection_async(chapters, outline, ctx)
+    for chunk_data in get_async_engine().stream(stream, get_cancel_token()):
+        if state.should_stop:
+            break
+        if chunk_data.get("type") != "item":
+            continue
+        result = chunk_data["content"]
+        results[result["number"]] = result
+        title = get_section_title(result["text"] if not result["error"] else dict(chapters)[result["number"]])
+        if result["error"]:
+            slots[result["number"]].warning(f"{title}：审查或修改失败，保持原文（{result['error'][:80]}）")
+        elif not result["questions"]:
+            slots[result["number"]].markdown(f"**{title}**：✅ 未发现问题")
+        else:
+            question_count = len(extract_review_questions(result["questions"]))
+            slots[result["number"]].markdown(f"**{title}**：✏️ 已根据 {question_count} 个问题修改")
+        status_container.info(f"🧩 章节进度：{len(results)}/{len(chapters)}")
+    
+    apply_model_used(ctx)
+    if state.should_stop:
+        return ("", current_prd, "")
+    failed = [result for result in results.values() if result["error"]]
+    if len(failed) == len(chapters):
+        return ("", current_prd, failed[0]["error"])
+    
+    # 逐章校验修改结果，格式不符的章节保持原文
+    patches = []
+    for number, text in chapters:
+        result = results.get(number)
+        if not result or result["error"] or not result["questions"] or result["text"].strip() == text.strip():
+            continue
+        try:
+            apply_prd_patch(current_prd, [("REPLACE", number, result["text"])])
+        except ValueError as e:
+            slots[number].warning(f"{get_section_title(text)}：修改结果格式不符（{e}），保持原文")
+            continue
+        patches.append(("REPLACE", number, result["text"]))
+    merged_prd = apply_prd_patch(current_prd, patches) if patches else current_prd
+    questions = "\n\n".join(
+        f"【{get_section_title(text)}】\n{results[number]['questions']}"
+        for number, text in chapters
+        if number in results and results[number]["questions"] and not results[number]["error"]
+    )
+    status_container.success(f"✅ {len(patches)}/{len(chapters)} 个章节已修改" +
+                             (f"，{len(failed)} 个章节失败" if failed else ""))
+    
+    # 跨章节一致性检查：只输出需要修正的章节
+    if patches:
+        consistency_section = ui.expander(f"🔗 第 {round_number} 轮 - 章节一致性检查", expanded=False)
+        consistency_status = consistency_section.empty()
+        consistency_container = consistency_section.empty()
+        changed = "、".join(str(number) for _, number, _ in patches)
+        prompt = f"""以下策划案的第 {changed} 章刚刚分别独立修改过，请检查章节之间是否一致。
+
+{merged_prd}"""
+        text, success, error = stream_to_container(prompt, PRD_CONSISTENCY_PROMPT, consistency_container,
+                                                   None, consistency_status)
+        if state.should_stop:
+            return (questions, merged_prd, "")
+        if not success:
+            consistency_status.warning(f"⚠️ 一致性检查失败（{error}），保留各章节的修改结果")
+        elif "<<<" in text:
+            try:
+                fixes = parse_prd_patch(text)
+                merged_prd = apply_prd_patch(merged_prd, fixes)
+                consistency_status.success(f"🔗 已修正第 {'、'.join(str(number) for _, number, _ in fixes)} 章中的不一致")
+            except ValueError as e:
+                consistency_status.warning(f"⚠️ 一致性修正无法应用（{e}），保留各章节的修改结果")
+        else:
+            consistency_status.success("🔗 章节之间没有发现不一致")
     
-    if use_stream and container:
-        return stream_to_container(prompt, PLANNER_FIX_PROMPT, container, thinking_container, status_container)
-    else:
-        result = call_gemini(prompt, PLANNER_FIX_PROMPT)
-        return (result, result is not None, st.session_state.last_error if not result else "")
+    return (questions, merged_prd, "")
 
 
-def reflection_loop(initial_prd: str, max_iterations: int) -> tuple:
+def reflection_loop(initial_prd: str, max_iterations: int, ui, run_id: str = "",
+                    completed_rounds: Optional[list] = None, convergence_threshold: float = 0.0,
+                    patch_mode: bool = False, incremental_review: bool = False,
+                    review_personas: Optional[list] = None, sharded: bool = False) -> tuple:
     """
     Reflection循环优化策划案（流式输出版本，支持中止）
     
+    每完成一轮立即写入检查点；从检查点继续时跳过已完成的轮次。
+    某轮审查或修改在重试、降级后仍失败时停止迭代（后续轮次通常也会失败），已完成的轮次可稍后继续。
+    设置收敛阈值时，策划案变化低于阈值且开发人员的问题大多重复后提前结束（见 assess_reflection_convergence）。
+    
     Args:
         initial_prd: 初始修正后的策划案
         max_iterations: 最大迭代轮次
+        ui: 输出容器（后台任务画布 JobCanvas，或 st.container()）
+        run_id: 检查点ID（为空时不记录检查点）
+        completed_rounds: 检查点中已完成的轮次（ReflectionCheckpointStore.load 的 rounds）
+        convergence_threshold: 收敛阈值（策划案变化比例，0 表示不提前结束）
+        patch_mode: 策划修改是否使用补丁模式（见 planner_fix）
+        incremental_review: 第二轮起是否只向开发人员发送修改过的章节全文（见 developer_review）
+        review_personas: 审查团角色（为空时由单个通用开发人员审查）
+        sharded: 是否按章节并行审查和修改（见 sharded_reflection_round；策划案至少有两个章节时生效）
     
     Returns:
-        tuple: (最终优化后的策划案, 是否被中止)
+        tuple: (最终优化后的策划案, 是否被中止, 错误信息, 收敛提示（未提前结束时为空）)
     """
+    completed_rounds = completed_rounds or []
     current_prd = initial_prd
     was_stopped = False
-    
-    for i in range(max_iterations):
+    state = get_run_state()
+    store = get_checkpoint_store() if run_id else None
+    asked_questions = []  # 之前各轮提出的问题，用于判断新问题占比
+    reviewed_prd = ""  # 上一轮开发人员审查的版本（增量审查的基准）
+    convergence = None
+    
+    # 已完成的轮次从检查点恢复，只展示开发人员问题
+    for record in completed_rounds:
+        restored_section = ui.expander(f"♻️ 第 {record['index'] + 1} 轮（已从检查点恢复）", expanded=False)
+        restored_section.markdown(record["questions"] or "本轮已跳过")
+        # 有问题但策划案未更新（策划修改失败）的轮次不判断收敛
+        if convergence_threshold and record["questions"] and record["prd"] != current_prd:
+            convergence = assess_reflection_convergence(current_prd, record["prd"], record["questions"],
+                                                        asked_questions, convergence_threshold)
+        else:
+            convergence = None
+        asked_questions += extract_review_questions(record["questions"])
+        if record["questions"]:
+            reviewed_prd = current_prd
+        current_prd = record["prd"]
+    
+    # 中断前最后完成的一轮已经收敛
+    if convergence and convergence["converged"]:
+        round_calls = estimate_reflection_round_calls(current_prd, review_personas, sharded)
+        note = describe_convergence(convergence, len(completed_rounds), convergence_threshold,
+                                    round_calls * (max_iterations - len(completed_rounds)))
+        ui.info(note)
+        return (current_prd, False, "", note)
+    
+    for i in range(len(completed_rounds), max_iterations):
         # 检查是否需要中止
-        if st.session_state.should_stop:
+        if state.should_stop:
             was_stopped = True
-            st.warning(f"⏹️ 迭代已在第 {i + 1} 轮前中止")
+            ui.warning(f"⏹️ 迭代已在第 {i + 1} 轮前中止")
             break
             
-        st.markdown(f"### 🔄 第 {i + 1} 轮迭代")
+        ui.markdown(f"### 🔄 第 {i + 1} 轮迭代")
         
-        # 显示中止按钮
-        col_status, col_stop = st.columns([4, 1])
-        with col_stop:
-            if st.button(f"⏹️ 中止迭代", key=f"stop_iteration_{i}", type="secondary"):
-                st.session_state.should_stop = True
+        round_start_prd = current_prd
+        planner_updated = True  # 有问题时策划是否给出了修改（修改失败时不判断收敛）
+        if sharded and sum(1 for number, _ in split_prd_sections(current_prd) if number) >= 2:
+            # 章节并行：各章节同时审查和修改，最后统一做一致性检查
+            dev_questions, updated_prd, error = sharded_reflection_round(current_prd, i + 1, ui)
+            if state.should_stop:
                 was_stopped = True
-                st.warning("⏹️ 迭代已中止")
-                return (current_prd, True)
+                ui.warning("⏹️ 已中止")
+                break
+            if error:
+                ui.error(f"❌ 第 {i + 1} 轮章节并行优化失败: {error}")
+                return (current_prd, False, error, "")
+            if dev_questions:
+                reviewed_prd = current_prd
+                planner_updated = updated_prd != current_prd
+            current_prd = updated_prd
+        else:
+            # 角色A: 开发人员审查
+            thinking_container = ui.expander(f"💭 第 {i + 1} 轮 - 开发人员思考过程", expanded=False).empty()
+            review_section = ui.expander(f"📋 第 {i + 1} 轮 - 开发人员审查", expanded=True)
+            review_section.markdown("**🔍 开发人员正在审查策划案...**")
+            status_container = review_section.empty()
+            dev_container = review_section.empty()
         
-        # 角色A: 开发人员审查
-        with st.expander(f"📋 第 {i + 1} 轮 - 开发人员审查", expanded=True):
-            st.markdown("**🔍 开发人员正在审查策划案...**")
-            
-            # 思考过程展示
-            thinking_expander = st.expander("💭 查看思考过程", expanded=False)
-            with thinking_expander:
-                thinking_container = st.empty()
-            
-            status_container = st.empty()
-            dev_container = st.empty()
-            
             dev_questions, success, error = developer_review(
                 current_prd, 
                 use_stream=True, 
                 container=dev_container,
                 thinking_container=thinking_container,
-                status_container=status_container
+                status_container=status_container,
+                reviewed_prd=reviewed_prd if incremental_review else "",
+                personas=review_personas
             )
-            
-            if st.session_state.should_stop:
+        
+            if state.should_stop:
                 was_stopped = True
-                st.warning("⏹️ 已中止")
+                review_section.warning("⏹️ 已中止")
                 break
-                
+            
             if success and dev_questions:
-                st.success("审查完成！")
+                reviewed_prd = current_prd
+                review_section.success("审查完成！")
             elif error:
-                st.error(f"❌ 审查失败: {error}")
-                st.warning("跳过本轮")
-                continue
+                review_section.error(f"❌ 审查失败: {error}")
+                return (current_prd, False, error, "")
             else:
-                st.warning("开发人员审查失败，跳过本轮")
+                review_section.warning("开发人员审查失败，跳过本轮")
+                if store:
+                    store.save_round(run_id, i, "", current_prd)
                 continue
         
-        # 角色B: 策划修改
-        with st.expander(f"✏️ 第 {i + 1} 轮 - 策划优化", expanded=True):
-            st.markdown("**✏️ 策划酸奶正在优化策划案...**")
-            
-            # 思考过程展示
-            thinking_expander2 = st.expander("💭 查看思考过程", expanded=False)
-            with thinking_expander2:
-                thinking_container2 = st.empty()
-            
-            status_container2 = st.empty()
-            fix_container = st.empty()
-            
+            # 角色B: 策划修改
+            thinking_container2 = ui.expander(f"💭 第 {i + 1} 轮 - 策划思考过程", expanded=False).empty()
+            fix_section = ui.expander(f"✏️ 第 {i + 1} 轮 - 策划优化", expanded=True)
+            fix_section.markdown("**✏️ 策划酸奶正在优化策划案...**")
+            status_container2 = fix_section.empty()
+            fix_container = fix_section.empty()
+        
             updated_prd, success, error = planner_fix(
                 current_prd, 
                 dev_questions, 
                 use_stream=True, 
                 container=fix_container,
                 thinking_container=thinking_container2,
-                status_container=status_container2
+                status_container=status_container2,
+                patch_mode=patch_mode
             )
-            
-            if st.session_state.should_stop:
+        
+            if state.should_stop:
                 was_stopped = True
-                st.warning("⏹️ 已中止")
+                fix_section.warning("⏹️ 已中止")
                 break
-                
+            
             if success and updated_prd:
                 current_prd = updated_prd
-                st.success(f"第 {i + 1} 轮优化完成！")
+                fix_section.success(f"第 {i + 1} 轮优化完成！")
             elif error:
-                st.error(f"❌ 优化失败: {error}")
-                st.warning("保持当前版本")
+                fix_section.error(f"❌ 优化失败: {error}")
+                return (current_prd, False, error, "")
             else:
-                st.warning("策划优化失败，保持当前版本")
-        
-        st.markdown("---")
+                fix_section.warning("策划优化失败，保持当前版本")
+                planner_updated = False
+        
+        if store:
+            store.save_round(run_id, i, dev_questions, current_prd)
+        
+        if convergence_threshold and not planner_updated:
+            # 策划未能修改时变化为0、问题与上一轮重复，不能据此判断已收敛
+            ui.markdown("📉 本轮策划案未更新，不判断是否收敛")
+        elif convergence_threshold:
+            convergence = assess_reflection_convergence(round_start_prd, current_prd, dev_questions,
+                                                        asked_questions, convergence_threshold)
+            novelty = f"{convergence['novelty']:.0%}" if convergence["novelty"] is not None else "无法识别（审查中没有编号问题）"
+            ui.markdown(f"📉 本轮策划案变化 {convergence['change']:.1%}，新问题占比 {novelty}")
+            if convergence["converged"]:
+                round_calls = estimate_reflection_round_calls(current_prd, review_personas, sharded)
+                note = describe_convergence(convergence, i + 1, convergence_threshold,
+                                            round_calls * (max_iterations - i - 1))
+                ui.info(note)
+                return (current_prd, False, "", note)
+        asked_questions += extract_review_questions(dev_questions)
+        ui.markdown("---")
+    
+    return (current_prd, was_stopped, "", "")
+
+
+# ============================================
+# 后台任务
+# ============================================
+
+# 同时运行的后台任务数（每个任务占用一个工作线程，模型调用仍受 LLM_MAX_CONCURRENCY 限制）
+JOB_MAX_WORKERS = 8
+
+# 页面轮询任务进度的间隔（秒）
+JOB_POLL_SECONDS = 1.0
+
+# 占位超过该时长（秒）没有写入时视为空闲：整页重跑时只渲染一次，不再放入轮询片段
+JOB_SLOT_IDLE_SECONDS = 3.0
+
+# 已结束的任务在内存中保留的时长（秒），期间刷新页面仍可取回结果
+JOB_RETENTION_SECONDS = 3600
+
+# URL 参数名：记录当前会话关联的任务ID，刷新页面或断线重连后据此重新关联
+JOB_QUERY_PARAM = "jobs"
+
+
+
+def get_current_job():
+    """
+    获取当前线程正在执行的后台任务（脚本线程中返回None）
+    
+    任务记录在工作线程对象上而不是模块级变量中：Streamlit 每次重跑都会重新执行本模块，
+    模块级的 threading.local 会被替换，而线程池是跨重跑共享的。
+    """
+    return getattr(threading.current_thread(), "yogort_job", None)
+
+
+def get_run_state():
+    """
+    获取运行状态的存放位置：后台任务线程中为任务对象，脚本线程中为 st.session_state
+    
+    两者都提供 should_stop / last_error / thinking_content / last_model_used，
+    流式调用、复检等函数通过它读写状态，同一份代码可以直接在后台任务中运行。
+    """
+    job = get_current_job()
+    return job if job is not None else st.session_state
+
+
+class JobLayout:
+    """
+    任务画布的布局版本（同一任务的所有画布和占位共享）
+    
+    新增输出块、占位定格或变为画布时递增；页面据此判断是否需要整页重跑，
+    占位内容的普通更新只改变该占位自身的版本。
+    """
+    
+    def __init__(self):
+        self._counter = itertools.count(1)
+        self.version = 0
+    
+    def bump(self):
+        """布局已变化（调用方需先完成对应的写入，页面先读版本再读内容）"""
+        self.version = next(self._counter)
+
+
+class JobSlot:
+    """
+    后台任务中的单元素占位（对应 st.empty()），只保留最近一次写入的内容
+    
+    状态以 (类型, 内容) 元组整体替换，页面线程读取时不会看到写了一半的状态。
+    最近仍在写入的占位在各自的轮询片段中刷新；空闲或定格（freeze）的占位只在整页重跑时渲染一次，
+    页面通过版本号发现其再次被写入。
+    """
+    
+    def __init__(self, layout: JobLayout):
+        self.layout = layout
+        self.state = ("empty", "")
+        self.version = 0  # 每次写入递增（先写内容再递增，页面先读版本再读内容）
+        self.updated_at = time.monotonic()
+        self.frozen = False
     
-    return (current_prd, was_stopped)
+    def _set(self, kind: str, body):
+        previous_kind = self.state[0]
+        self.state = (kind, body)
+        self.version += 1
+        self.updated_at = time.monotonic()
+        # 在普通内容和画布之间切换时，页面需要整页重跑才能按新结构显示
+        if (kind == "canvas") != (previous_kind == "canvas"):
+            self.layout.bump()
+    
+    def markdown(self, body: str, unsafe_allow_html: bool = False):
+        self._set("html" if unsafe_allow_html else "markdown", body)
+    
+    def info(self, body: str):
+        self._set("info", body)
+    
+    def success(self, body: str):
+        self._set("success", body)
+    
+    def warning(self, body: str):
+        self._set("warning", body)
+    
+    def error(self, body: str):
+        self._set("error", body)
+    
+    def empty(self):
+        self._set("empty", "")
+    
+    def container(self):
+        """将占位替换为可追加内容的画布（供 SegmentedStreamRenderer 分段输出）"""
+        canvas = JobCanvas(self.layout)
+        self._set("canvas", canvas)
+        return canvas
+    
+    def freeze(self):
+        """定格当前内容：之后不再写入，页面轮询时不再重发（如已写完的策划案章节）"""
+        if not self.frozen:
+            self.frozen = True
+            self.layout.bump()
+
+
+class JobCanvas:
+    """
+    后台任务的输出画布（对应 st.container()），按顺序记录输出块
+    
+    支持静态内容（markdown/info/success/warning/error）、empty() 占位和 expander() 折叠区，
+    页面由 render_job_canvas() 重放为 Streamlit 组件。
+    """
+    
+    def __init__(self, layout: Optional[JobLayout] = None):
+        self.layout = layout or JobLayout()
+        self.blocks = []  # [(类型, 内容)]，只追加
+    
+    def _append(self, kind: str, body):
+        self.blocks.append((kind, body))
+        self.layout.bump()
+    
+    def markdown(self, body: str, unsafe_allow_html: bool = False):
+        self._append("html" if unsafe_allow_html else "markdown", body)
+    
+    def info(self, body: str):
+        self._append("info", body)
+    
+    def success(self, body: str):
+        self._append("success", body)
+    
+    def warning(self, body: str):
+        self._append("warning", body)
+    
+    def error(self, body: str):
+        self._append("error", body)
+    
+    def empty(self) -> JobSlot:
+        slot = JobSlot(self.layout)
+        self._append("slot", slot)
+        return slot
+    
+    def container(self) -> "JobCanvas":
+        canvas = JobCanvas(self.layout)
+        self._append("canvas", canvas)
+        return canvas
+    
+    def expander(self, label: str, expanded: bool = False) -> "JobCanvas":
+        canvas = JobCanvas(self.layout)
+        self._append("expander", (label, expanded, canvas))
+        return canvas
+
+
+def _render_job_block(kind: str, body, in_expander: bool, watched: Optional[list]):
+    """渲染画布中的单个输出块（占位需先取出其状态）"""
+    if kind == "canvas":
+        render_job_canvas(body, in_expander, watched)
+    elif kind == "expander":
+        label, expanded, child = body
+        if in_expander:
+            st.markdown(f"**{label}**")
+            render_job_canvas(child, True, watched)
+        else:
+            with st.expander(label, expanded=expanded):
+                render_job_canvas(child, True, watched)
+    elif kind == "markdown":
+        st.markdown(body)
+    elif kind == "html":
+        st.markdown(body, unsafe_allow_html=True)
+    elif kind in ("info", "success", "warning", "error"):
+        getattr(st, kind)(body)
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_live_job_slot(slot: JobSlot):
+    """
+    定时刷新单个仍在写入的占位，轮询时只重发该占位的内容
+    
+    占位变为画布或被定格属于布局变化，由 render_job_status 触发整页重跑后按新布局渲染。
+    """
+    kind, body = slot.state
+    if kind not in ("canvas", "expander"):
+        _render_job_block(kind, body, False, None)
+
+
+def render_job_canvas(canvas: JobCanvas, in_expander: bool = False, watched: Optional[list] = None):
+    """
+    将任务画布重放为 Streamlit 组件
+    
+    Args:
+        canvas: 任务画布
+        in_expander: 是否已位于折叠区内（Streamlit 不支持嵌套折叠区，内层以标题形式展示）
+        watched: 任务仍在进行时传入列表：最近仍在写入的占位放入各自的轮询片段，其余内容只渲染一次，
+                 只渲染一次的占位以 (占位, 版本) 记入该列表，供 render_job_status 检查是否再次被写入
+    """
+    for kind, body in list(canvas.blocks):
+        if kind == "slot":
+            slot = body
+            version = slot.version
+            kind, body = slot.state
+            if watched is not None and kind != "canvas":
+                if not slot.frozen and time.monotonic() - slot.updated_at < JOB_SLOT_IDLE_SECONDS:
+                    render_live_job_slot(slot)
+                    continue
+                watched.append((slot, version))
+        _render_job_block(kind, body, in_expander, watched)
+
+
+class Job:
+    """
+    后台任务：在工作线程中执行，输出写入画布，结果写入 result
+    
+    should_stop / last_error / thinking_content / last_model_used 与 session_state 中的同名状态含义一致
+    （见 get_run_state）；中止标志即任务的取消令牌，一经设置就保持有效，任务内后续步骤都会跳过。
+    """
+    
+    def __init__(self, kind: str, ctx: dict):
+        """
+        Args:
+            kind: 任务所属功能（与功能模块名称一致，每个会话每种功能同时只关联一个任务）
+            ctx: 提交任务时采集的调用参数（get_call_context()）
+        """
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.token = CancellationToken()
+        # 取消令牌随调用参数传到调用层，中止时立即关闭进行中的请求
+        self.ctx = dict(ctx, cancel_token=self.token)
+        self.status = "running"  # running, done, error, cancelled
+        self.phase = ""  # 当前阶段说明，显示在进度区
+        self.canvas = JobCanvas()
+        self.result = {}
+        self.error = ""
+        self.created_at = time.time()
+        self.finished_at = None
+        self.last_error = ""
+        self.thinking_content = ""
+        self.last_model_used = ctx.get("model", "")
+        self.meta = {}  # 提交方附带的信息（如用户输入），取回结果时使用
+        self.future = None  # 线程池中的执行句柄（排队中的任务可直接取消）
+        self._cleanups = []  # 任务结束后必须执行的清理（见 add_cleanup）
+        self._cleanup_lock = threading.Lock()
+    
+    @property
+    def should_stop(self) -> bool:
+        return self.token.cancelled
+    
+    @should_stop.setter
+    def should_stop(self, value: bool):
+        # 流式调用检测到中止后会清除标志（页面中下一次生成需要），后台任务忽略清除
+        if value:
+            self.token.cancel()
+    
+    @property
+    def finished(self) -> bool:
+        return self.status != "running"
+    
+    def cancel(self):
+        """中止任务：进行中的模型调用、排队和重试等待立即取消；仍在排队的任务不再执行"""
+        self.token.cancel()
+        if self.future is not None:
+            self.future.cancel()
+    
+    def add_cleanup(self, fn):
+        """登记任务结束后的清理（如删除临时文件）；任务未执行就被取消时同样执行"""
+        with self._cleanup_lock:
+            self._cleanups.append(fn)
+    
+    def run_cleanups(self):
+        """执行并清空已登记的清理（只执行一次，单个清理失败不影响其他清理）"""
+        with self._cleanup_lock:
+            cleanups, self._cleanups = self._cleanups, []
+        for fn in cleanups:
+            try:
+                fn()
+            except Exception as e:
+                logger.warning("job %s cleanup failed: %s", self.id, e)
+
+
+class JobManager:
+    """
+    进程级后台任务管理
+    
+    任务在线程池中执行，不依赖发起任务的脚本运行：页面重跑、切换功能、刷新或断线重连都不会中断任务，
+    任务对象按ID保存，结束后保留 JOB_RETENTION_SECONDS 供页面取回结果。
+    """
+    
+    def __init__(self, max_workers: int = JOB_MAX_WORKERS):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="yogort-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+    
+    def submit(self, kind: str, ctx: dict, fn, *args, cleanup=None) -> Job:
+        """
+        提交后台任务
+        
+        Args:
+            kind: 任务所属功能
+            ctx: 调用参数（必须在脚本线程中通过 get_call_context() 采集）
+            fn: 任务函数，签名为 fn(job, *args)；抛出异常时任务标记为失败
+            cleanup: 任务结束后执行的清理（可选）；任务在排队中被取消或随进程退出被丢弃时同样执行
+        
+        Returns:
+            Job: 任务对象
+        """
+        job = Job(kind, ctx)
+        if cleanup is not None:
+            job.add_cleanup(cleanup)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        job.future = self._executor.submit(self._run, job, fn, args)
+        job.future.add_done_callback(lambda future: self._on_done(job, future))
+        return job
+    
+    @staticmethod
+    def _on_done(job: Job, future: concurrent.futures.Future):
+        """任务未执行就被取消（排队中中止、关闭线程池）时标记结束并执行清理"""
+        if future.cancelled():
+            job.finished_at = time.time()
+            job.status = "cancelled"
+            job.run_cleanups()
+    
+    def _run(self, job: Job, fn, args: tuple):
+        thread = threading.current_thread()
+        thread.yogort_job = job
+        status = "error"
+        try:
+            fn(job, *args)
+            status = "cancelled" if job.should_stop else "done"
+        except Exception as e:
+            logger.warning("job %s (%s) failed: %s", job.id, job.kind, e, exc_info=logger.isEnabledFor(logging.DEBUG))
+            job.error = str(e)
+            status = "cancelled" if job.should_stop else "error"
+        finally:
+            thread.yogort_job = None
+            job.run_cleanups()
+        job.finished_at = time.time()
+        job.status = status
+    
+    def _prune(self):
+        """移除结束已久的任务（调用方持有锁）"""
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at and now - job.finished_at > JOB_RETENTION_SECONDS
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+    
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def running_count(self) -> int:
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job.finished)
+    
+    def shutdown(self):
+        """中止所有任务并关闭线程池"""
+        with self._lock:
+            for job in self._jobs.values():
+                job.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+@st.cache_resource(show_spinner=False)
+def get_job_manager() -> JobManager:
+    """获取进程级后台任务管理器（所有会话共享）"""
+    manager = JobManager()
+    atexit.register(manager.shutdown)
+    return manager
+
+
+def _sync_job_query_params():
+    """将当前会话关联的任务ID写入 URL 参数"""
+    job_ids = ",".join(st.session_state.active_jobs.values())
+    if job_ids:
+        st.query_params[JOB_QUERY_PARAM] = job_ids
+    elif JOB_QUERY_PARAM in st.query_params:
+        del st.query_params[JOB_QUERY_PARAM]
+
+
+def restore_active_jobs():
+    """新会话初始化时根据 URL 参数重新关联仍保留的任务（刷新页面或断线重连）"""
+    st.session_state.active_jobs = {}
+    manager = get_job_manager()
+    for job_id in st.query_params.get(JOB_QUERY_PARAM, "").split(","):
+        job = manager.get(job_id) if job_id else None
+        if job is not None:
+            st.session_state.active_jobs[job.kind] = job.id
+    _sync_job_query_params()
+
+
+def start_job(kind: str, fn, *args, cleanup=None) -> Job:
+    """
+    在后台启动任务并关联到当前会话（同一功能的上一个任务会被中止）
+    
+    Args:
+        kind: 任务所属功能（功能模块名称）
+        fn: 任务函数，签名为 fn(job, *args)
+        cleanup: 任务结束（或未执行就被取消）后执行的清理（可选，见 JobManager.submit）
+    
+    Returns:
+        Job: 任务对象
+    """
+    cancel_active_job(kind)
+    job = get_job_manager().submit(kind, get_call_context(), fn, *args, cleanup=cleanup)
+    st.session_state.active_jobs[kind] = job.id
+    _sync_job_query_params()
+    return job
+
+
+def get_active_job(kind: str) -> Optional[Job]:
+    """获取当前会话中某功能关联的任务（任务已被清理时返回None）"""
+    job_id = st.session_state.active_jobs.get(kind)
+    return get_job_manager().get(job_id) if job_id else None
+
+
+def is_job_running(kind: str) -> bool:
+    job = get_active_job(kind)
+    return job is not None and not job.finished
+
+
+def release_active_job(kind: str) -> Optional[Job]:
+    """解除任务与会话的关联（结果已取回），返回该任务"""
+    job = get_active_job(kind)
+    st.session_state.active_jobs.pop(kind, None)
+    _sync_job_query_params()
+    return job
+
+
+def cancel_active_job(kind: str):
+    """中止并解除当前会话中某功能关联的任务"""
+    job = release_active_job(kind)
+    if job is not None:
+        job.cancel()
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_job_status(kind: str, layout_version: int, watched: list):
+    """
+    定时刷新的阶段说明和中止按钮；任务结束、画布布局变化或只渲染一次的占位再次被写入时整页重跑
+    
+    Args:
+        kind: 任务所属功能
+        layout_version: 本次整页渲染时画布的布局版本
+        watched: 本次整页渲染中只渲染一次的占位及其版本 [(JobSlot, int)]
+    """
+    job = get_active_job(kind)
+    if (job is None or job.finished or job.canvas.layout.version != layout_version
+            or any(slot.version != version for slot, version in watched)):
+        st.rerun()
+    
+    col_status, col_stop = st.columns([4, 1])
+    with col_status:
+        st.markdown(f"**{job.phase or '⏳ 正在处理...'}**")
+    with col_stop:
+        if st.button("⏹️ 中止", key=f"stop_job_{kind}", type="secondary", disabled=job.should_stop):
+            job.cancel()
+            st.warning("⏹️ 正在中止...")
+
+
+def render_job_progress(kind: str):
+    """
+    任务进度区：阶段说明、中止按钮和任务输出；任务结束后整页重跑以取回结果
+    
+    已定格或空闲的内容（如写完的策划案章节、结束的思考过程）只在整页重跑时渲染一次，
+    轮询片段只重发仍在写入的占位，每次轮询推送的数据量与正在输出的内容成正比，而不是与整个画布成正比。
+    
+    Args:
+        kind: 任务所属功能
+    """
+    job = get_active_job(kind)
+    if job is None:
+        return
+    # 先读布局版本再渲染：渲染期间布局发生变化时，下一次轮询会触发整页重跑
+    layout_version = job.canvas.layout.version
+    # 阶段说明显示在输出上方，但需要等画布渲染完才知道哪些占位只渲染了一次
+    status_area = st.container()
+    watched = []
+    render_job_canvas(job.canvas, watched=watched)
+    with status_area:
+        render_job_status(kind, layout_version, watched)
+
+
+def run_generate_prd_job(job: Job, final_input: str, attachment_name: str, parallel: bool, pipelined: bool,
+                         fast: bool = False):
+    """
+    后台任务：生成策划案并进行AI复检
+    
+    Args:
+        job: 当前任务
+        final_input: 功能描述（含附件内容）
+        attachment_name: 附件名称（无附件时为空）
+        parallel: 是否并行复检
+        pipelined: 是否边生成边复检（仅并行复检时有效）
+        fast: 是否快速生成（先生成大纲，再并行撰写各章节）
+    """
+    ui = job.canvas
+    pipeline = SelfCheckPipeline(job.ctx) if parallel and pipelined else None
+    if pipeline:
+        # 中止时立即取消已提交的复检请求
+        job.token.add_callback(pipeline.cancel)
+    try:
+        job.phase = "✍️ 策划酸奶正在撰写策划案..."
+        ui.markdown("### 📄 生成的策划案")
+        if attachment_name:
+            ui.info(f"📎 已包含附件: {attachment_name}")
+        if fast:
+            status_container = ui.empty()
+            result, success, error = generate_prd_fast(
+                final_input,
+                ui.empty(),
+                status_container=status_container,
+                text_callback=pipeline.feed if pipeline else None
+            )
+        else:
+            thinking_container = ui.expander("💭 查看模型思考过程", expanded=False).empty()
+            status_container = ui.empty()
+            result, success, error = generate_prd(
+                final_input,
+                use_stream=True,
+                container=ui.empty(),
+                thinking_container=thinking_container,
+                status_container=status_container,
+                text_callback=pipeline.feed if pipeline else None
+            )
+        # 中止时保留部分结果
+        job.result["prd"] = result
+        if not (success and result):
+            if not job.should_stop:
+                raise RuntimeError(error or "生成失败，请重试")
+            return
+        if pipeline:
+            pipeline.finish(result)
+        
+        job.phase = "🔍 AI正在进行复检清单检查..."
+        ui.success("✅ 策划案生成完成！")
+        ui.markdown("### 🔍 AI复检清单检查结果")
+        thinking_container = ui.expander("💭 查看模型思考过程", expanded=False).empty()
+        status_container = ui.empty()
+        check_container = ui.empty()
+        if pipeline is not None:
+            # 边生成边复检：大部分条目已在生成过程中完成，这里只需收集结果
+            check_result, success, error = pipeline.collect(check_container, status_container)
+        else:
+            check_result, success, error = ai_self_check(
+                result,
+                use_stream=True,
+                container=check_container,
+                thinking_container=thinking_container,
+                status_container=status_container,
+                parallel=parallel
+            )
+        job.result["check"] = check_result if success else ""
+        job.result["check_error"] = error
+    finally:
+        if pipeline:
+            pipeline.cancel()
+
+
+def run_optimize_prd_job(job: Job, run_id: str):
+    """
+    后台任务：优化策划案（初始修正 → Reflection 循环 → AI复检），各阶段结果写入检查点
+    
+    从检查点继续时使用首次提交时的设置，跳过已完成的初始修正和迭代轮次。
+    
+    Args:
+        job: 当前任务
+        run_id: 检查点ID（ReflectionCheckpointStore.create_run 创建）
+    """
+    store = get_checkpoint_store()
+    checkpoint = store.load(run_id)
+    if checkpoint is None:
+        raise RuntimeError("检查点不存在或已过期，请重新开始优化")
+    settings = checkpoint["settings"]
+    # 继续优化时沿用首次提交时选择的模型及其降级链（当前采集的降级链属于现在选择的模型）
+    job.ctx["model"] = settings["model"]
+    if "fallback_models" in settings:
+        job.ctx["fallback_models"] = list(settings["fallback_models"])
+    elif job.ctx["fallback_models"]:
+        # 旧版检查点没有保存降级链：按保存的模型重新计算
+        job.ctx["fallback_models"] = get_fallback_models("优化策划案", settings["model"])
+    job.last_model_used = settings["model"]
+    store.set_status(run_id, "running")
+    
+    ui = job.canvas
+    ui.markdown("### 📌 Step 1: 初始修正")
+    initial_fixed = checkpoint["initial_prd"]
+    if initial_fixed:
+        ui.info("♻️ 已从检查点恢复初始修正结果")
+    else:
+        job.phase = "✏️ 正在进行初始修正..."
+        if settings["attachment_name"]:
+            ui.info(f"📎 参考附件: {settings['attachment_name']}")
+        thinking_container = ui.expander("💭 查看模型思考过程", expanded=False).empty()
+        status_container = ui.empty()
+        initial_fixed, success, error = optimize_prd_initial(
+            settings["old_prd"],
+            settings["feedback"],
+            use_stream=True,
+            container=ui.empty(),
+            thinking_container=thinking_container,
+            status_container=status_container
+        )
+        if not (success and initial_fixed):
+            if job.should_stop:
+                store.set_status(run_id, "stopped")
+                return
+            store.set_status(run_id, "failed", error)
+            raise RuntimeError(f"初始修正失败: {error}" if error else "初始修正失败，请重试")
+        store.save_initial(run_id, initial_fixed)
+        ui.success("初始修正完成！")
+    job.result["initial_prd"] = initial_fixed
+    ui.markdown("---")
+    
+    job.phase = "🔁 正在进行 Reflection 循环优化..."
+    ui.markdown("### 🔁 Step 2: Reflection 循环优化")
+    max_iterations = settings["max_iterations"]
+    final_prd, was_stopped, error, convergence_note = reflection_loop(
+        initial_fixed, max_iterations, ui.container(), run_id, checkpoint["rounds"],
+        settings.get("convergence_threshold", 0.0), settings.get("patch_mode", False),
+        settings.get("incremental_review", False), settings.get("review_personas"), settings.get("sharded", False)
+    )
+    job.result["prd"] = final_prd
+    job.result["convergence"] = convergence_note
+    if was_stopped:
+        store.set_status(run_id, "stopped")
+        return
+    if error:
+        store.set_status(run_id, "failed", error)
+        raise RuntimeError(f"Reflection 迭代失败（已完成的轮次已保存，可继续优化）: {error}")
+    if not convergence_note:
+        ui.success(f"完成 {max_iterations} 轮迭代优化！")
+    ui.markdown("---")
+    
+    job.phase = "🔍 AI正在进行最终复检清单检查..."
+    ui.markdown("### 🔍 Step 3: AI复检清单检查")
+    thinking_container = ui.expander("💭 查看模型思考过程", expanded=False).empty()
+    status_container = ui.empty()
+    check_result, success, error = ai_self_check(
+        final_prd,
+        use_stream=True,
+        container=ui.empty(),
+        thinking_container=thinking_container,
+        status_container=status_container,
+        parallel=settings["parallel"]
+    )
+    job.result["check"] = check_result if success else ""
+    job.result["check_error"] = error
+    if job.should_stop:
+        store.set_status(run_id, "stopped")
+    else:
+        store.set_status(run_id, "done")
+
+
+def run_stream_job(job: Job, prompt: str, system_prompt: str, phase: str):
+    """
+    后台任务：单次流式生成，正文写入 result["text"]
+    
+    Args:
+        job: 当前任务
+        prompt: 用户提示词
+        system_prompt: 系统提示词
+        phase: 进度区显示的阶段说明
+    """
+    job.phase = phase
+    thinking_container = job.canvas.expander("💭 查看模型思考过程", expanded=False).empty()
+    status_container = job.canvas.empty()
+    text, success, error = stream_to_container(prompt, system_prompt, job.canvas.empty(), thinking_container,
+                                               status_container)
+    job.result["text"] = text
+    if not success and not job.should_stop:
+        raise RuntimeError(error or "生成失败，请重试")
+
+
+def remove_temp_file(path: str):
+    """删除本地临时文件（文件已不存在时忽略）"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def run_wow_review_job(job: Job, video_path: str, review_prompt: str):
+    """
+    后台任务：上传游玩视频并生成 WoW 玩法评审报告，报告写入 result["text"]
+    
+    Args:
+        job: 当前任务
+        video_path: 本地临时视频文件（由提交方登记为任务清理，任务未执行时同样删除）
+        review_prompt: 评审提示词
+    """
+    ui = job.canvas
+    status_container = ui.empty()
+    # 上传的视频只能用同一个 Key 访问，整个评审过程固定使用一个 Key
+    wow_api_key = select_api_key(job.ctx)
+    # 上传、轮询和分析可能持续数分钟，整个任务期间占用客户端，避免被空闲回收
+    with get_client_registry().lease(wow_api_key) as client:
+        uploaded_file_obj = None
+        try:
+            job.phase = "📤 正在上传视频到AI服务..."
+            status_container.info(job.phase)
+            
+            # 所有请求经由重试调度器（可重试错误自动退避重试，服务持续失败时快速失败）
+            retry_scheduler = get_retry_scheduler()
+            
+            # 上传视频到 Gemini File API (使用 client.aio.files.upload)
+            uploaded_file_obj = run_async(retry_scheduler.run(
+                lambda _: client.aio.files.upload(
+                    file=video_path,
+                    config={"display_name": "WoW_Gameplay"}
+                ),
+                lambda: wow_api_key,
+                "files"  # 文件接口与模型无关，单独统计熔断
+            ))
+            
+            job.phase = "⏳ 视频正在处理中，请耐心等待..."
+            status_container.info(job.phase)
+            
+            # 等待视频处理完成
+            while uploaded_file_obj.state.name == "PROCESSING":
+                # 中止时立即结束等待（不再等满轮询间隔）
+                if job.token.wait(2):
+                    return
+                uploaded_file_obj = run_async(retry_scheduler.run(
+                    lambda _: client.aio.files.get(name=uploaded_file_obj.name),
+                    lambda: wow_api_key,
+                    "files"
+                ))
+            
+            if uploaded_file_obj.state.name == "FAILED":
+                raise RuntimeError("视频处理失败，请尝试上传其他视频。")
+            if uploaded_file_obj.state.name != "ACTIVE":
+                raise RuntimeError(f"视频状态异常: {uploaded_file_obj.state.name}")
+            
+            job.phase = "🤖 AI 正在分析视频内容..."
+            status_container.info(job.phase)
+            
+            # 调用模型生成评审报告，过载时按降级链改用备用模型
+            wow_models = [job.ctx["model"]] + job.ctx["fallback_models"]
+            for model_index, current_model in enumerate(wow_models):
+                try:
+                    response = run_async(retry_scheduler.run(
+                        lambda _: client.aio.models.generate_content(
+                            model=current_model,
+                            contents=[uploaded_file_obj, review_prompt]
+                        ),
+                        lambda: wow_api_key,
+                        current_model
+                    ))
+                    break
+                except Exception as e:
+                    if should_fallback(e) and model_index < len(wow_models) - 1:
+                        status_container.info(f"🔄 {current_model} 暂时不可用，改用 {wow_models[model_index + 1]}...")
+                        continue
+                    raise
+            job.last_model_used = current_model
+            record_call_usage(job.ctx, get_usage_tokens(response.usage_metadata))
+            
+            if not (response and response.text):
+                raise RuntimeError("AI 未能生成评审结果，请重试。")
+            job.result["text"] = response.text
+            status_container.empty()
+        
+        finally:
+            # 可选：删除云端文件
+            if uploaded_file_obj:
+                try:
+                    client.files.delete(name=uploaded_file_obj.name)
+                except:
+                    pass
 
 
 def main():
@@ -2190,8 +6979,6 @@ def main():
         st.session_state.generated_prd = ""
     if "optimized_prd" not in st.session_state:
         st.session_state.optimized_prd = ""
-    if "is_processing" not in st.session_state:
-        st.session_state.is_processing = False
     
     # 初始化会话历史
     init_session_history()
@@ -2203,18 +6990,10 @@ def main():
         st.session_state.show_history_detail = False
     
     # 尝试从 Streamlit Secrets 获取 API Key（用于云部署）
-    default_api_key = ""
-    secrets_api_key_loaded = False
-    try:
-        if "GOOGLE_API_KEY" in st.secrets:
-            default_api_key = st.secrets["GOOGLE_API_KEY"]
-            secrets_api_key_loaded = True
-        elif "GEMINI_API_KEY" in st.secrets:
-            default_api_key = st.secrets["GEMINI_API_KEY"]
-            secrets_api_key_loaded = True
-    except Exception:
-        # 本地运行时可能没有 secrets 文件
-        pass
+    # 配置了多个 Key（GOOGLE_API_KEYS）时，实际请求由 Key 池分配
+    secrets_api_keys = load_secrets_api_keys()
+    default_api_key = secrets_api_keys[0] if secrets_api_keys else ""
+    secrets_api_key_loaded = bool(secrets_api_keys)
     
     if "api_key" not in st.session_state:
         st.session_state.api_key = default_api_key
@@ -2232,12 +7011,36 @@ def main():
     # 中止控制
     if "should_stop" not in st.session_state:
         st.session_state.should_stop = False
+    # 后台任务（新会话根据 URL 参数重新关联刷新前的任务）
+    if "active_jobs" not in st.session_state:
+        restore_active_jobs()
     # 错误信息
     if "last_error" not in st.session_state:
         st.session_state.last_error = ""
     # 思考过程
     if "thinking_content" not in st.session_state:
         st.session_state.thinking_content = ""
+    # 响应缓存（默认关闭，需用户手动开启）
+    if "response_cache_enabled" not in st.session_state:
+        st.session_state.response_cache_enabled = False
+    if "bypass_response_cache" not in st.session_state:
+        st.session_state.bypass_response_cache = False
+    if "parallel_self_check" not in st.session_state:
+        st.session_state.parallel_self_check = True
+    if "pipelined_self_check" not in st.session_state:
+        st.session_state.pipelined_self_check = True
+    # 模型降级（默认开启）及实际使用的模型
+    if "model_fallback_enabled" not in st.session_state:
+        st.session_state.model_fallback_enabled = True
+    if "last_model_used" not in st.session_state:
+        st.session_state.last_model_used = ""
+    # 对冲请求（默认关闭）
+    if "hedge_enabled" not in st.session_state:
+        st.session_state.hedge_enabled = False
+    if "hedge_model" not in st.session_state:
+        st.session_state.hedge_model = ""
+    if "hedge_percentile" not in st.session_state:
+        st.session_state.hedge_percentile = 90
     
     # ========== 侧边栏 - API配置 ==========
     with st.sidebar:
@@ -2327,6 +7130,16 @@ def main():
         # 云端部署提示
         if st.session_state.secrets_api_key_loaded:
             st.caption("💡 云端部署模式：API Key 已安全存储")
+            
+            # 多 Key 负载均衡的使用情况
+            key_pool = get_api_key_pool()
+            if len(key_pool.api_keys) > 1:
+                with st.expander(f"🔑 API Key 池（{len(key_pool.api_keys)} 个）"):
+                    for key_usage in key_pool.usage_report():
+                        st.caption(
+                            f"{key_usage['key']}：{key_usage['status']}，请求 {key_usage['requests']} 次，"
+                            f"token {key_usage['tokens']:,}，限流 {key_usage['throttles']} 次"
+                        )
         
         st.markdown("---")
         
@@ -2348,6 +7161,93 @@ def main():
         
         st.markdown("---")
         
+        # 响应缓存设置
+        st.subheader("💾 响应缓存")
+        st.session_state.response_cache_enabled = st.checkbox(
+            "启用响应缓存",
+            value=st.session_state.response_cache_enabled,
+            help="模型、提示词、输入内容和生成配置完全相同的请求将直接复用之前的结果（多轮讨论类功能不缓存）"
+        )
+        if st.session_state.response_cache_enabled:
+            st.session_state.bypass_response_cache = st.toggle(
+                "绕过缓存（强制重新生成）",
+                value=st.session_state.bypass_response_cache,
+                help="开启后不读取缓存，新生成的结果仍会写入缓存"
+            )
+            response_cache = get_response_cache()
+            cache_stats = response_cache.stats
+            st.caption(
+                f"命中：内存 {cache_stats['memory_hits']} / 磁盘 {cache_stats['disk_hits']}，"
+                f"未命中 {cache_stats['misses']}"
+            )
+            if st.button("🗑️ 清空缓存", key="clear_response_cache"):
+                response_cache.clear()
+                st.success("缓存已清空")
+        
+        st.markdown("---")
+        
+        # 性能设置
+        st.subheader("⚡ 性能设置")
+        st.session_state.parallel_self_check = st.checkbox(
+            "并行复检",
+            value=st.session_state.parallel_self_check,
+            help="复检清单10项同时检查，耗时接近单项检查；关闭后恢复整体逐项生成（可查看思考过程）"
+        )
+        if st.session_state.parallel_self_check:
+            st.session_state.pipelined_self_check = st.checkbox(
+                "边生成边复检",
+                value=st.session_state.pipelined_self_check,
+                help="生成策划案时，每写完一个章节就开始检查依赖该章节的清单条目，生成结束后复检结果几乎立即可用"
+            )
+        st.session_state.model_fallback_enabled = st.checkbox(
+            "模型自动降级",
+            value=st.session_state.model_fallback_enabled,
+            help="当前模型过载（重试用尽或熔断）时自动改用更轻量的模型，例如 pro → flash → flash-lite"
+        )
+        st.session_state.hedge_enabled = st.checkbox(
+            "对冲请求（汇报助手 / 白皮书助手）",
+            value=st.session_state.hedge_enabled,
+            help="首字迟迟未返回时再发出一个相同的请求，先返回的胜出，另一个自动取消"
+        )
+        if st.session_state.hedge_enabled:
+            st.session_state.hedge_percentile = st.select_slider(
+                "对冲阈值（首字延迟分位数）",
+                options=[50, 75, 90, 95, 99],
+                value=st.session_state.hedge_percentile,
+                format_func=lambda p: f"P{p}",
+                help=f"主请求的首字延迟超过历史该分位数时发出对冲请求（样本不足 {HEDGE_MIN_SAMPLES} 个时固定为 {HEDGE_DEFAULT_DELAY_SECONDS:.0f} 秒）"
+            )
+            hedge_model_options = [""] + [m for m in st.session_state.models_list if m != get_selected_model()]
+            st.session_state.hedge_model = st.selectbox(
+                "对冲请求模型",
+                options=hedge_model_options,
+                index=hedge_model_options.index(st.session_state.hedge_model) if st.session_state.hedge_model in hedge_model_options else 0,
+                format_func=lambda m: m or "与当前模型相同",
+                help="可选择更快的模型作为对冲请求"
+            )
+            hedge_stats = get_hedge_stats().snapshot()
+            st.caption(
+                f"对冲率 {hedge_stats['hedge_rate']:.0%}（{hedge_stats['hedged']}/{hedge_stats['requests']}），"
+                f"主请求胜出 {hedge_stats['primary_wins']} 次，对冲请求胜出 {hedge_stats['hedge_wins']} 次"
+                + (f"（对冲首字延迟均值 {hedge_stats['hedge_ttft']:.1f} 秒）" if hedge_stats["hedge_wins"] else "")
+            )
+        queue_stats = get_rate_limiter().snapshot()
+        st.caption(
+            f"限流排队：当前 {queue_stats['waiting']} 个请求等待中，累计排队 {queue_stats['queued']} 次"
+        )
+        retry_stats = get_retry_scheduler().snapshot()
+        st.caption(
+            f"请求重试 {retry_stats['retries']} 次（服务端提示 {retry_stats['server_hints']} 次），"
+            f"熔断拒绝 {retry_stats['circuit_rejections']} 次"
+            + (f"，{retry_stats['open_circuits']} 个Key/模型熔断中" if retry_stats['open_circuits'] else "")
+        )
+        # 本会话在后台运行的任务（切换功能后任务继续执行，回到对应功能即可查看进度）
+        running_jobs = [kind for kind in st.session_state.active_jobs if is_job_running(kind)]
+        if running_jobs:
+            st.caption("🧵 后台任务进行中：" + "、".join(running_jobs))
+        
+        st.markdown("---")
+        
         # 帮助信息
         with st.expander("📖 使用帮助"):
             st.markdown("""
@@ -2435,11 +7335,13 @@ def main():
                 st.session_state.viewing_history_id = None
                 st.rerun()
             
-            col_info1, col_info2 = st.columns(2)
+            col_info1, col_info2, col_info3 = st.columns(3)
             with col_info1:
                 st.markdown(f"**功能类型：** {history_item.get('function_type', '未知')}")
             with col_info2:
                 st.markdown(f"**生成时间：** {history_item.get('timestamp', '未知')}")
+            with col_info3:
+                st.markdown(f"**生成模型：** {history_item.get('model') or '未知'}")
             
             # 显示输入数据
             with st.expander("📥 输入内容", expanded=False):
@@ -2567,151 +7469,75 @@ def main():
         if "generated_check_result" not in st.session_state:
             st.session_state.generated_check_result = ""
         
-        # 使用session_state跟踪当前处理阶段
+        # 生成过程由后台任务执行，session_state 只记录是否已完成（用于保存历史）
         if "current_stage" not in st.session_state:
-            st.session_state.current_stage = "idle"  # idle, generating, checking, done
+            st.session_state.current_stage = "idle"  # idle, done
         
-        if st.button("🚀 生成策划案", type="primary", disabled=st.session_state.is_processing):
+        fast_generate = st.checkbox(
+            "⚡ 快速生成",
+            value=False,
+            key="fast_generate",
+            help="先生成大纲（关键要点和决策），再按大纲同时撰写10个章节并按顺序拼接，耗时约为最长章节的撰写时间"
+        )
+        
+        if st.button("🚀 生成策划案", type="primary", disabled=is_job_running("生成策划案")):
             if not user_input.strip():
                 st.error("请输入功能描述！")
             else:
-                st.session_state.is_processing = True
-                st.session_state.should_stop = False  # 重置中止标志
                 st.session_state.generated_check_result = ""  # 清空之前的检查结果
                 st.session_state.generated_prd = ""  # 清空之前的结果
                 st.session_state.last_error = ""  # 清空错误
-                st.session_state.current_stage = "generating"
+                st.session_state.current_stage = "idle"
                 st.session_state.generate_saved_to_history = False  # 重置历史保存标记
-                # 保存用户输入和附件内容到session_state
-                st.session_state.saved_user_input = user_input
-                st.session_state.saved_attachment_content = st.session_state.get("uploaded_file_content", "")
-                st.session_state.saved_attachment_name = st.session_state.get("uploaded_file_name", "")
-                st.rerun()  # 触发重新渲染
-        
-        # 处理生成阶段
-        if st.session_state.is_processing and st.session_state.current_stage == "generating":
-            # 从session_state获取保存的输入
-            user_input_saved = st.session_state.get("saved_user_input", user_input)
-            attachment_content = st.session_state.get("saved_attachment_content", "")
-            attachment_name = st.session_state.get("saved_attachment_name", "")
-            
-            # 流式生成策划案
-            st.markdown("### 📄 生成的策划案")
-            
-            # 显示中止按钮和状态
-            col_status, col_stop = st.columns([4, 1])
-            with col_status:
-                st.markdown("**✍️ 策划酸奶正在撰写策划案...**")
-            with col_stop:
-                if st.button("⏹️ 中止生成", key="stop_generate", type="secondary"):
-                    st.session_state.should_stop = True
-                    st.session_state.is_processing = False
-                    st.session_state.current_stage = "idle"
-                    st.warning("⏹️ 生成已中止")
-                    st.rerun()
-            
-            # 思考过程展示区域（可折叠）
-            thinking_expander = st.expander("💭 查看模型思考过程", expanded=False)
-            with thinking_expander:
-                thinking_container = st.empty()
-            
-            # 状态和错误显示容器
-            status_container = st.empty()
-            
-            # 构建最终的输入（包含附件内容）
-            final_input = user_input_saved
-            if attachment_content:
-                final_input = f"""【用户功能描述】
-{user_input_saved}
+                attachment_content = st.session_state.get("uploaded_file_content", "")
+                attachment_name = st.session_state.get("uploaded_file_name", "")
+                
+                # 构建最终的输入（包含附件内容）
+                final_input = user_input
+                if attachment_content:
+                    final_input = f"""【用户功能描述】
+{user_input}
 
 【附件内容】（文件名: {attachment_name}）
 {attachment_content}
 
 请参考以上功能描述和附件内容，生成完整的策划案。"""
-                st.info(f"📎 已包含附件: {attachment_name}")
-            
-            # 创建容器用于流式显示
-            prd_container = st.empty()
-            result, success, error = generate_prd(
-                final_input, 
-                use_stream=True, 
-                container=prd_container,
-                thinking_container=thinking_container,
-                status_container=status_container
-            )
-            
-            if success and result:
-                st.session_state.generated_prd = result
+                
+                job = start_job(
+                    "生成策划案",
+                    run_generate_prd_job,
+                    final_input,
+                    attachment_name if attachment_content else "",
+                    st.session_state.parallel_self_check,
+                    st.session_state.pipelined_self_check,
+                    fast_generate
+                )
+                job.meta["user_input"] = user_input
+                st.rerun()  # 触发重新渲染
+        
+        # 后台任务进行中：定时刷新进度；结束后取回结果
+        generate_job = get_active_job("生成策划案")
+        if generate_job is not None and not generate_job.finished:
+            render_job_progress("生成策划案")
+        elif generate_job is not None:
+            release_active_job("生成策划案")
+            st.session_state.saved_user_input = generate_job.meta.get("user_input", "")
+            st.session_state.last_model_used = generate_job.last_model_used
+            # 中止时保留已生成的部分结果
+            st.session_state.generated_prd = generate_job.result.get("prd", "")
+            st.session_state.generated_check_result = generate_job.result.get("check", "")
+            if generate_job.status == "done":
+                st.session_state.current_stage = "done"
                 st.success("✅ 策划案生成完成！")
-                st.session_state.current_stage = "checking"
-                st.rerun()  # 进入下一阶段
-            elif error:
-                st.error(f"❌ 生成失败: {error}")
-                st.session_state.is_processing = False
-                st.session_state.current_stage = "idle"
-            elif st.session_state.should_stop:
-                st.warning("⏹️ 生成已中止")
-                if result:  # 如果有部分结果，保存它
-                    st.session_state.generated_prd = result
-                st.session_state.is_processing = False
-                st.session_state.current_stage = "idle"
-                st.session_state.should_stop = False
+                if generate_job.result.get("check_error"):
+                    st.error(f"❌ 复检失败: {generate_job.result['check_error']}")
+            elif generate_job.status == "cancelled":
+                st.warning(f"⏹️ 生成已中止{format_consumed_tokens(generate_job.token)}")
             else:
-                st.error("生成失败，请重试")
-                st.session_state.is_processing = False
-                st.session_state.current_stage = "idle"
-        
-        # 处理检查阶段
-        elif st.session_state.is_processing and st.session_state.current_stage == "checking":
-            # 显示已生成的策划案（格式化显示）
-            render_prd_document(st.session_state.generated_prd, "生成的策划案")
-            st.success("✅ 策划案生成完成！")
-            
-            # AI自检 - 流式输出
-            st.markdown("### 🔍 AI复检清单检查结果")
-            
-            # 显示中止按钮和状态
-            col_status, col_stop = st.columns([4, 1])
-            with col_status:
-                st.markdown("**🔍 AI正在进行复检清单检查...**")
-            with col_stop:
-                if st.button("⏹️ 中止检查", key="stop_check", type="secondary"):
-                    st.session_state.should_stop = True
-                    st.session_state.is_processing = False
-                    st.session_state.current_stage = "idle"
-                    st.warning("⏹️ 检查已中止")
-                    st.rerun()
-            
-            # 思考过程展示区域
-            thinking_expander = st.expander("💭 查看模型思考过程", expanded=False)
-            with thinking_expander:
-                thinking_container = st.empty()
-            
-            # 状态和错误显示容器
-            status_container = st.empty()
-            
-            check_container = st.empty()
-            check_result, success, error = ai_self_check(
-                st.session_state.generated_prd, 
-                use_stream=True, 
-                container=check_container,
-                thinking_container=thinking_container,
-                status_container=status_container
-            )
-            
-            if success and check_result:
-                st.session_state.generated_check_result = check_result
-                st.success("✅ 复检完成！")
-            elif error:
-                st.error(f"❌ 复检失败: {error}")
-            
-            st.session_state.is_processing = False
-            st.session_state.current_stage = "done"
-            st.session_state.should_stop = False
-            st.rerun()  # 刷新以显示最终结果和下载按钮
+                st.error(f"❌ 生成失败: {generate_job.error}")
         
         # 显示已保存的生成结果（非处理中状态）
-        if st.session_state.generated_prd and not st.session_state.is_processing:
+        if st.session_state.generated_prd and not is_job_running("生成策划案"):
             # 使用格式化显示函数
             render_prd_document(st.session_state.generated_prd, "生成的策划案")
             
@@ -2800,16 +7626,17 @@ def main():
                 with st.spinner("正在思考..."):
                     response_container = st.empty()
                     full_response = ""
+                    response_renderer = StreamRenderer(response_container, cursor="▌")
                     for chunk in call_gemini_stream(full_prompt, get_system_prompt_with_date(GENERATE_PRD_SYSTEM_PROMPT)):
                         if chunk["type"] == "text":
                             full_response += chunk["content"]
-                            response_container.markdown(full_response + "▌")
+                            response_renderer.update(full_response)
                         elif chunk["type"] == "error":
                             st.error(f"生成失败: {chunk['content']}")
                             break
                     
                     if full_response:
-                        response_container.markdown(full_response)
+                        response_renderer.flush()
                         add_chat_message(chat_key, "assistant", full_response)
                         st.rerun()
     
@@ -3003,22 +7830,25 @@ graph LR
             full_response = ""
             thinking_text = ""
             
+            result_renderer = StreamRenderer(result_container)
+            thinking_renderer = StreamRenderer(thinking_container.empty(), cursor="")
             for chunk_data in call_gemini_stream(mermaid_parse_prompt, MINDMAP_PARSE_SYSTEM_PROMPT):
                 chunk_type = chunk_data.get("type", "text")
                 chunk_content = chunk_data.get("content", "")
                 
                 if chunk_type == "text":
                     full_response += chunk_content
-                    result_container.markdown(full_response + " ▌")
+                    result_renderer.update(full_response)
                 elif chunk_type == "thinking":
                     thinking_text += chunk_content
-                    with thinking_container:
-                        st.markdown(thinking_text)
+                    thinking_renderer.update(thinking_text)
                 elif chunk_type == "error":
                     status_container.error(f"❌ 解析失败: {chunk_content}")
             
+            thinking_renderer.flush()
+            
             if full_response:
-                result_container.markdown(full_response)
+                result_renderer.flush()
                 st.session_state.mindmap_parsed_structure = full_response
                 status_container.success('✅ Mermaid结构解析完成！请点击"生成策划案"按钮继续。')
                 st.rerun()
@@ -3044,6 +7874,8 @@ graph LR
             full_response = ""
             thinking_text = ""
             
+            result_renderer = StreamRenderer(result_container)
+            thinking_renderer = StreamRenderer(thinking_container.empty(), cursor="")
             for chunk_data in call_gemini_with_image_stream(
                 image_info["data"],
                 parse_prompt,
@@ -3056,11 +7888,12 @@ graph LR
                 
                 if chunk_type == "text":
                     full_response += chunk_content
-                    result_container.markdown(full_response + " ▌")
+                    result_renderer.update(full_response)
                 elif chunk_type == "thinking":
                     thinking_text += chunk_content
-                    with thinking_container:
-                        st.markdown(thinking_text)
+                    thinking_renderer.update(thinking_text)
+                elif chunk_type == "queue":
+                    status_container.info(chunk_content)
                 elif chunk_type == "retry":
                     status_container.warning(chunk_content)
                 elif chunk_type == "error":
@@ -3068,8 +7901,10 @@ graph LR
                 elif chunk_type == "stopped":
                     status_container.warning("⚠️ 用户已中止")
             
+            thinking_renderer.flush()
+            
             if full_response:
-                result_container.markdown(full_response)
+                result_renderer.flush()
                 st.session_state.mindmap_parsed_structure = full_response
                 status_container.success('✅ 脑图结构解析完成！请点击"生成策划案"按钮继续。')
                 st.rerun()
@@ -3111,17 +7946,20 @@ graph LR
             full_response = ""
             thinking_text = ""
             
+            result_renderer = SegmentedStreamRenderer(result_container)
+            thinking_renderer = StreamRenderer(thinking_container.empty(), cursor="")
             for chunk_data in call_gemini_stream(generate_prompt, get_system_prompt_with_date(MINDMAP_TO_PRD_SYSTEM_PROMPT), thinking_container):
                 chunk_type = chunk_data.get("type", "text")
                 chunk_content = chunk_data.get("content", "")
                 
                 if chunk_type == "text":
                     full_response += chunk_content
-                    result_container.markdown(full_response + " ▌")
+                    result_renderer.update(full_response)
                 elif chunk_type == "thinking":
                     thinking_text += chunk_content
-                    with thinking_container:
-                        st.markdown(thinking_text)
+                    thinking_renderer.update(thinking_text)
+                elif chunk_type == "queue":
+                    status_container.info(chunk_content)
                 elif chunk_type == "retry":
                     status_container.warning(chunk_content)
                 elif chunk_type == "error":
@@ -3129,6 +7967,8 @@ graph LR
                 elif chunk_type == "stopped":
                     status_container.warning("⚠️ 用户已中止")
             
+            thinking_renderer.flush()
+            
             if full_response:
                 result_container.empty()
                 st.session_state.mindmap_generated_prd = full_response
@@ -3225,16 +8065,17 @@ graph LR
                 response_container = st.empty()
                 full_response = ""
                 
+                response_renderer = StreamRenderer(response_container, template="**🤖 AI：** {text}")
                 for chunk_data in call_gemini_stream(full_prompt, get_system_prompt_with_date(MINDMAP_TO_PRD_SYSTEM_PROMPT)):
                     chunk_type = chunk_data.get("type", "text")
                     chunk_content = chunk_data.get("content", "")
                     
                     if chunk_type == "text":
                         full_response += chunk_content
-                        response_container.markdown(f"**🤖 AI：** {full_response} ▌")
+                        response_renderer.update(full_response)
                 
                 if full_response:
-                    response_container.markdown(f"**🤖 AI：** {full_response}")
+                    response_renderer.flush()
                     add_chat_message(chat_key, "assistant", full_response)
                     st.rerun()
     
@@ -3328,10 +8169,53 @@ graph LR
                 value=3,
                 help="设置Reflection循环的迭代次数（1-10轮）"
             )
+            
+            early_stop = st.checkbox(
+                "收敛后提前结束",
+                value=True,
+                key="reflection_early_stop",
+                help="策划案几乎不再变化、且开发人员的问题大多与之前重复时，自动结束剩余轮次"
+            )
+            convergence_percent = st.slider(
+                "收敛阈值（策划案变化比例）",
+                min_value=1,
+                max_value=20,
+                value=int(REFLECTION_CONVERGENCE_THRESHOLD * 100),
+                format="%d%%",
+                disabled=not early_stop,
+                key="reflection_convergence_threshold"
+            )
+            
+            patch_mode = st.checkbox(
+                "补丁模式",
+                value=True,
+                key="reflection_patch_mode",
+                help="每轮只让策划输出修改或新增的章节并在本地合并，减少输出token；补丁无法应用时自动改为重写全文"
+            )
+            incremental_review = st.checkbox(
+                "增量审查",
+                value=True,
+                key="reflection_incremental_review",
+                help="第二轮起，未修改的章节只向开发人员发送标题和摘要，修改过的章节发送全文，减少输入token"
+            )
+            review_personas = st.multiselect(
+                "审查团",
+                options=list(REVIEW_PERSONAS),
+                default=[],
+                format_func=lambda persona: REVIEW_PERSONAS[persona]["name"],
+                key="reflection_review_personas",
+                help="每轮由多个角色同时审查，问题合并去重后交给策划修改；不选时由一位通用开发人员审查"
+            )
+            sharded = st.checkbox(
+                "章节并行优化",
+                value=False,
+                key="reflection_sharded",
+                help="长策划案适用：每轮按章节同时审查和修改（共享全文概要），合并后统一做一致性检查；开启后补丁模式、增量审查和审查团不生效"
+            )
         
-        # 使用session_state跟踪优化阶段
+        # 优化过程由后台任务执行，session_state 只记录是否已完成（用于保存历史）
         if "optimize_stage" not in st.session_state:
-            st.session_state.optimize_stage = "idle"  # idle, initial, reflection, checking, done
+            st.session_state.optimize_stage = "idle"  # idle, done
         if "initial_fixed_prd" not in st.session_state:
             st.session_state.initial_fixed_prd = ""
         if "saved_old_prd" not in st.session_state:
@@ -3340,13 +8224,14 @@ graph LR
             st.session_state.saved_feedback = ""
         if "saved_max_iterations" not in st.session_state:
             st.session_state.saved_max_iterations = 3
+        if "optimize_checkpoint_id" not in st.session_state:
+            # 刷新页面或重启服务后，从地址栏恢复最近一次优化的检查点
+            st.session_state.optimize_checkpoint_id = st.query_params.get(CHECKPOINT_QUERY_PARAM, "")
         
-        if st.button("🔄 开始优化", type="primary", disabled=st.session_state.is_processing):
+        if st.button("🔄 开始优化", type="primary", disabled=is_job_running("优化策划案")):
             if not old_prd.strip():
                 st.error("请输入原策划案！")
             else:
-                st.session_state.is_processing = True
-                st.session_state.should_stop = False  # 重置中止标志
                 st.session_state.last_error = ""  # 清空错误
                 st.session_state.optimized_prd = ""
                 st.session_state.optimized_check_result = ""
@@ -3355,164 +8240,101 @@ graph LR
                 st.session_state.saved_feedback = feedback
                 st.session_state.saved_max_iterations = max_iterations
                 st.session_state.optimize_saved_to_history = False  # 重置历史保存标记
-                # 保存附件内容
-                st.session_state.saved_optimize_attachment = st.session_state.get("uploaded_file_content", "")
-                st.session_state.saved_optimize_attachment_name = st.session_state.get("uploaded_file_name", "")
-                st.session_state.optimize_stage = "initial"
-                st.rerun()  # 触发重新渲染
-        
-        # 处理初始修正阶段
-        if st.session_state.is_processing and st.session_state.optimize_stage == "initial":
-            st.markdown("### 📌 Step 1: 初始修正")
-            
-            # 显示附件使用信息
-            optimize_attachment = st.session_state.get("saved_optimize_attachment", "")
-            optimize_attachment_name = st.session_state.get("saved_optimize_attachment_name", "")
-            if optimize_attachment:
-                st.info(f"📎 参考附件: {optimize_attachment_name}")
-            
-            # 显示中止按钮和状态
-            col_status, col_stop = st.columns([4, 1])
-            with col_status:
-                st.markdown("**✏️ 正在进行初始修正...**")
-            with col_stop:
-                if st.button("⏹️ 中止", key="stop_initial", type="secondary"):
-                    st.session_state.should_stop = True
-                    st.session_state.optimize_processing = False
-                    st.session_state.optimize_stage = "idle"
-                    st.warning("⏹️ 优化已中止")
-                    st.rerun()
-            
-            # 思考过程展示区域
-            thinking_expander = st.expander("💭 查看模型思考过程", expanded=False)
-            with thinking_expander:
-                thinking_container = st.empty()
-            
-            # 状态和错误显示容器
-            status_container = st.empty()
-            
-            # 构建包含附件的feedback
-            final_feedback = st.session_state.saved_feedback
-            if optimize_attachment:
-                final_feedback = f"""{st.session_state.saved_feedback if st.session_state.saved_feedback else "无特别意见"}
+                st.session_state.optimize_stage = "idle"
+                
+                # 构建包含附件的feedback
+                optimize_attachment = st.session_state.get("uploaded_file_content", "")
+                optimize_attachment_name = st.session_state.get("uploaded_file_name", "")
+                final_feedback = feedback
+                if optimize_attachment:
+                    final_feedback = f"""{feedback if feedback else "无特别意见"}
 
 【附件内容参考】（文件名: {optimize_attachment_name}）
 {optimize_attachment}"""
-            
-            initial_container = st.empty()
-            initial_fixed, success, error = optimize_prd_initial(
-                st.session_state.saved_old_prd, 
-                final_feedback,
-                use_stream=True, 
-                container=initial_container,
-                thinking_container=thinking_container,
-                status_container=status_container
-            )
-            
-            if success and initial_fixed:
-                st.session_state.initial_fixed_prd = initial_fixed
-                st.success("初始修正完成！")
-                st.session_state.optimize_stage = "reflection"
-                st.rerun()
-            elif error:
-                st.error(f"❌ 初始修正失败: {error}")
-                st.session_state.is_processing = False
-                st.session_state.optimize_stage = "idle"
-            elif st.session_state.should_stop:
-                st.warning("⏹️ 已中止")
-                st.session_state.is_processing = False
-                st.session_state.optimize_stage = "idle"
-                st.session_state.should_stop = False
-            else:
-                st.error("初始修正失败，请重试")
-                st.session_state.is_processing = False
-                st.session_state.optimize_stage = "idle"
-        
-        # 处理Reflection循环阶段
-        elif st.session_state.is_processing and st.session_state.optimize_stage == "reflection":
-            # 显示已完成的初始修正
-            st.markdown("### 📌 Step 1: 初始修正")
-            with st.expander("查看初始修正结果", expanded=False):
-                st.markdown(st.session_state.initial_fixed_prd)
-            st.success("初始修正完成！")
-            st.markdown("---")
-            
-            # Reflection循环
-            st.markdown("### 🔁 Step 2: Reflection 循环优化")
-            final_prd, was_stopped = reflection_loop(st.session_state.initial_fixed_prd, st.session_state.saved_max_iterations)
-            
-            st.session_state.optimized_prd = final_prd
-            
-            if was_stopped:
-                st.warning("⏹️ 迭代已中止，将使用当前版本进行复检")
-                st.session_state.should_stop = False
-            
-            st.session_state.optimize_stage = "checking"
-            st.rerun()
+                
+                # 设置写入检查点，中断后“继续优化”沿用同一份设置
+                run_id = get_checkpoint_store().create_run({
+                    "old_prd": old_prd,
+                    "feedback": final_feedback,
+                    "display_feedback": feedback,
+                    "attachment_name": optimize_attachment_name if optimize_attachment else "",
+                    "max_iterations": int(max_iterations),
+                    "parallel": st.session_state.parallel_self_check,
+                    "model": get_selected_model(),
+                    "fallback_models": get_call_context()["fallback_models"],
+                    "convergence_threshold": convergence_percent / 100 if early_stop else 0.0,
+                    "patch_mode": patch_mode,
+                    "incremental_review": incremental_review,
+                    "review_personas": review_personas,
+                    "sharded": sharded,
+                })
+                st.session_state.optimize_checkpoint_id = run_id
+                st.query_params[CHECKPOINT_QUERY_PARAM] = run_id
+                job = start_job("优化策划案", run_optimize_prd_job, run_id)
+                job.meta.update(old_prd=old_prd, feedback=feedback, max_iterations=max_iterations)
+                st.rerun()  # 触发重新渲染
         
-        # 处理最终检查阶段
-        elif st.session_state.is_processing and st.session_state.optimize_stage == "checking":
-            # 显示之前的步骤
-            st.markdown("### 📌 Step 1: 初始修正")
-            st.success("初始修正完成！")
-            st.markdown("---")
-            
-            st.markdown("### 🔁 Step 2: Reflection 循环优化")
-            st.success(f"完成 {st.session_state.saved_max_iterations} 轮迭代优化！")
-            st.markdown("---")
-            
-            # AI自检 - 流式输出
-            st.markdown("### 🔍 Step 3: AI复检清单检查")
-            
-            # 显示中止按钮和状态
-            col_status, col_stop = st.columns([4, 1])
-            with col_status:
-                st.markdown("**🔍 AI正在进行最终复检清单检查...**")
-            with col_stop:
-                if st.button("⏹️ 中止检查", key="stop_final_check", type="secondary"):
-                    st.session_state.should_stop = True
-                    st.session_state.optimize_processing = False
-                    st.session_state.optimize_stage = "idle"
-                    st.warning("⏹️ 检查已中止")
-                    st.rerun()
-            
-            # 思考过程展示区域
-            thinking_expander = st.expander("💭 查看模型思考过程", expanded=False)
-            with thinking_expander:
-                thinking_container = st.empty()
-            
-            status_container = st.empty()
-            check_container = st.empty()
-            
-            check_result, success, error = ai_self_check(
-                st.session_state.optimized_prd, 
-                use_stream=True, 
-                container=check_container,
-                thinking_container=thinking_container,
-                status_container=status_container
-            )
-            
-            if success and check_result:
-                st.session_state.optimized_check_result = check_result
-                st.success("✅ 复检完成！")
-            elif error:
-                st.error(f"❌ 复检失败: {error}")
-                st.session_state.optimized_check_result = ""
+        # 后台任务进行中：定时刷新进度；结束后取回结果
+        optimize_job = get_active_job("优化策划案")
+        if optimize_job is not None and not optimize_job.finished:
+            render_job_progress("优化策划案")
+        elif optimize_job is not None:
+            release_active_job("优化策划案")
+            st.session_state.saved_old_prd = optimize_job.meta.get("old_prd", "")
+            st.session_state.saved_feedback = optimize_job.meta.get("feedback", "")
+            st.session_state.saved_max_iterations = optimize_job.meta.get("max_iterations", 3)
+            st.session_state.last_model_used = optimize_job.last_model_used
+            st.session_state.initial_fixed_prd = optimize_job.result.get("initial_prd", "")
+            st.session_state.optimized_prd = optimize_job.result.get("prd", "")
+            st.session_state.optimized_check_result = optimize_job.result.get("check", "")
+            if optimize_job.status == "done":
+                st.session_state.optimize_stage = "done"
+                st.session_state.optimize_checkpoint_id = ""
+                if CHECKPOINT_QUERY_PARAM in st.query_params:
+                    del st.query_params[CHECKPOINT_QUERY_PARAM]
+                st.success("✅ 策划案优化完成！")
+                if optimize_job.result.get("convergence"):
+                    st.info(optimize_job.result["convergence"])
+                if optimize_job.result.get("check_error"):
+                    st.error(f"❌ 复检失败: {optimize_job.result['check_error']}")
+            elif optimize_job.status == "cancelled":
+                if st.session_state.optimized_prd:
+                    # Reflection 迭代中止：保留当前版本（未复检）
+                    st.session_state.optimize_stage = "done"
+                    st.warning(f"⏹️ 迭代已中止，已保留当前版本（未进行复检）{format_consumed_tokens(optimize_job.token)}")
+                else:
+                    st.warning(f"⏹️ 优化已中止{format_consumed_tokens(optimize_job.token)}")
             else:
-                st.session_state.optimized_check_result = ""
-            
-            st.session_state.is_processing = False
-            st.session_state.optimize_stage = "done"
-            st.session_state.should_stop = False
-            st.success("✅ 策划案优化完成！")
-            st.rerun()  # 刷新以显示最终结果和下载按钮
+                st.error(f"❌ {optimize_job.error}")
+        
+        # 未完成的优化（中止、失败、刷新页面或服务重启）：从最后完成的轮次继续
+        if st.session_state.optimize_checkpoint_id and not is_job_running("优化策划案"):
+            checkpoint = get_checkpoint_store().load(st.session_state.optimize_checkpoint_id)
+            if checkpoint is not None and checkpoint["status"] != "done":
+                settings = checkpoint["settings"]
+                resume_col, resume_btn_col = st.columns([4, 1])
+                with resume_col:
+                    progress = f"已完成 {len(checkpoint['rounds'])}/{settings['max_iterations']} 轮迭代" \
+                        if checkpoint["initial_prd"] else "尚未完成初始修正"
+                    st.info(f"♻️ 检测到未完成的优化（{progress}），可使用相同设置继续，已完成的轮次不会重新生成")
+                with resume_btn_col:
+                    if st.button("▶️ 继续优化", key="resume_optimize", use_container_width=True):
+                        st.session_state.optimized_prd = ""
+                        st.session_state.optimized_check_result = ""
+                        st.session_state.optimize_saved_to_history = False
+                        st.session_state.optimize_stage = "idle"
+                        st.query_params[CHECKPOINT_QUERY_PARAM] = checkpoint["run_id"]
+                        job = start_job("优化策划案", run_optimize_prd_job, checkpoint["run_id"])
+                        job.meta.update(old_prd=settings["old_prd"], feedback=settings["display_feedback"],
+                                        max_iterations=settings["max_iterations"])
+                        st.rerun()
         
         # 初始化优化自检结果的session_state
         if "optimized_check_result" not in st.session_state:
             st.session_state.optimized_check_result = ""
         
         # 显示已保存的优化结果（非处理中状态）
-        if st.session_state.optimized_prd and not st.session_state.is_processing:
+        if st.session_state.optimized_prd and not is_job_running("优化策划案"):
             # 使用格式化显示函数
             render_prd_document(st.session_state.optimized_prd, "优化后的策划案")
             
@@ -3605,16 +8427,17 @@ graph LR
                 with st.spinner("正在思考..."):
                     response_container = st.empty()
                     full_response = ""
+                    response_renderer = StreamRenderer(response_container, cursor="▌")
                     for chunk in call_gemini_stream(full_prompt, INITIAL_FIX_SYSTEM_PROMPT):
                         if chunk["type"] == "text":
                             full_response += chunk["content"]
-                            response_container.markdown(full_response + "▌")
+                            response_renderer.update(full_response)
                         elif chunk["type"] == "error":
                             st.error(f"生成失败: {chunk['content']}")
                             break
                     
                     if full_response:
-                        response_container.markdown(full_response)
+                        response_renderer.flush()
                         add_chat_message(chat_key, "assistant", full_response)
                         st.rerun()
     
@@ -3659,11 +8482,9 @@ graph LR
         # 初始化汇报助手相关的session_state
         if "generated_report" not in st.session_state:
             st.session_state.generated_report = ""
-        if "report_processing" not in st.session_state:
-            st.session_state.report_processing = False
         
         # 生成按钮
-        if st.button("📝 生成汇报", type="primary", disabled=st.session_state.report_processing):
+        if st.button("📝 生成汇报", type="primary", disabled=is_job_running("汇报助手")):
             # 验证输入
             if not current_problem.strip():
                 st.error("请填写【当前问题】！")
@@ -3672,35 +8493,11 @@ graph LR
             elif not expected_result.strip():
                 st.error("请填写【预期结果】！")
             else:
-                st.session_state.report_processing = True
-                st.session_state.should_stop = False
                 st.session_state.generated_report = ""
                 st.session_state.report_saved_to_history = False  # 重置历史保存标记
-                st.rerun()
-        
-        # 处理生成阶段
-        if st.session_state.report_processing:
-            # 显示中止按钮和状态
-            col_status, col_stop = st.columns([4, 1])
-            with col_status:
-                st.markdown("**✍️ 正在生成汇报文案...**")
-            with col_stop:
-                if st.button("⏹️ 中止生成", key="stop_report", type="secondary"):
-                    st.session_state.should_stop = True
-                    st.session_state.report_processing = False
-                    st.warning("⏹️ 生成已中止")
-                    st.rerun()
-            
-            # 思考过程展示区域
-            thinking_expander = st.expander("💭 查看模型思考过程", expanded=False)
-            with thinking_expander:
-                thinking_container = st.empty()
-            
-            # 输出容器
-            output_container = st.empty()
-            
-            # 构建Prompt
-            user_prompt = f"""请根据以下信息，撰写一份给领导的工作汇报文案：
+                
+                # 构建Prompt
+                user_prompt = f"""请根据以下信息，撰写一份给领导的工作汇报文案：
 
 【当前问题】
 {current_problem}
@@ -3712,54 +8509,28 @@ graph LR
 {expected_result}
 
 请按照模板格式输出汇报文案。"""
-            
-            # 调用Gemini API（流式）
-            full_response = ""
-            thinking_content = ""
-            was_stopped = False
-            has_error = False
-            error_message = ""
-            
-            for chunk in call_gemini_stream(user_prompt, REPORT_ASSISTANT_SYSTEM_PROMPT, thinking_container):
-                if st.session_state.should_stop:
-                    was_stopped = True
-                    break
                 
-                if chunk["type"] == "text":
-                    full_response += chunk["content"]
-                    output_container.markdown(full_response + "▌")
-                elif chunk["type"] == "thinking":
-                    thinking_content += chunk["content"]
-                    with thinking_expander:
-                        thinking_container.markdown(thinking_content)
-                elif chunk["type"] == "error":
-                    has_error = True
-                    error_message = chunk["content"]
-                    break
-                elif chunk["type"] == "retry":
-                    st.info(chunk["content"])
-            
-            # 移除光标
-            if full_response:
-                output_container.markdown(full_response)
-            
-            # 处理结果
-            if has_error:
-                st.error(f"❌ 生成失败: {error_message}")
-            elif was_stopped:
-                st.warning("⚠️ 生成已中止")
-                if full_response:
-                    st.session_state.generated_report = full_response
-            else:
+                start_job("汇报助手", run_stream_job, user_prompt, REPORT_ASSISTANT_SYSTEM_PROMPT, "✍️ 正在生成汇报文案...")
+                st.rerun()
+        
+        # 后台任务进行中：定时刷新进度；结束后取回结果
+        report_job = get_active_job("汇报助手")
+        if report_job is not None and not report_job.finished:
+            render_job_progress("汇报助手")
+        elif report_job is not None:
+            release_active_job("汇报助手")
+            st.session_state.last_model_used = report_job.last_model_used
+            # 中止时保留已生成的部分结果
+            st.session_state.generated_report = report_job.result.get("text", "")
+            if report_job.status == "done":
                 st.success("✅ 汇报文案生成完成！")
-                st.session_state.generated_report = full_response
-            
-            st.session_state.report_processing = False
-            st.session_state.should_stop = False
-            st.rerun()
+            elif report_job.status == "cancelled":
+                st.warning(f"⚠️ 生成已中止{format_consumed_tokens(report_job.token)}")
+            else:
+                st.error(f"❌ 生成失败: {report_job.error}")
         
         # 显示已生成的汇报（非处理中状态）
-        if st.session_state.generated_report and not st.session_state.report_processing:
+        if st.session_state.generated_report and not is_job_running("汇报助手"):
             # 使用格式化显示函数
             render_prd_document(st.session_state.generated_report, "汇报文案")
             
@@ -3839,16 +8610,17 @@ graph LR
                 with st.spinner("正在思考..."):
                     response_container = st.empty()
                     full_response = ""
+                    response_renderer = StreamRenderer(response_container, cursor="▌")
                     for chunk in call_gemini_stream(full_prompt, REPORT_ASSISTANT_SYSTEM_PROMPT):
                         if chunk["type"] == "text":
                             full_response += chunk["content"]
-                            response_container.markdown(full_response + "▌")
+                            response_renderer.update(full_response)
                         elif chunk["type"] == "error":
                             st.error(f"生成失败: {chunk['content']}")
                             break
                     
                     if full_response:
-                        response_container.markdown(full_response)
+                        response_renderer.flush()
                         add_chat_message(chat_key, "assistant", full_response)
                         st.rerun()
     
@@ -3889,98 +8661,44 @@ graph LR
         # 初始化周报助手相关的session_state
         if "generated_weekly_report" not in st.session_state:
             st.session_state.generated_weekly_report = ""
-        if "weekly_report_processing" not in st.session_state:
-            st.session_state.weekly_report_processing = False
         
         # 生成按钮
-        if st.button("📝 生成周报", type="primary", disabled=st.session_state.weekly_report_processing):
+        if st.button("📝 生成周报", type="primary", disabled=is_job_running("周报助手")):
             if not daily_logs.strip():
                 st.error("请输入本周日报/工作记录！")
             else:
-                st.session_state.weekly_report_processing = True
-                st.session_state.should_stop = False
                 st.session_state.generated_weekly_report = ""
                 st.session_state.saved_daily_logs = daily_logs
                 st.session_state.weekly_saved_to_history = False  # 重置历史保存标记
-                st.rerun()
-        
-        # 处理生成阶段
-        if st.session_state.weekly_report_processing:
-            # 显示中止按钮和状态
-            col_status, col_stop = st.columns([4, 1])
-            with col_status:
-                st.markdown("**✍️ 正在生成周报...**")
-            with col_stop:
-                if st.button("⏹️ 中止生成", key="stop_weekly", type="secondary"):
-                    st.session_state.should_stop = True
-                    st.session_state.weekly_report_processing = False
-                    st.warning("⏹️ 生成已中止")
-                    st.rerun()
-            
-            # 思考过程展示区域
-            thinking_expander = st.expander("💭 查看模型思考过程", expanded=False)
-            with thinking_expander:
-                thinking_container = st.empty()
-            
-            # 输出容器
-            output_container = st.empty()
-            
-            # 构建Prompt
-            saved_logs = st.session_state.get("saved_daily_logs", daily_logs)
-            user_prompt = f"""
+                
+                # 构建Prompt
+                user_prompt = f"""
 {WEEKLY_REPORT_SYSTEM_PROMPT}
 
 Input Data (本周日报/工作记录):
-{saved_logs}
+{daily_logs}
 """
-            
-            # 调用Gemini API（流式）
-            full_response = ""
-            thinking_content = ""
-            was_stopped = False
-            has_error = False
-            error_message = ""
-            
-            for chunk in call_gemini_stream(user_prompt, ""):
-                if st.session_state.should_stop:
-                    was_stopped = True
-                    break
-                
-                if chunk["type"] == "text":
-                    full_response += chunk["content"]
-                    output_container.markdown(full_response + "▌")
-                elif chunk["type"] == "thinking":
-                    thinking_content += chunk["content"]
-                    with thinking_expander:
-                        thinking_container.markdown(thinking_content)
-                elif chunk["type"] == "error":
-                    has_error = True
-                    error_message = chunk["content"]
-                    break
-                elif chunk["type"] == "retry":
-                    st.info(chunk["content"])
-            
-            # 移除光标
-            if full_response:
-                output_container.markdown(full_response)
-            
-            # 处理结果
-            if has_error:
-                st.error(f"❌ 生成失败: {error_message}")
-            elif was_stopped:
-                st.warning("⚠️ 生成已中止")
-                if full_response:
-                    st.session_state.generated_weekly_report = full_response
-            else:
+                start_job("周报助手", run_stream_job, user_prompt, "", "✍️ 正在生成周报...")
+                st.rerun()
+        
+        # 后台任务进行中：定时刷新进度；结束后取回结果
+        weekly_job = get_active_job("周报助手")
+        if weekly_job is not None and not weekly_job.finished:
+            render_job_progress("周报助手")
+        elif weekly_job is not None:
+            release_active_job("周报助手")
+            st.session_state.last_model_used = weekly_job.last_model_used
+            # 中止时保留已生成的部分结果
+            st.session_state.generated_weekly_report = weekly_job.result.get("text", "")
+            if weekly_job.status == "done":
                 st.success("✅ 周报生成完成！")
-                st.session_state.generated_weekly_report = full_response
-            
-            st.session_state.weekly_report_processing = False
-            st.session_state.should_stop = False
-            st.rerun()
+            elif weekly_job.status == "cancelled":
+                st.warning(f"⚠️ 生成已中止{format_consumed_tokens(weekly_job.token)}")
+            else:
+                st.error(f"❌ 生成失败: {weekly_job.error}")
         
         # 显示已生成的周报（非处理中状态）
-        if st.session_state.generated_weekly_report and not st.session_state.weekly_report_processing:
+        if st.session_state.generated_weekly_report and not is_job_running("周报助手"):
             # 使用格式化显示函数
             render_prd_document(st.session_state.generated_weekly_report, "周报")
             
@@ -4056,16 +8774,17 @@ Input Data (本周日报/工作记录):
                 with st.spinner("正在思考..."):
                     response_container = st.empty()
                     full_response = ""
+                    response_renderer = StreamRenderer(response_container, cursor="▌")
                     for chunk in call_gemini_stream(full_prompt, WEEKLY_REPORT_SYSTEM_PROMPT):
                         if chunk["type"] == "text":
                             full_response += chunk["content"]
-                            response_container.markdown(full_response + "▌")
+                            response_renderer.update(full_response)
                         elif chunk["type"] == "error":
                             st.error(f"生成失败: {chunk['content']}")
                             break
                     
                     if full_response:
-                        response_container.markdown(full_response)
+                        response_renderer.flush()
                         add_chat_message(chat_key, "assistant", full_response)
                         st.rerun()
     
@@ -4091,99 +8810,45 @@ Input Data (本周日报/工作记录):
         # 初始化白皮书助手相关的session_state
         if "generated_feature_desc" not in st.session_state:
             st.session_state.generated_feature_desc = ""
-        if "whitepaper_processing" not in st.session_state:
-            st.session_state.whitepaper_processing = False
         
         # 生成按钮
-        if st.button("📝 生成功能描述", type="primary", disabled=st.session_state.whitepaper_processing):
+        if st.button("📝 生成功能描述", type="primary", disabled=is_job_running("白皮书助手")):
             if not feature_keyword.strip():
                 st.error("请输入功能关键词！")
             else:
-                st.session_state.whitepaper_processing = True
-                st.session_state.should_stop = False
                 st.session_state.generated_feature_desc = ""
                 st.session_state.saved_feature_keyword = feature_keyword
                 st.session_state.whitepaper_saved_to_history = False  # 重置历史保存标记
-                st.rerun()
-        
-        # 处理生成阶段
-        if st.session_state.whitepaper_processing:
-            # 显示中止按钮和状态
-            col_status, col_stop = st.columns([4, 1])
-            with col_status:
-                st.markdown("**✍️ 正在生成功能描述...**")
-            with col_stop:
-                if st.button("⏹️ 中止生成", key="stop_whitepaper", type="secondary"):
-                    st.session_state.should_stop = True
-                    st.session_state.whitepaper_processing = False
-                    st.warning("⏹️ 生成已中止")
-                    st.rerun()
-            
-            # 思考过程展示区域
-            thinking_expander = st.expander("💭 查看模型思考过程", expanded=False)
-            with thinking_expander:
-                thinking_container = st.empty()
-            
-            # 输出容器
-            output_container = st.empty()
-            
-            # 构建Prompt
-            saved_keyword = st.session_state.get("saved_feature_keyword", feature_keyword)
-            user_prompt = f"""
+                
+                # 构建Prompt
+                user_prompt = f"""
 {WHITEPAPER_ASSISTANT_SYSTEM_PROMPT}
 
 ---
 请输入功能关键词：
-【{saved_keyword}】
+【{feature_keyword}】
 """
-            
-            # 调用Gemini API（流式）
-            full_response = ""
-            thinking_content = ""
-            was_stopped = False
-            has_error = False
-            error_message = ""
-            
-            for chunk in call_gemini_stream(user_prompt, ""):
-                if st.session_state.should_stop:
-                    was_stopped = True
-                    break
-                
-                if chunk["type"] == "text":
-                    full_response += chunk["content"]
-                    output_container.markdown(full_response + "▌")
-                elif chunk["type"] == "thinking":
-                    thinking_content += chunk["content"]
-                    with thinking_expander:
-                        thinking_container.markdown(thinking_content)
-                elif chunk["type"] == "error":
-                    has_error = True
-                    error_message = chunk["content"]
-                    break
-                elif chunk["type"] == "retry":
-                    st.info(chunk["content"])
-            
-            # 移除光标
-            if full_response:
-                output_container.markdown(full_response)
-            
-            # 处理结果
-            if has_error:
-                st.error(f"❌ 生成失败: {error_message}")
-            elif was_stopped:
-                st.warning("⚠️ 生成已中止")
-                if full_response:
-                    st.session_state.generated_feature_desc = full_response
-            else:
+                start_job("白皮书助手", run_stream_job, user_prompt, "", "✍️ 正在生成功能描述...")
+                st.rerun()
+        
+        # 后台任务进行中：定时刷新进度；结束后取回结果
+        whitepaper_job = get_active_job("白皮书助手")
+        if whitepaper_job is not None and not whitepaper_job.finished:
+            render_job_progress("白皮书助手")
+        elif whitepaper_job is not None:
+            release_active_job("白皮书助手")
+            st.session_state.last_model_used = whitepaper_job.last_model_used
+            # 中止时保留已生成的部分结果
+            st.session_state.generated_feature_desc = whitepaper_job.result.get("text", "")
+            if whitepaper_job.status == "done":
                 st.success("✅ 功能描述生成完成！")
-                st.session_state.generated_feature_desc = full_response
-            
-            st.session_state.whitepaper_processing = False
-            st.session_state.should_stop = False
-            st.rerun()
+            elif whitepaper_job.status == "cancelled":
+                st.warning(f"⚠️ 生成已中止{format_consumed_tokens(whitepaper_job.token)}")
+            else:
+                st.error(f"❌ 生成失败: {whitepaper_job.error}")
         
         # 显示已生成的功能描述（非处理中状态）
-        if st.session_state.generated_feature_desc and not st.session_state.whitepaper_processing:
+        if st.session_state.generated_feature_desc and not is_job_running("白皮书助手"):
             # 使用格式化显示函数
             render_prd_document(st.session_state.generated_feature_desc, "功能描述")
             
@@ -4259,16 +8924,17 @@ Input Data (本周日报/工作记录):
                 with st.spinner("正在思考..."):
                     response_container = st.empty()
                     full_response = ""
+                    response_renderer = StreamRenderer(response_container, cursor="▌")
                     for chunk in call_gemini_stream(full_prompt, WHITEPAPER_ASSISTANT_SYSTEM_PROMPT):
                         if chunk["type"] == "text":
                             full_response += chunk["content"]
-                            response_container.markdown(full_response + "▌")
+                            response_renderer.update(full_response)
                         elif chunk["type"] == "error":
                             st.error(f"生成失败: {chunk['content']}")
                             break
                     
                     if full_response:
-                        response_container.markdown(full_response)
+                        response_renderer.flush()
                         add_chat_message(chat_key, "assistant", full_response)
                         st.rerun()
     
@@ -4664,20 +9330,23 @@ Input Data (本周日报/工作记录):
             full_response = ""
             thinking_text = ""
             
+            response_renderer = StreamRenderer(response_container)
+            thinking_renderer = StreamRenderer(thinking_container, cursor="")
             for chunk in call_gemini_stream(full_prompt, LINA_SYSTEM_PROMPT):
                 if chunk["type"] == "text":
                     full_response += chunk["content"]
-                    response_container.markdown(full_response + " ▌")
+                    response_renderer.update(full_response)
                 elif chunk["type"] == "thinking":
                     thinking_text += chunk["content"]
-                    with thinking_expander:
-                        thinking_container.markdown(thinking_text)
+                    thinking_renderer.update(thinking_text)
                 elif chunk["type"] == "error":
                     st.error(f"生成失败: {chunk['content']}")
                     break
             
+            thinking_renderer.flush()
+            
             if full_response:
-                response_container.markdown(full_response)
+                response_renderer.flush()
                 # 添加AI回复到历史
                 st.session_state.lina_chat_history.append({
                     "role": "assistant",
@@ -5179,20 +9848,23 @@ Tone:
             full_response = ""
             thinking_text = ""
             
+            response_renderer = StreamRenderer(response_container)
+            thinking_renderer = StreamRenderer(thinking_container, cursor="")
             for chunk in call_gemini_stream(full_prompt, LINMO_SYSTEM_PROMPT):
                 if chunk["type"] == "text":
                     full_response += chunk["content"]
-                    response_container.markdown(full_response + " ▌")
+                    response_renderer.update(full_response)
                 elif chunk["type"] == "thinking":
                     thinking_text += chunk["content"]
-                    with thinking_expander:
-                        thinking_container.markdown(thinking_text)
+                    thinking_renderer.update(thinking_text)
                 elif chunk["type"] == "error":
                     st.error(f"生成失败: {chunk['content']}")
                     break
             
+            thinking_renderer.flush()
+            
             if full_response:
-                response_container.markdown(full_response)
+                response_renderer.flush()
                 # 添加AI回复到历史
                 st.session_state.linmo_chat_history.append({
                     "role": "assistant",
@@ -5221,8 +9893,6 @@ Tone:
         # 初始化session state
         if "wow_review_result" not in st.session_state:
             st.session_state.wow_review_result = ""
-        if "wow_is_processing" not in st.session_state:
-            st.session_state.wow_is_processing = False
         if "wow_uploaded_video" not in st.session_state:
             st.session_state.wow_uploaded_video = None
         
@@ -5239,12 +9909,11 @@ Tone:
             "🎬 开始AI评审",
             key="wow_start_review",
             type="primary",
-            disabled=uploaded_video is None or st.session_state.wow_is_processing
+            disabled=uploaded_video is None or is_job_running("PUBGM WoW 玩法评审")
         )
         
         # 处理评审逻辑
-        if start_review and uploaded_video and not st.session_state.wow_is_processing:
-            st.session_state.wow_is_processing = True
+        if start_review and uploaded_video and not is_job_running("PUBGM WoW 玩法评审"):
             st.session_state.wow_review_result = ""
             
             # WoW 评审专用的 System Prompt
@@ -5276,77 +9945,31 @@ Output Format (Markdown):
 [请给出一段总结性的评价，指出这个作品最大的亮点是什么，以及最需要改进的一个地方。]
 """
             
-            with st.spinner("正在上传视频并进行AI分析，请稍候...（视频越长耗时越久）"):
-                temp_file_path = None
-                uploaded_file_obj = None
-                
-                try:
-                    # 创建 Client 实例
-                    client = genai.Client(api_key=st.session_state.api_key)
-                    
-                    # 1. 临时保存视频文件
-                    suffix = "." + uploaded_video.name.split(".")[-1].lower()
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
-                        tmp_file.write(uploaded_video.read())
-                        temp_file_path = tmp_file.name
-                    
-                    st.info("📤 正在上传视频到AI服务...")
-                    
-                    # 2. 上传视频到 Gemini File API (使用 client.files.upload)
-                    uploaded_file_obj = client.files.upload(
-                        file=temp_file_path,
-                        config={"display_name": "WoW_Gameplay"}
-                    )
-                    
-                    st.info("⏳ 视频正在处理中，请耐心等待...")
-                    
-                    # 3. 等待视频处理完成
-                    while uploaded_file_obj.state.name == "PROCESSING":
-                        time.sleep(2)
-                        uploaded_file_obj = client.files.get(name=uploaded_file_obj.name)
-                    
-                    if uploaded_file_obj.state.name == "FAILED":
-                        st.error("❌ 视频处理失败，请尝试上传其他视频。")
-                        st.session_state.wow_is_processing = False
-                    elif uploaded_file_obj.state.name == "ACTIVE":
-                        st.info("🤖 AI 正在分析视频内容...")
-                        
-                        # 4. 调用模型生成评审报告
-                        # 获取当前选择的模型
-                        current_model = st.session_state.get("selected_model", "gemini-2.0-flash")
-                        
-                        response = client.models.generate_content(
-                            model=current_model,
-                            contents=[uploaded_file_obj, WOW_REVIEW_PROMPT]
-                        )
-                        
-                        if response and response.text:
-                            st.session_state.wow_review_result = response.text
-                            st.success("✅ 评审完成！")
-                        else:
-                            st.error("❌ AI 未能生成评审结果，请重试。")
-                    else:
-                        st.error(f"❌ 视频状态异常: {uploaded_file_obj.state.name}")
-                
-                except Exception as e:
-                    st.error(f"❌ 评审过程中出错: {str(e)}")
-                
-                finally:
-                    # 5. 清理：删除本地临时文件
-                    if temp_file_path and os.path.exists(temp_file_path):
-                        try:
-                            os.remove(temp_file_path)
-                        except:
-                            pass
-                    
-                    # 可选：删除云端文件
-                    if uploaded_file_obj:
-                        try:
-                            client.files.delete(name=uploaded_file_obj.name)
-                        except:
-                            pass
-                    
-                    st.session_state.wow_is_processing = False
+            if get_gemini_client() is not None:
+                # 临时保存视频文件，上传和分析在后台任务中进行（完成后删除）
+                suffix = "." + uploaded_video.name.split(".")[-1].lower()
+                with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
+                    tmp_file.write(uploaded_video.read())
+                    temp_file_path = tmp_file.name
+                start_job("PUBGM WoW 玩法评审", run_wow_review_job, temp_file_path, WOW_REVIEW_PROMPT,
+                          cleanup=lambda: remove_temp_file(temp_file_path))
+                st.rerun()
+        
+        # 后台任务进行中：定时刷新进度；结束后取回结果
+        wow_job = get_active_job("PUBGM WoW 玩法评审")
+        if wow_job is not None and not wow_job.finished:
+            st.caption("视频越长耗时越久，评审在后台进行，可以切换到其他功能稍后回来查看")
+            render_job_progress("PUBGM WoW 玩法评审")
+        elif wow_job is not None:
+            release_active_job("PUBGM WoW 玩法评审")
+            st.session_state.last_model_used = wow_job.last_model_used
+            st.session_state.wow_review_result = wow_job.result.get("text", "")
+            if wow_job.status == "done":
+                st.success("✅ 评审完成！")
+            elif wow_job.status == "cancelled":
+                st.warning(f"⏹️ 评审已中止{format_consumed_tokens(wow_job.token)}")
+            else:
+                st.error(f"❌ 评审过程中出错: {wow_job.error}")
         
         # 显示评审结果
         if st.session_state.wow_review_result:
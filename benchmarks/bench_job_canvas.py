@@ -0,0 +1,123 @@
+"""
+后台任务进度区推送量基准：对比每次轮询重放整个画布与只重发仍在写入的占位时，推送到页面的数据量
+
+模拟一次后台生成：先输出思考过程，再按章节流式输出约 15000 字的策划案，页面每秒轮询一次。
+只统计渲染内容本身（UTF-8 字节数），不含 Streamlit 协议开销。
+
+运行方式（在仓库根目录）：
+    python benchmarks/bench_job_canvas.py
+"""
+
+import contextlib
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+CHAPTERS = 15
+CHAPTER_CHARS = 1000
+THINKING_CHARS = 2000
+CHARS_PER_SECOND = 200  # 模型输出速度（字/秒）
+RENDER_FPS = app.STREAM_RENDER_FPS
+
+
+class CountingStreamlit:
+    """替代 st 的计数器：记录各渲染调用推送的字节数"""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def _count(self, body, *args, **kwargs):
+        self.bytes += len(str(body).encode("utf-8"))
+
+    markdown = info = success = warning = error = _count
+
+    def expander(self, label, expanded=False):
+        self._count(label)
+        return contextlib.nullcontext()
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+def make_prd() -> str:
+    return "".join(
+        f"**{i}. 第{i}章**\n" + ("玩法规则说明文字，" * (CHAPTER_CHARS // 9)) + "\n"
+        for i in range(1, CHAPTERS + 1)
+    )
+
+
+def simulate():
+    """返回 (旧方案字节数, 新方案字节数, 轮询次数, 整页重跑次数)"""
+    clock = SimulatedClock()
+    counter = CountingStreamlit()
+    live_slots = []
+    app.time.monotonic = clock.monotonic
+    app.st = counter
+    app.render_live_job_slot = lambda slot: live_slots.append(slot)
+
+    canvas = app.JobCanvas()
+    canvas.markdown("### 📄 生成的策划案")
+    thinking_renderer = app.StreamRenderer(canvas.expander("💭 查看模型思考过程").empty(),
+                                           template="💭 **模型思考中...**\n\n{text}", cursor="")
+    canvas.empty()  # 状态提示
+    renderer = app.SegmentedStreamRenderer(canvas.empty())
+    thinking = "分析需求，" * (THINKING_CHARS // 5)
+    prd = make_prd()
+
+    legacy_bytes = new_bytes = polls = full_renders = 0
+    rendered_layout = None
+    watched = []
+    produced = 0
+    step = 1.0 / RENDER_FPS
+    total_chars = len(thinking) + len(prd)
+    while produced < total_chars:
+        # 一秒内按帧推进输出
+        for _ in range(RENDER_FPS):
+            clock.now += step
+            produced = min(produced + CHARS_PER_SECOND * step, total_chars)
+            if produced <= len(thinking):
+                thinking_renderer.update(thinking[:int(produced)])
+            else:
+                thinking_renderer.flush()
+                renderer.update(prd[:int(produced) - len(thinking)])
+        if produced >= total_chars:
+            renderer.flush()
+        polls += 1
+
+        # 旧方案：每次轮询重放整个画布
+        counter.bytes = 0
+        app.render_job_canvas(canvas)
+        legacy_bytes += counter.bytes
+
+        # 新方案：布局变化或只渲染一次的占位再次被写入时整页重跑，否则只重发仍在写入的占位
+        counter.bytes = 0
+        if canvas.layout.version != rendered_layout or any(slot.version != v for slot, v in watched):
+            rendered_layout = canvas.layout.version
+            live_slots.clear()
+            watched = []
+            app.render_job_canvas(canvas, watched=watched)
+            full_renders += 1
+        for slot in live_slots:
+            counter._count(slot.state[1] if slot.state[0] != "empty" else "")
+        new_bytes += counter.bytes
+    return legacy_bytes, new_bytes, polls, full_renders
+
+
+def main():
+    legacy_bytes, new_bytes, polls, full_renders = simulate()
+    print(f"策划案 {CHAPTERS * CHAPTER_CHARS} 字，轮询 {polls} 次，其中整页重跑 {full_renders} 次")
+    print(f"每次轮询重放整个画布: {legacy_bytes / 1024:8.0f} KB")
+    print(f"只重发仍在写入的占位:{new_bytes / 1024:8.0f} KB")
+    print(f"减少: {1 - new_bytes / legacy_bytes:.0%}")
+
+
+if __name__ == "__main__":
+    main()
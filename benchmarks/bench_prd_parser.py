@@ -0,0 +1,238 @@
+"""
+策划案解析微基准：对比旧版三套独立解析（展示格式化、HTML 渲染、Excel 导出）与共用的 PrdDocument 语法树
+
+- 旧版：每次页面重跑都重新解析，三个函数各自逐行做正则匹配，HTML 渲染另有约 10 次全文 re.sub
+- 首次解析：一次遍历建立语法树，三个用途共用
+- 缓存命中：同一份策划案再次渲染（页面重跑）时按内容哈希取回已解析的结果
+
+运行方式（在仓库根目录）：
+    python benchmarks/bench_prd_parser.py
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+CHAPTER_COUNTS = [10, 40, 160]
+REPEAT = 5
+
+
+def make_prd(chapters: int) -> str:
+    """构造模拟的策划案：每章包含二级、三级标题，列表、流程步骤、加粗和普通段落"""
+    lines = ["**签到系统策划案**", "创建日期：2026-01-01", ""]
+    for c in range(1, chapters + 1):
+        lines += [f"{c}、第{c}章 功能规格", ""]
+        for s in range(1, 4):
+            lines += [f"{c}.{s} 小节{s}", f"本小节说明**核心规则**以及相关的配置项，数值为 {s * 10}%。", "流程如下："]
+            lines += [f"{k}、第{k}步：玩家在活动界面中完成对应的操作并领取奖励，系统记录日志" for k in range(1, 4)]
+            lines += ["", f"{c}.{s}.1 细则", "- 每日签到上限 1 次", "- 连续签到 **7 天** 额外奖励", "* 断签后重新计算", ""]
+    return "\n".join(lines)
+
+
+def legacy_format_prd_content(content: str) -> str:
+    """旧版 format_prd_content（逐行编译正则），仅用于对比"""
+    # 处理内容，增强格式
+    lines = content.split('\n')
+    formatted_lines = []
+    
+    # 用于判断是否在列表上下文中
+    in_list_context = False
+    
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        
+        # 跳过空行
+        if not stripped:
+            formatted_lines.append(line)
+            in_list_context = False
+            continue
+        
+        # 清理标题中的 ** 符号
+        clean_line = re.sub(r'\*\*', '', stripped)
+        
+        # 匹配三级标题：1.1.1、xxx 或 1.1.1 xxx（优先匹配更长的模式）
+        level3_match = re.match(r'^(\d+\.\d+\.\d+)[、\.．]?\s*(.+)$', clean_line)
+        # 匹配二级标题：1.1、xxx 或 1.1 xxx
+        level2_match = re.match(r'^(\d+\.\d+)[、\.．]?\s*(.+)$', clean_line)
+        # 匹配一级标题：仅行首为单个数字 + 顿号/点号 + 标题文字（不含冒号结尾，避免匹配列表）
+        level1_match = app.PRD_DISPLAY_LEVEL1_PATTERN.match(clean_line)
+        
+        # 检查是否是列表项（在特定上下文中的数字开头行）
+        # 列表项特征：前面有 - 或 * 开头，或者在流程/步骤描述中
+        is_list_item = False
+        
+        # 检查前一行是否暗示这是列表
+        if i > 0:
+            prev_line = lines[i-1].strip() if i > 0 else ""
+            # 如果前一行以冒号结尾，或包含"流程"、"步骤"等词，后续的数字行可能是列表
+            if prev_line.endswith('：') or prev_line.endswith(':') or \
+               '流程' in prev_line or '步骤' in prev_line or in_list_context:
+                # 检查当前行是否看起来像列表项（较长的描述性文字）
+                if level1_match and len(clean_line) > 20:
+                    is_list_item = True
+                    in_list_context = True
+        
+        # 检查是否是以 - 或 * 开头的列表项
+        if stripped.startswith('-') or stripped.startswith('*'):
+            # 保持原样，只清理多余的 **
+            formatted_lines.append(re.sub(r'\*\*([^*]+)\*\*', r'**\1**', line))
+            in_list_context = True
+            continue
+        
+        if level3_match:
+            num, title = level3_match.groups()
+            title = title.strip()
+            formatted_lines.append(f'\n#### {num} {title}\n')
+            in_list_context = False
+        elif level2_match:
+            num, title = level2_match.groups()
+            title = title.strip()
+            formatted_lines.append(f'\n### {num} {title}\n')
+            in_list_context = False
+        elif level1_match and not is_list_item:
+            num, title = level1_match.groups()
+            title = title.strip()
+            # 一级标题使用特殊样式
+            formatted_lines.append(f'\n## {num}、{title}\n')
+            in_list_context = False
+        else:
+            # 对于普通行，保持原样但清理格式
+            # 处理列表项格式，确保 **xxx** 格式正确
+            processed_line = line
+            # 如果是数字开头的列表项，转换为有序列表格式
+            list_item_match = re.match(r'^(\d+)[、\.．]\s*(.+)$', clean_line)
+            if list_item_match and is_list_item:
+                num, text = list_item_match.groups()
+                processed_line = f'{num}. {text}'
+            formatted_lines.append(processed_line)
+    
+    return '\n'.join(formatted_lines)
+
+
+def legacy_render_html(content: str) -> str:
+    """旧版 render_prd_document 的 HTML 转换（约 10 次全文 re.sub），仅用于对比"""
+    # 格式化内容
+    formatted_content = legacy_format_prd_content(content)
+    
+    # 将Markdown转换为HTML以便在自定义容器中正确显示
+    # 处理标题
+    html_content = formatted_content
+    
+    # 转换 ## 标题为 h2
+    html_content = re.sub(r'^## (.+)$', r'<h2>\1</h2>', html_content, flags=re.MULTILINE)
+    # 转换 ### 标题为 h3
+    html_content = re.sub(r'^### (.+)$', r'<h3>\1</h3>', html_content, flags=re.MULTILINE)
+    # 转换 #### 标题为 h4
+    html_content = re.sub(r'^#### (.+)$', r'<h4>\1</h4>', html_content, flags=re.MULTILINE)
+    
+    # 转换加粗文本
+    html_content = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', html_content)
+    
+    # 转换列表项 (- 开头)
+    html_content = re.sub(r'^- (.+)$', r'<li>\1</li>', html_content, flags=re.MULTILINE)
+    
+    # 转换有序列表项 (1. 开头)
+    html_content = re.sub(r'^(\d+)\. (.+)$', r'<li>\2</li>', html_content, flags=re.MULTILINE)
+    
+    # 将连续的 <li> 包裹在 <ul> 中
+    html_content = re.sub(r'((?:<li>.*?</li>\s*)+)', r'<ul>\1</ul>', html_content, flags=re.DOTALL)
+    
+    # 转换段落（非空行且不是HTML标签开头的行）
+    lines = html_content.split('\n')
+    processed_lines = []
+    for line in lines:
+        stripped = line.strip()
+        if stripped and not stripped.startswith('<') and not stripped.startswith('#'):
+            processed_lines.append(f'<p>{stripped}</p>')
+        else:
+            processed_lines.append(line)
+    html_content = '\n'.join(processed_lines)
+    
+    # 清理多余的空行
+    html_content = re.sub(r'\n{3,}', '\n\n', html_content)
+    
+    return html_content
+
+
+def legacy_excel_data(prd_content: str) -> list:
+    """旧版 parse_prd_to_excel_data（每行 4 次正则匹配），仅用于对比"""
+    lines = prd_content.strip().split('\n')
+    excel_data = []
+    current_level = 0
+    
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        
+        # 检查是否是标题行，从高级别往低级别检查
+        level4_match = app.PRD_LEVEL4_PATTERN.match(line)
+        level3_match = app.PRD_LEVEL3_PATTERN.match(line)
+        level2_match = app.PRD_LEVEL2_PATTERN.match(line)
+        level1_match = app.PRD_LEVEL1_PATTERN.match(line)
+        
+        if level4_match:
+            # 四级标题 -> 第4列
+            current_level = 4
+            excel_data.append((line, 4))
+        elif level3_match:
+            # 三级标题 -> 第3列
+            current_level = 3
+            excel_data.append((line, 3))
+        elif level2_match:
+            # 二级标题 -> 第2列
+            current_level = 2
+            excel_data.append((line, 2))
+        elif level1_match:
+            # 一级标题 -> 第1列
+            current_level = 1
+            excel_data.append((line, 1))
+        else:
+            # 普通内容 -> 当前标题的下一列，至少在第2列
+            content_level = max(current_level + 1, 2) if current_level > 0 else 1
+            excel_data.append((line, content_level))
+    
+    return excel_data
+
+
+def legacy_all(content: str):
+    return legacy_format_prd_content(content), legacy_render_html(content), legacy_excel_data(content)
+
+
+def shared_all(content: str):
+    return app.format_prd_content(content), app.parse_prd(content).html, app.parse_prd_to_excel_data(content)
+
+
+def shared_cold(content: str):
+    """清空缓存后解析（首次渲染某份策划案）"""
+    app.get_prd_parse_cache()._entries.clear()
+    return shared_all(content)
+
+
+def bench(fn, content: str, number: int) -> float:
+    """返回单次调用耗时（毫秒）"""
+    best = min(timeit.repeat(lambda: fn(content), number=number, repeat=REPEAT))
+    return best / number * 1e3
+
+
+def main():
+    print(f"{'章节数':>6} {'字符数':>8} {'旧版(ms)':>10} {'首次(ms)':>10} {'缓存(ms)':>10} {'首次加速':>8} {'缓存加速':>8}")
+    for chapters in CHAPTER_COUNTS:
+        content = make_prd(chapters)
+        # 三个用途的输出必须与旧版完全一致
+        assert shared_cold(content) == legacy_all(content)
+        number = max(1, 200 // chapters)
+        legacy = bench(legacy_all, content, number)
+        cold = bench(shared_cold, content, number)
+        warm = bench(shared_all, content, number * 20)
+        print(f"{chapters:>6} {len(content):>8} {legacy:>10.2f} {cold:>10.2f} {warm:>10.3f} "
+              f"{legacy / cold:>7.2f}x {legacy / warm:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+流式解码微基准：对比旧版逐 Part 反射解析与 decode_stream_chunk 的单 chunk 开销
+
+运行方式（在仓库根目录）：
+    python benchmarks/bench_stream_decoder.py
+"""
+
+import contextlib
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from google.genai import types  # noqa: E402
+
+import app  # noqa: E402
+
+CHUNK_COUNT = 200
+REPEAT = 5
+
+
+def make_chunks(count: int) -> list:
+    """构造模拟的流式响应：前 1/4 为思考摘要，之后为正文"""
+    chunks = []
+    for i in range(count):
+        thought = i < count // 4
+        chunks.append(types.GenerateContentResponse(candidates=[
+            types.Candidate(content=types.Content(role="model", parts=[
+                types.Part(text=f"第{i}段内容，" * 8, thought=thought or None)
+            ]))
+        ]))
+    return chunks
+
+
+def legacy_decode(chunks: list) -> list:
+    """旧版解析逻辑（hasattr/dir 反射 + stdout 调试输出），仅用于对比"""
+    out = []
+    debug_printed = False
+    for chunk in chunks:
+        if hasattr(chunk, 'candidates') and chunk.candidates:
+            for candidate in chunk.candidates:
+                if hasattr(candidate, 'content') and candidate.content:
+                    for part in candidate.content.parts:
+                        part_type = type(part).__name__
+                        if not debug_printed:
+                            part_attrs = [attr for attr in dir(part) if not attr.startswith('_')]
+                            print(f"[DEBUG call_gemini_stream] Part type: {part_type}")
+                            print(f"[DEBUG call_gemini_stream] Part attributes: {part_attrs}")
+                            for attr in ['thought', 'thinking', 'text']:
+                                if hasattr(part, attr):
+                                    val = getattr(part, attr)
+                                    print(f"[DEBUG call_gemini_stream] part.{attr} = {repr(val)[:100] if val else None}")
+                            debug_printed = True
+                        thinking_text = ""
+                        if hasattr(part, 'thought') and part.thought:
+                            thinking_text = part.thought
+                            print(f"[DEBUG] Found thinking content: {thinking_text}...")
+                        if thinking_text:
+                            out.append({"type": "thinking", "content": thinking_text})
+                        elif hasattr(part, 'text') and part.text:
+                            out.append({"type": "text", "content": part.text})
+        elif chunk.text:
+            out.append({"type": "text", "content": chunk.text})
+    return out
+
+
+def unified_decode(chunks: list) -> list:
+    out = []
+    for chunk in chunks:
+        out.extend(app.decode_stream_chunk(chunk))
+    return out
+
+
+def bench(fn, chunks: list) -> float:
+    """返回单 chunk 平均耗时（微秒），stdout 输出被丢弃"""
+    sink = io.StringIO()
+    with contextlib.redirect_stdout(sink):
+        best = min(timeit.repeat(lambda: fn(chunks), number=20, repeat=REPEAT))
+    return best / 20 / len(chunks) * 1e6
+
+
+def main():
+    chunks = make_chunks(CHUNK_COUNT)
+    legacy = bench(legacy_decode, chunks)
+    unified = bench(unified_decode, chunks)
+    print(f"chunks: {CHUNK_COUNT}")
+    print(f"legacy  : {legacy:8.2f} µs/chunk")
+    print(f"unified : {unified:8.2f} µs/chunk")
+    print(f"speedup : {legacy / unified:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()